@@ -0,0 +1,103 @@
+import random
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, List
+
+from analytics.SendToRemarkableRequestModel import SendToRemarkableRequestModel
+
+# DynamoDB's BatchWriteItem limit:
+MAX_BATCH_SIZE = 25
+
+
+class AnalyticsSink:
+    """
+    Buffer analytics events during an invocation and write them in batches.
+
+    Full buffers are written on a background thread, and whatever's left is
+    written by `flush()` at the end of the invocation. Unprocessed items are
+    retried with jittered backoff. Each written batch is also passed to
+    `rollup` (see analytics.rollups.record_rollups), if given. Nothing in
+    here ever raises: analytics must not get in the way of delivering
+    documents.
+    """
+
+    def __init__(
+        self,
+        model=SendToRemarkableRequestModel,
+        buffer_size: int = MAX_BATCH_SIZE,
+        max_retries: int = 3,
+        base_backoff: float = 0.05,
+        rollup: Callable[[List[dict]], None] = None,
+    ):
+        self.model = model
+        self.rollup = rollup
+        self.buffer_size = min(buffer_size, MAX_BATCH_SIZE)
+        self.max_retries = max_retries
+        self.base_backoff = base_backoff
+        self._buffer: List[dict] = []
+        self._keys = set()
+        self._lock = threading.Lock()
+        self._writer = ThreadPoolExecutor(max_workers=1)
+        self._pending: List[Future] = []
+
+    def record(self, **fields) -> None:
+        """
+        Buffer one event. `fields` are the model's attributes.
+        """
+        with self._lock:
+            # Concurrent uploads can log the same email at the same instant,
+            # and BatchWriteItem rejects duplicate keys:
+            key = (fields["email"], fields["date"])
+            while key in self._keys:
+                fields["date"] += "0"
+                key = (fields["email"], fields["date"])
+            self._keys.add(key)
+            self._buffer.append(fields)
+            if len(self._buffer) < self.buffer_size:
+                return
+            batch = self._take()
+            self._pending.append(self._writer.submit(self.write, batch))
+
+    def flush(self) -> None:
+        """
+        Write anything still buffered and wait for background writes.
+        """
+        with self._lock:
+            batch = self._take()
+            self._keys = set()
+            pending, self._pending = self._pending, []
+        if batch:
+            self.write(batch)
+        for future in pending:
+            future.result()
+
+    def write(self, batch: List[dict]) -> None:
+        self._write_events(batch)
+        if self.rollup is not None:
+            try:
+                self.rollup(batch)
+            except Exception as e:
+                print(f"Encountered exception while updating rollups: {e}")
+
+    def _write_events(self, batch: List[dict]) -> None:
+        try:
+            items = [self.model(**fields).serialize() for fields in batch]
+            connection = self.model._get_connection()
+            for attempt in range(self.max_retries + 1):
+                data = connection.batch_write_item(put_items=items) or {}
+                unprocessed = data.get("UnprocessedItems", {}).get(
+                    self.model.Meta.table_name
+                )
+                if not unprocessed:
+                    return
+                items = [item["PutRequest"]["Item"] for item in unprocessed]
+                if attempt < self.max_retries:
+                    time.sleep(random.uniform(0, self.base_backoff * 2 ** attempt))
+            print(f"Dropped {len(items)} analytics events after {self.max_retries} retries.")
+        except Exception as e:
+            print(f"Encountered exception while logging: {e}")
+
+    def _take(self) -> List[dict]:
+        batch, self._buffer = self._buffer, []
+        return batch
@@ -1,7 +1,29 @@
 from pynamodb.models import Model
-from pynamodb.attributes import UnicodeAttribute, NumberAttribute, BooleanAttribute
+from pynamodb.attributes import (
+    UnicodeAttribute,
+    NumberAttribute,
+    BooleanAttribute,
+    MapAttribute,
+)
 from pynamodb.constants import PAY_PER_REQUEST_BILLING_MODE
+from pynamodb.indexes import AllProjection, GlobalSecondaryIndex
 from config import Config
+import clients
+
+
+class DayIndex(GlobalSecondaryIndex):
+    """
+    Every event on a given day, in time order, so that reports over a time
+    range query one partition per day instead of scanning the whole table.
+    """
+
+    class Meta:
+        index_name = "day-index"
+        projection = AllProjection()
+
+    day = UnicodeAttribute(hash_key=True)
+    date = UnicodeAttribute(range_key=True)
+
 
 class SendToRemarkableRequestModel(Model):
     """
@@ -12,9 +34,17 @@ class SendToRemarkableRequestModel(Model):
         table_name = "remailable-send-requests"
         region = Config.AWS_REGION
         billing_mode = PAY_PER_REQUEST_BILLING_MODE
+        host = clients.dynamodb_host()
+        max_pool_connections = clients.pool_size()
 
     email = UnicodeAttribute(hash_key=True)
     date = UnicodeAttribute(range_key=True)
     upload_size = NumberAttribute(default=0)  # in bytes
     success = BooleanAttribute()
     traceback = UnicodeAttribute()
+    attachment_count = NumberAttribute(null=True)  # files in the same message
+    stage_durations = MapAttribute(null=True)  # stage name -> milliseconds
+    bytes_saved = NumberAttribute(null=True)  # by slimming the PDF before upload
+    day = UnicodeAttribute(null=True)  # like "2021-03-23"; the key of day_index
+
+    day_index = DayIndex()
@@ -0,0 +1,24 @@
+from pynamodb.models import Model
+from pynamodb.attributes import UnicodeAttribute, NumberAttribute
+from pynamodb.constants import PAY_PER_REQUEST_BILLING_MODE
+from config import Config
+import clients
+
+class UsageRollupModel(Model):
+    """
+    Running totals of document events per hour and per day, so that usage
+    questions don't have to scan remailable-send-requests.
+    """
+
+    class Meta:
+        table_name = "remailable-usage-rollups"
+        region = Config.AWS_REGION
+        billing_mode = PAY_PER_REQUEST_BILLING_MODE
+        host = clients.dynamodb_host()
+        max_pool_connections = clients.pool_size()
+
+    granularity = UnicodeAttribute(hash_key=True)  # "hour" or "day"
+    bucket = UnicodeAttribute(range_key=True)  # like "2021-03-23T14" or "2021-03-23"
+    requests = NumberAttribute(default=0)
+    successes = NumberAttribute(default=0)
+    upload_bytes = NumberAttribute(default=0)
@@ -0,0 +1,124 @@
+"""
+Read document events back out of remailable-send-requests for reports.
+
+A report over a time range queries the table's day index, one day at a
+time. Anything else is a parallel scan: the table is split into segments
+that worker threads scan at once. Either way, events are yielded as they
+arrive, so a report never holds more than a page or so in memory.
+"""
+import datetime
+import json
+import queue
+import threading
+from typing import Iterable, Iterator, Optional
+
+from analytics.SendToRemarkableRequestModel import SendToRemarkableRequestModel
+
+_DONE = object()
+
+
+def days_between(start: datetime.datetime, end: datetime.datetime) -> Iterator[str]:
+    """
+    The day-index buckets ("2021-03-23") from `start` to `end`, inclusive.
+    """
+    day = start.date()
+    while day <= end.date():
+        yield day.isoformat()
+        day += datetime.timedelta(days=1)
+
+
+def query_range(
+    start: datetime.datetime,
+    end: datetime.datetime,
+    filter_condition=None,
+    model=SendToRemarkableRequestModel,
+) -> Iterator:
+    """
+    Every event between `start` and `end`, oldest first, from the day index.
+    Events logged before the index existed have no day and aren't found.
+    """
+    for day in days_between(start, end):
+        yield from model.day_index.query(
+            day,
+            range_key_condition=model.date.between(start.isoformat(), end.isoformat()),
+            filter_condition=filter_condition,
+        )
+
+
+def parallel_scan(
+    filter_condition=None,
+    segments: int = 4,
+    model=SendToRemarkableRequestModel,
+    buffer_size: int = 1000,
+) -> Iterator:
+    """
+    Every event matching `filter_condition`, in no particular order, from
+    `segments` concurrent scans.
+
+    Scanners block once `buffer_size` events are waiting to be consumed.
+    The first error from any scanner is raised here.
+    """
+    results = queue.Queue(maxsize=buffer_size)
+    stop = threading.Event()
+
+    def scan(segment: int) -> None:
+        try:
+            for item in model.scan(
+                filter_condition, segment=segment, total_segments=segments
+            ):
+                if stop.is_set():
+                    return
+                results.put(item)
+        except Exception as e:
+            results.put(e)
+        finally:
+            results.put(_DONE)
+
+    workers = [
+        threading.Thread(target=scan, args=(segment,), daemon=True)
+        for segment in range(segments)
+    ]
+    for worker in workers:
+        worker.start()
+    try:
+        running = segments
+        while running:
+            item = results.get()
+            if item is _DONE:
+                running -= 1
+            elif isinstance(item, Exception):
+                raise item
+            else:
+                yield item
+    finally:
+        # If the consumer stopped early, let the scanners finish:
+        stop.set()
+        while any(worker.is_alive() for worker in workers):
+            try:
+                results.get(timeout=0.1)
+            except queue.Empty:
+                pass
+
+
+def write_ndjson(items: Iterable, out) -> int:
+    """
+    Write each event to `out` as a line of JSON. Returns how many there were.
+    """
+    count = 0
+    for item in items:
+        out.write(json.dumps(item.to_simple_dict(), sort_keys=True, default=str))
+        out.write("\n")
+        count += 1
+    return count
+
+
+def parse_time(value: str, now: Optional[datetime.datetime] = None) -> datetime.datetime:
+    """
+    "24h", "7d" and "30m" are that long before `now`; anything else is an
+    ISO date or timestamp.
+    """
+    now = now or datetime.datetime.now()
+    units = {"m": "minutes", "h": "hours", "d": "days"}
+    if value[-1:] in units and value[:-1].isdigit():
+        return now - datetime.timedelta(**{units[value[-1]]: int(value[:-1])})
+    return datetime.datetime.fromisoformat(value)
@@ -0,0 +1,65 @@
+import datetime
+from typing import Dict, Iterable, List, Tuple
+
+from analytics.UsageRollupModel import UsageRollupModel
+
+# How many characters of an ISO timestamp make up each bucket:
+GRANULARITIES = {"hour": 13, "day": 10}
+
+
+def bucket_for(date: str, granularity: str) -> str:
+    """
+    The rollup bucket an ISO timestamp like "2021-03-23T14:05:00" falls in.
+    """
+    return date[: GRANULARITIES[granularity]]
+
+
+def record_rollups(events: Iterable[dict], model=UsageRollupModel) -> None:
+    """
+    Add a batch of SendToRemarkableRequestModel events to the hourly and
+    daily rollups.
+
+    Events are totalled locally first, so each bucket costs one atomic ADD
+    update per batch regardless of how many events landed in it.
+    """
+    totals: Dict[Tuple[str, str], List[int]] = {}
+    for event in events:
+        for granularity in GRANULARITIES:
+            key = (granularity, bucket_for(event["date"], granularity))
+            total = totals.setdefault(key, [0, 0, 0])
+            total[0] += 1
+            total[1] += 1 if event.get("success") else 0
+            total[2] += max(0, event.get("upload_size") or 0)
+
+    for (granularity, bucket), (requests, successes, upload_bytes) in totals.items():
+        model(granularity, bucket).update(
+            actions=[
+                model.requests.add(requests),
+                model.successes.add(successes),
+                model.upload_bytes.add(upload_bytes),
+            ]
+        )
+
+
+def get_usage(
+    granularity: str,
+    start: datetime.datetime,
+    end: datetime.datetime,
+    model=UsageRollupModel,
+) -> List[dict]:
+    """
+    Read the rollups between `start` and `end` (inclusive) with one query,
+    oldest first. Buckets with no events are omitted.
+    """
+    first = bucket_for(start.isoformat(), granularity)
+    last = bucket_for(end.isoformat(), granularity)
+    return [
+        {
+            "bucket": row.bucket,
+            "requests": int(row.requests),
+            "successes": int(row.successes),
+            "failures": int(row.requests - row.successes),
+            "upload_bytes": int(row.upload_bytes),
+        }
+        for row in model.query(granularity, model.bucket.between(first, last))
+    ]
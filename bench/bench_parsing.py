@@ -0,0 +1,197 @@
+"""
+Micro-benchmarks for the parsing and dispatch hot path.
+
+Usage:
+
+    python bench/bench_parsing.py [--repeat 3] [--quick] [--scenario NAME ...]
+        [--compare previous.json] > bench_output.txt
+
+Builds synthetic emails with PDF, EPUB and inline parts, then times and
+memory-profiles (tracemalloc peak) each stage against in-process fakes:
+
+    - load: streaming an .eml out of (fake) S3 into the MIME parser
+    - extract: extract_files_from_email
+    - handle: handle_message_result, including zip packaging
+
+Results are printed as JSON. With --compare, each stage also gets the ratio
+against the same stage in an earlier result file.
+"""
+import argparse
+import contextlib
+import gc
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+import tracemalloc
+from email.mime.application import MIMEApplication
+from email.mime.image import MIMEImage
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+import lambda_main  # noqa: E402
+from fakes import FakeS3, fake_backends  # noqa: E402
+
+KB = 1024
+MB = 1024 * KB
+
+# name: (attachment count, attachment size)
+SCENARIOS = {
+    "one-small": (1, 100 * KB),
+    "one-large": (1, 30 * MB),
+    "many-small": (50, 100 * KB),
+    "ten-medium": (10, 1 * MB),
+    "three-large": (3, 10 * MB),
+}
+QUICK_SCALE = 10
+
+
+def fake_document(kind: str, size: int, rng: random.Random) -> bytes:
+    header = b"%PDF-1.4\n" if kind == "pdf" else b"PK\x03\x04mimetypeapplication/epub+zip"
+    return header + rng.randbytes(max(0, size - len(header)))
+
+
+def build_email(count: int, size: int, seed: int = 0) -> bytes:
+    """
+    A multipart email with `count` attachments of `size` bytes, alternating
+    PDF and EPUB, plus a text body, an HTML body and an inline image.
+    """
+    rng = random.Random(seed)
+    message = MIMEMultipart("mixed")
+    message["From"] = "Bench Mark <bench@example.com>"
+    message["To"] = "remailable@example.com"
+    message["Subject"] = "Benchmark documents"
+    message.attach(MIMEText("Here are some documents.", "plain"))
+    message.attach(MIMEText("<p>Here are some <b>documents</b>.</p>", "html"))
+    inline = MIMEImage(b"\x89PNG\r\n\x1a\n" + rng.randbytes(4 * KB), "png")
+    inline.add_header("Content-Disposition", "inline", filename="logo.png")
+    message.attach(inline)
+    for i in range(count):
+        if i % 2:
+            part = MIMEApplication(
+                fake_document("epub", size, rng), "epub+zip", name=f"book_{i}.epub"
+            )
+            part.add_header("Content-Disposition", "attachment", filename=f"book_{i}.epub")
+        else:
+            part = MIMEApplication(
+                fake_document("pdf", size, rng), "pdf", name=f"paper_{i}.pdf"
+            )
+            part.add_header("Content-Disposition", "attachment", filename=f"paper_{i}.pdf")
+        message.attach(part)
+    return message.as_bytes()
+
+
+def measure(fn, repeat: int) -> dict:
+    """
+    Best-of-`repeat` wall time, then one more run under tracemalloc for the
+    peak allocation.
+    """
+    times = []
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    gc.collect()
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        "best_ms": round(min(times) * 1000, 3),
+        "mean_ms": round(sum(times) / len(times) * 1000, 3),
+        "peak_mb": round(peak / MB, 3),
+    }
+
+
+def run_scenario(name: str, count: int, size: int, repeat: int) -> dict:
+    raw = build_email(count, size)
+    s3 = FakeS3({name: raw})
+    with fake_backends(s3=s3):
+        # BUCKET_PREFIX may be set in the local config:
+        key = f"{lambda_main.Config.BUCKET_PREFIX}/{name}" if hasattr(
+            lambda_main.Config, "BUCKET_PREFIX"
+        ) else name
+        s3.objects[key] = raw
+
+        message = lambda_main.load_email_from_s3(name)
+        result = lambda_main.extract_files_from_email(message)
+        assert len(result["extracted_files"]) == count, result["status"]
+
+        stages = {
+            "load": measure(lambda: lambda_main.load_email_from_s3(name), repeat),
+            "extract": measure(
+                lambda: lambda_main.extract_files_from_email(message), repeat
+            ),
+            "handle": measure(lambda: lambda_main.handle_message_result(result), repeat),
+        }
+        # Receipts go out in the background; wait for them here, while
+        # their log lines still go to stderr and SES is still faked:
+        lambda_main.flush_notifications()
+    return {
+        "attachments": count,
+        "attachment_bytes": size,
+        "email_bytes": len(raw),
+        "stages": stages,
+    }
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=REPO_ROOT,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except Exception:
+        return "unknown"
+
+
+def compare(results: dict, previous: dict) -> None:
+    for name, scenario in results["scenarios"].items():
+        before = previous.get("scenarios", {}).get(name)
+        if not before:
+            continue
+        for stage, numbers in scenario["stages"].items():
+            old = before["stages"].get(stage)
+            if old:
+                numbers["vs_previous"] = {
+                    "best_ms": numbers["best_ms"] / old["best_ms"],
+                    "peak_mb": numbers["peak_mb"] / old["peak_mb"] if old["peak_mb"] else None,
+                }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument(
+        "--quick", action="store_true", help=f"Shrink attachments {QUICK_SCALE}x."
+    )
+    parser.add_argument("--scenario", action="append", choices=sorted(SCENARIOS))
+    parser.add_argument("--compare", help="An earlier JSON result to compare against.")
+    args = parser.parse_args()
+
+    results = {"revision": git_revision(), "python": sys.version.split()[0], "scenarios": {}}
+    # Keep plog chatter out of the JSON on stdout:
+    with contextlib.redirect_stdout(sys.stderr):
+        for name in args.scenario or SCENARIOS:
+            count, size = SCENARIOS[name]
+            if args.quick:
+                size //= QUICK_SCALE
+            results["scenarios"][name] = run_scenario(name, count, size, args.repeat)
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,306 @@
+"""
+In-process stand-ins for the external services lambda_main talks to, for
+benchmarks and local runs.
+"""
+import contextlib
+import io
+import os
+import random
+import threading
+import time
+from typing import Dict, Iterable
+from unittest import mock
+
+from botocore.response import StreamingBody
+
+import breaker
+import clients
+import lambda_main
+from folders import FOLDER_CACHE
+
+
+class FakeS3:
+    """
+    Just enough of an S3 client for loading emails: objects live in a dict
+    keyed by object key, and ranged GETs are supported.
+    """
+
+    def __init__(self, objects: Dict[str, bytes] = None):
+        self.objects = objects if objects is not None else {}
+
+    def get_object(self, Bucket: str, Key: str, Range: str = None):
+        data = self.objects[Key]
+        if Range:
+            first, last = Range[len("bytes=") :].split("-")
+            data = data[int(first) : int(last) + 1]
+        return {"Body": StreamingBody(io.BytesIO(data), len(data))}
+
+
+class FilesystemS3:
+    """
+    An S3 client backed by files on disk. `add` maps an object key to a
+    file; GETs (ranged or not) stream straight from that file.
+    """
+
+    def __init__(self):
+        self.files = {}
+
+    def add(self, key: str, filename: str) -> None:
+        self.files[key] = filename
+
+    def get_object(self, Bucket: str, Key: str, Range: str = None):
+        filename = self.files[Key]
+        size = os.path.getsize(filename)
+        if not Range:
+            return {"Body": StreamingBody(open(filename, "rb"), size), "ContentLength": size}
+        first, last = Range[len("bytes=") :].split("-")
+        first, last = int(first), min(int(last), size - 1)
+        length = last - first + 1
+        with open(filename, "rb") as f:
+            f.seek(first)
+            data = f.read(length)
+        return {
+            "Body": StreamingBody(io.BytesIO(data), length),
+            "ContentLength": length,
+            "ContentRange": f"bytes {first}-{last}/{size}",
+        }
+
+
+class FakeSES:
+    """
+    Records the emails it's asked to send.
+    """
+
+    def __init__(self):
+        self.sent = []
+        self._lock = threading.Lock()
+
+    def send_email(self, **kwargs):
+        with self._lock:
+            self.sent.append(kwargs)
+        return {"MessageId": str(len(self.sent))}
+
+
+class _Response:
+    def __init__(self, status_code: int):
+        self.status_code = status_code
+        self.ok = status_code < 400
+
+
+
+
+class FakeRemarkable:
+    """
+    A stand-in for rmapy's Client. Uploads still build the zip archive, so
+    packaging cost is measured, but nothing leaves the process.
+
+    `latency` seconds are slept per call, and `error_rate` of uploads fail
+    with a 503, which is retried.
+    """
+
+    def __init__(self, latency: float = 0.0, error_rate: float = 0.0, seed: int = None):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.uploads = []
+        self.folders = []
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def fail_sometimes(self) -> None:
+        time.sleep(self.latency)
+        with self._lock:
+            fail = self._random.random() < self.error_rate
+        if fail:
+            from rmapy.exceptions import ApiError
+
+            raise ApiError("Fake reMarkable upload failed", response=_Response(503))
+
+    def record(self, name: str, size: int) -> None:
+        with self._lock:
+            self.uploads.append((name, size))
+
+    def client(self, config_dict: dict = None):
+        fake = self
+
+        class Client:
+            def __init__(self, config_dict: dict = None):
+                self.config = config_dict
+
+            def register_device(self, code: str, save_to_file: bool = True) -> bool:
+                time.sleep(fake.latency)
+                self.config = {"devicetoken": f"device-{code}", "usertoken": ""}
+                return True
+
+            def renew_token(self, save_to_file: bool = True) -> dict:
+                time.sleep(fake.latency)
+                return dict(self.config or {}, usertoken="user")
+
+            def upload(self, zip_doc, to=None):
+                fake.fail_sometimes()
+                zip_doc.dump(zip_doc.zipfile)
+                fake.record(zip_doc.metadata["VissibleName"], len(zip_doc.zipfile.getvalue()))
+                return True
+
+            # The calls streaming.stream_upload makes:
+            def _upload_request(self, zip_doc):
+                return f"https://fake-blob/{zip_doc.ID}"
+
+            def request(self, method, url, data=None, **kwargs):
+                fake.fail_sometimes()
+                self._uploaded = sum(len(chunk) for chunk in data)
+                return _Response(200)
+
+            def update_metadata(self, doc):
+                fake.record(doc.VissibleName, self._uploaded)
+                return True
+
+            # The calls folders.FolderCache makes:
+            def get_meta_items(self):
+                time.sleep(fake.latency)
+                with fake._lock:
+                    return list(fake.folders)
+
+            def create_folder(self, folder):
+                time.sleep(fake.latency)
+                with fake._lock:
+                    fake.folders.append(folder)
+                return True
+
+        return Client(config_dict)
+
+
+class MemoryTables:
+    """
+    In-memory stand-ins for the DynamoDB tables: users, send requests and
+    dedup claims. Its methods replace the matching lambda_main functions.
+
+    With `register_everyone`, any sender is treated as a registered user.
+    With `deduplicate` off, nothing is ever treated as a duplicate.
+    """
+
+    def __init__(self, register_everyone: bool = True, deduplicate: bool = True):
+        self.register_everyone = register_everyone
+        self.deduplicate = deduplicate
+        self.users = {}
+        self.requests = []
+        self.claims = {}
+        self.checkpoints = set()
+        self.user_lookups = 0
+        self._lock = threading.Lock()
+
+    def get_valid_config_for_user(self, user_email: str) -> dict:
+        from users import sanitize_email
+
+        user_email = sanitize_email(user_email)
+        with self._lock:
+            self.user_lookups += 1
+            if user_email not in self.users:
+                if not self.register_everyone:
+                    raise KeyError(f"Failed key lookup for {user_email}.")
+                self.users[user_email] = {"devicetoken": "device", "usertoken": "user"}
+            return self.users[user_email]
+
+    def resolve_users(self, user_emails: Iterable[str]) -> Dict[str, dict]:
+        return {e: self.get_valid_config_for_user(e) for e in user_emails}
+
+    def set_config_for_user(self, user_email: str, new_cfg: dict) -> bool:
+        from users import sanitize_email
+
+        with self._lock:
+            self.users[sanitize_email(user_email)] = new_cfg
+        return True
+
+    def delete_user(self, user_email: str) -> bool:
+        from users import sanitize_email
+
+        with self._lock:
+            self.users.pop(sanitize_email(user_email), None)
+        return True
+
+    def log_send_request(self, user_email, upload_size, success, traceback, **kwargs):
+        with self._lock:
+            self.requests.append(
+                dict(kwargs, user_email=user_email, upload_size=upload_size, success=success)
+            )
+
+    def claim(self, key: str):
+        ttl = getattr(lambda_main.Config, "DEDUP_LEASE_SECONDS", 60)
+        now = time.time()
+        with self._lock:
+            if self.claims.get(key, 0) > now:
+                return None
+            self.claims[key] = now + ttl
+        return key
+
+    def finish(self, key: str) -> None:
+        ttl = getattr(lambda_main.Config, "DEDUP_TTL_SECONDS", 24 * 60 * 60)
+        with self._lock:
+            self.claims[key] = time.time() + ttl
+
+    def release(self, key: str) -> None:
+        with self._lock:
+            self.claims.pop(key, None)
+
+    def delivered_already(self, message_key: str, files) -> list:
+        with self._lock:
+            return [(message_key, fbytes) in self.checkpoints for _, fbytes in files]
+
+    def checkpoint_delivery(self, message_key: str, fbytes: bytes) -> None:
+        with self._lock:
+            self.checkpoints.add((message_key, fbytes))
+
+
+@contextlib.contextmanager
+def fake_backends(
+    s3: FakeS3 = None,
+    ses: FakeSES = None,
+    remarkable: FakeRemarkable = None,
+    tables: MemoryTables = None,
+):
+    """
+    Point lambda_main at fakes for S3, SES, the reMarkable cloud, user
+    lookups and analytics for the duration of the block.
+
+    Deduplication is off unless `tables` is given, in which case it and
+    the user table are kept in `tables`.
+    """
+    import rmapy.api
+
+    s3 = s3 or FakeS3()
+    ses = ses or FakeSES()
+    remarkable = remarkable or FakeRemarkable()
+    clients.use("s3", s3)
+    clients.use("ses", ses)
+    breaker.REMARKABLE.reset()
+    FOLDER_CACHE.clear()
+    if tables is None:
+        patches = {
+            "get_valid_config_for_user": lambda user_email: {
+                "devicetoken": "device",
+                "usertoken": "user",
+            },
+            "log_send_request": lambda *a, **kw: None,
+            "deduplicating": lambda: False,
+        }
+    else:
+        patches = {
+            "get_valid_config_for_user": tables.get_valid_config_for_user,
+            "resolve_users": tables.resolve_users,
+            "set_config_for_user": tables.set_config_for_user,
+            "delete_user": tables.delete_user,
+            "log_send_request": tables.log_send_request,
+            "deduplicating": lambda: tables.deduplicate,
+            "_claim": tables.claim,
+            "finish_claim": lambda key: key and tables.finish(key),
+            "release_claim": lambda key: key and tables.release(key),
+            "delivered_already": tables.delivered_already,
+            "checkpoint_delivery": tables.checkpoint_delivery,
+        }
+    try:
+        with contextlib.ExitStack() as stack:
+            stack.enter_context(mock.patch.object(rmapy.api, "Client", remarkable.client))
+            for name, replacement in patches.items():
+                stack.enter_context(mock.patch.object(lambda_main, name, replacement))
+            yield s3, ses, remarkable
+    finally:
+        clients.reset()
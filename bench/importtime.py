@@ -0,0 +1,99 @@
+"""
+Report what importing an entry point costs, `python -X importtime` style.
+
+Usage:
+
+    python bench/importtime.py [--module ingest] [--top 20]
+        [--budget-ms 300] [--forbid flask,rmapy,pynamodb]
+
+Prints a JSON report of the total import time and the most expensive
+top-level packages. Exits non-zero if the total is over `--budget-ms`, or if
+any of the `--forbid` packages were imported, so CI can check against it.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+from typing import Dict, List
+
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def measure(module: str) -> List[Dict]:
+    """
+    Import `module` in a fresh interpreter and return one entry per module
+    it imported (including itself, last): {"module", "self_us",
+    "cumulative_us", "depth"}. Interpreter startup (site etc) is excluded.
+    """
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=REPO_ROOT,
+        capture_output=True,
+        text=True,
+    )
+    if proc.returncode != 0:
+        raise RuntimeError(f"Importing {module} failed:\n{proc.stderr}")
+
+    entries: List[Dict] = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:") :].split("|")
+        entries.append(
+            {
+                "module": name.strip(),
+                "self_us": int(self_us),
+                "cumulative_us": int(cumulative_us),
+                "depth": (len(name) - len(name.lstrip()) - 1) // 2,
+            }
+        )
+        if entries[-1]["depth"] == 0:
+            if entries[-1]["module"] == module:
+                return entries
+            # A top-level import from interpreter startup; not ours.
+            entries = []
+    raise RuntimeError(f"Couldn't find {module} in the -X importtime output.")
+
+
+def report(module: str, top: int = 20) -> Dict:
+    entries = measure(module)
+    packages: Dict[str, int] = {}
+    for entry in entries:
+        package = entry["module"].split(".")[0]
+        packages[package] = packages.get(package, 0) + entry["self_us"]
+    return {
+        "module": module,
+        "total_ms": sum(e["self_us"] for e in entries) / 1000,
+        "module_count": len(entries),
+        "packages": sorted(packages),
+        "top_packages_ms": {
+            package: us / 1000
+            for package, us in sorted(
+                packages.items(), key=lambda item: item[1], reverse=True
+            )[:top]
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--module", default="ingest")
+    parser.add_argument("--top", type=int, default=20)
+    parser.add_argument("--budget-ms", type=float, default=None)
+    parser.add_argument("--forbid", default="flask,rmapy,pynamodb")
+    args = parser.parse_args()
+
+    result = report(args.module, args.top)
+    forbidden = [p for p in args.forbid.split(",") if p and p in result["packages"]]
+    over_budget = args.budget_ms is not None and result["total_ms"] > args.budget_ms
+    result["forbidden_imports"] = forbidden
+    result["over_budget"] = over_budget
+    print(json.dumps(result, indent=2))
+    if forbidden or over_budget:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+"""
+Replay a directory of .eml files through the whole pipeline, end to end,
+against local stand-ins for every backend.
+
+Usage:
+
+    python bench/replay.py [DIRECTORY] [--concurrency 8] [--repeat 10]
+        [--latency 0.05] [--error-rate 0.01] [--seed 0] [--dedup] > replay.json
+
+Every .eml in DIRECTORY (default test_data/) is stored in a filesystem-backed
+fake S3, `--repeat` times under distinct keys, and each copy is fed through
+`transfer_s3_path_to_remarkable` on a pool of `--concurrency` threads. Users,
+send requests and dedup claims live in memory, receipts go to a recording
+SES, and the fake reMarkable cloud sleeps `--latency` seconds per call and
+fails `--error-rate` of uploads. Deduplication is off unless `--dedup` is
+given, since every repeat would otherwise be skipped as a duplicate.
+
+Prints JSON with messages/sec, p50/p95/p99 latency per message and the
+process's peak RSS.
+"""
+import argparse
+import contextlib
+import glob
+import json
+import os
+import resource
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+import lambda_main  # noqa: E402
+from fakes import (  # noqa: E402
+    FakeRemarkable,
+    FakeSES,
+    FilesystemS3,
+    MemoryTables,
+    fake_backends,
+)
+
+
+def percentile(values: list, pct: float) -> float:
+    """
+    Nearest-rank percentile of `values`, which must be sorted.
+    """
+    if not values:
+        return 0.0
+    rank = max(1, int(round(pct / 100 * len(values) + 0.5)))
+    return values[min(rank, len(values)) - 1]
+
+
+def peak_rss_mb() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes:
+    return peak / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+
+def replay(
+    directory: str,
+    concurrency: int = 8,
+    repeat: int = 1,
+    latency: float = 0.0,
+    error_rate: float = 0.0,
+    seed: int = None,
+    dedup: bool = False,
+) -> dict:
+    emails = sorted(glob.glob(os.path.join(directory, "*.eml")))
+    if not emails:
+        raise SystemExit(f"No .eml files in {directory}")
+
+    s3 = FilesystemS3()
+    ses = FakeSES()
+    remarkable = FakeRemarkable(latency=latency, error_rate=error_rate, seed=seed)
+    tables = MemoryTables(deduplicate=dedup)
+    paths = []
+    for i in range(repeat):
+        for filename in emails:
+            path = f"replay-{i}-{os.path.basename(filename)}"
+            s3.add(lambda_main.s3_key(path), filename)
+            paths.append(path)
+
+    def run(path):
+        start = time.perf_counter()
+        try:
+            outcomes = lambda_main.transfer_s3_path_to_remarkable(path) or []
+            ok = all(o["success"] for o in outcomes)
+        except Exception:
+            ok = False
+        return time.perf_counter() - start, ok
+
+    with fake_backends(s3=s3, ses=ses, remarkable=remarkable, tables=tables), mock.patch.object(
+        lambda_main.Config, "SEND_EMAILS", True
+    ), mock.patch.object(
+        lambda_main.Config, "EMAIL_SENDER", "Remailable <replay@example.com>", create=True
+    ):
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            results = list(pool.map(run, paths))
+        lambda_main.flush_notifications()
+        elapsed = time.perf_counter() - start
+
+    latencies = sorted(seconds * 1000 for seconds, _ in results)
+    return {
+        "messages": len(paths),
+        "concurrency": concurrency,
+        "seconds": round(elapsed, 3),
+        "messages_per_sec": round(len(paths) / elapsed, 2),
+        "latency_ms": {
+            "p50": round(percentile(latencies, 50), 3),
+            "p95": round(percentile(latencies, 95), 3),
+            "p99": round(percentile(latencies, 99), 3),
+            "max": round(latencies[-1], 3),
+        },
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+        "failed_messages": sum(1 for _, ok in results if not ok),
+        "uploads": len(remarkable.uploads),
+        "emails_sent": len(ses.sent),
+        "send_requests_logged": len(tables.requests),
+        "user_lookups": tables.user_lookups,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "directory", nargs="?", default=os.path.join(REPO_ROOT, "test_data")
+    )
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument(
+        "--repeat", type=int, default=1, help="Replay every email this many times."
+    )
+    parser.add_argument(
+        "--latency", type=float, default=0.0, help="Seconds per reMarkable call."
+    )
+    parser.add_argument(
+        "--error-rate", type=float, default=0.0, help="Fraction of uploads that fail."
+    )
+    parser.add_argument("--seed", type=int)
+    parser.add_argument(
+        "--dedup",
+        action="store_true",
+        help="Deduplicate documents, so repeats after the first are skipped.",
+    )
+    args = parser.parse_args()
+
+    # Keep plog chatter out of the JSON on stdout:
+    with contextlib.redirect_stdout(sys.stderr):
+        results = replay(
+            args.directory,
+            concurrency=args.concurrency,
+            repeat=args.repeat,
+            latency=args.latency,
+            error_rate=args.error_rate,
+            seed=args.seed,
+            dedup=args.dedup,
+        )
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,167 @@
+"""
+Retries with jittered exponential backoff, and a circuit breaker, for calls
+to the reMarkable cloud.
+
+When enough calls in a row fail with errors that look like the service
+being degraded (timeouts, connection errors, 429s and 5xxs), the breaker
+opens and every call fails fast with CircuitOpenError until the cooldown
+is over. Then a single trial call is let through; if it works, the breaker
+closes again.
+
+The breaker lives at module scope, so it's shared by every thread and
+survives across warm lambda invocations in the same container.
+"""
+import random
+import re
+import threading
+import time
+from typing import Callable
+
+from config import Config
+
+
+class CircuitOpenError(Exception):
+    """
+    The reMarkable cloud looks degraded, so we didn't try.
+    """
+
+
+class CircuitBreaker:
+    def __init__(self, name: str, failure_threshold: int = 5, cooldown: float = 60.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self._failures = 0
+        self._opened_at = None
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._opened_at is None:
+                return "closed"
+            if time.monotonic() - self._opened_at < self.cooldown:
+                return "open"
+            return "half-open"
+
+    def is_open(self) -> bool:
+        return self.state == "open"
+
+    def before_call(self) -> None:
+        """
+        Raise CircuitOpenError unless a call may go ahead right now.
+        """
+        with self._lock:
+            if self._opened_at is None:
+                return
+            if time.monotonic() - self._opened_at >= self.cooldown and not self._trial_in_flight:
+                self._trial_in_flight = True
+                return
+        raise CircuitOpenError(f"The {self.name} circuit is open; not trying for now.")
+
+    def record_success(self) -> None:
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial_in_flight = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+            if self._trial_in_flight or self._failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+            self._trial_in_flight = False
+
+    def record_other_error(self) -> None:
+        """
+        The call failed for a reason that says nothing about the service's
+        health: don't count it either way, but let another trial through.
+        """
+        with self._lock:
+            self._trial_in_flight = False
+
+    def reset(self) -> None:
+        self.record_success()
+
+
+# rmapy's renew_token raises AuthError("Can't renew token: 503"), without
+# the response:
+_RENEWAL_STATUS = re.compile(r"renew token: (\d{3})\b")
+
+
+def status_code(error: Exception):
+    """
+    The HTTP status an error from the reMarkable cloud came with, if any.
+    """
+    status = getattr(getattr(error, "response", None), "status_code", None)
+    if status is None:
+        match = _RENEWAL_STATUS.search(str(error))
+        if match:
+            status = int(match.group(1))
+    return status
+
+
+def is_retryable(error: Exception) -> bool:
+    """
+    True for errors that are worth trying again: timeouts, dropped
+    connections, and 429 or 5xx responses.
+    """
+    import requests
+
+    if isinstance(error, (requests.ConnectionError, requests.Timeout)):
+        return True
+    status = status_code(error)
+    return status == 429 or (status is not None and status >= 500)
+
+
+def call(
+    fn: Callable,
+    *args,
+    breaker: CircuitBreaker,
+    attempts: int = 3,
+    base_delay: float = 0.5,
+    **kwargs,
+):
+    """
+    Call `fn(*args, **kwargs)` through `breaker`, retrying retryable errors
+    up to `attempts` times in all, with full-jitter exponential backoff.
+    Other errors are raised straight away and don't count against the
+    breaker.
+    """
+    for attempt in range(attempts):
+        breaker.before_call()
+        try:
+            result = fn(*args, **kwargs)
+        except Exception as e:
+            if not is_retryable(e):
+                breaker.record_other_error()
+                raise
+            breaker.record_failure()
+            if attempt == attempts - 1:
+                raise
+            time.sleep(random.uniform(0, base_delay * 2 ** attempt))
+        else:
+            breaker.record_success()
+            return result
+
+
+REMARKABLE = CircuitBreaker(
+    "reMarkable",
+    failure_threshold=getattr(Config, "BREAKER_FAILURES", 5),
+    cooldown=getattr(Config, "BREAKER_COOLDOWN", 60),
+)
+
+
+def remarkable_call(fn: Callable, *args, **kwargs):
+    """
+    Call the reMarkable cloud with the configured retries and breaker.
+    """
+    return call(
+        fn,
+        *args,
+        breaker=REMARKABLE,
+        attempts=getattr(Config, "REMARKABLE_ATTEMPTS", 3),
+        base_delay=getattr(Config, "REMARKABLE_BACKOFF", 0.5),
+        **kwargs,
+    )
@@ -0,0 +1,106 @@
+"""
+A registry of AWS clients, created lazily once per container.
+
+Lambda keeps module state alive between warm invocations, so holding on to
+clients here means we only pay for parsing botocore's service models and
+opening TLS connections on a cold start. Connection pools are sized to
+match the worker pools in lambda_main.
+
+Tests and benchmarks can swap in local stand-ins with `use()`,
+`set_factory()` and `point_models_at()`.
+"""
+import threading
+from typing import Callable, Dict
+
+from config import Config
+
+
+_clients: Dict[str, object] = {}
+_factories: Dict[str, Callable[[str], object]] = {}
+_lock = threading.Lock()
+
+
+def pool_size() -> int:
+    """
+    How many keep-alive connections each client should hold: enough for
+    every record worker to have all of its upload workers busy at once.
+    """
+    return max(
+        10,
+        getattr(Config, "RECORD_CONCURRENCY", 4)
+        * getattr(Config, "USER_UPLOAD_CONCURRENCY", 4),
+    )
+
+
+def _boto3_client(service: str):
+    import boto3
+    from botocore.config import Config as BotoConfig
+
+    return boto3.client(
+        service,
+        region_name=Config.AWS_REGION,
+        config=BotoConfig(max_pool_connections=pool_size(), tcp_keepalive=True),
+    )
+
+
+def get_client(service: str):
+    """
+    Get the shared client for an AWS service, creating it if needed.
+    """
+    with _lock:
+        if service not in _clients:
+            factory = _factories.get(service, _boto3_client)
+            _clients[service] = factory(service)
+        return _clients[service]
+
+
+def s3():
+    return get_client("s3")
+
+
+def ses():
+    return get_client("ses")
+
+
+def set_factory(service: str, factory: Callable[[str], object]) -> None:
+    """
+    Build future clients for `service` with `factory(service)` instead of
+    boto3, dropping any client that's already been created.
+    """
+    with _lock:
+        _factories[service] = factory
+        _clients.pop(service, None)
+
+
+def use(service: str, client) -> None:
+    """
+    Use `client` for `service` from now on.
+    """
+    set_factory(service, lambda _: client)
+
+
+def reset() -> None:
+    """
+    Forget every client and factory, going back to boto3 defaults.
+    """
+    with _lock:
+        _clients.clear()
+        _factories.clear()
+
+
+def dynamodb_host():
+    """
+    The DynamoDB endpoint for PynamoDB models (None means AWS), e.g. a
+    DynamoDB Local instance set in `Config.DYNAMODB_HOST`.
+    """
+    return getattr(Config, "DYNAMODB_HOST", None)
+
+
+def point_models_at(host, *models) -> None:
+    """
+    Point PynamoDB models at a different DynamoDB endpoint, discarding
+    their cached connections.
+    """
+    for model in models:
+        model.Meta.host = host
+        model._connection = None
@@ -0,0 +1,261 @@
+"""
+Render Markdown, HTML and plain text to PDF, so they can be sent to the
+tablet like any other document.
+
+Converters are looked up by kind ("markdown", "html" or "text") in
+`CONVERTERS`, and `register_converter` swaps one out. The defaults use the
+optional `markdown` and `weasyprint` packages when they're installed, and
+otherwise lay the text out in a plain monospaced PDF.
+
+Converters take a str and return PDF bytes. `run_converter` runs one in a
+child process of its own, so that one that hangs can be killed.
+"""
+import hashlib
+import html.parser
+import textwrap
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, Optional
+
+Converter = Callable[[str], bytes]
+
+# Bump this when the output of the default converters changes, so that
+# cached results from the old ones aren't used:
+CONVERTER_VERSION = "1"
+
+# Points. The tablet's screen is 3:4, so text fills it without margins.
+PAGE_WIDTH, PAGE_HEIGHT = 447, 596
+MARGIN = 36
+FONT_SIZE = 10
+LEADING = 12
+# Courier's glyphs are all 0.6em wide:
+COLUMNS = int((PAGE_WIDTH - 2 * MARGIN) / (FONT_SIZE * 0.6))
+ROWS = int((PAGE_HEIGHT - 2 * MARGIN) / LEADING)
+
+
+def _pdf_string(line: str) -> bytes:
+    data = line.encode("cp1252", "replace")
+    return b"(" + data.replace(b"\\", b"\\\\").replace(b"(", b"\\(").replace(b")", b"\\)") + b")"
+
+
+def text_to_pdf(text: str) -> bytes:
+    """
+    Lay `text` out in Courier, wrapping long lines, one tablet-sized page
+    after another.
+    """
+    lines = []
+    for paragraph in text.expandtabs(4).splitlines():
+        lines.extend(textwrap.wrap(paragraph, COLUMNS) or [""])
+    pages = [lines[i : i + ROWS] for i in range(0, len(lines), ROWS)] or [[]]
+
+    # Objects 1-3 are the catalog, page tree and font; then each page is
+    # followed by its content stream.
+    page_ids = [4 + 2 * i for i in range(len(pages))]
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        b"<< /Type /Pages /Kids [%s] /Count %d >>"
+        % (b" ".join(b"%d 0 R" % i for i in page_ids), len(pages)),
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Courier /Encoding /WinAnsiEncoding >>",
+    ]
+    for page_id, page in zip(page_ids, pages):
+        stream = b"BT /F1 %d Tf %d TL %d %d Td\n" % (
+            FONT_SIZE,
+            LEADING,
+            MARGIN,
+            PAGE_HEIGHT - MARGIN,
+        )
+        stream += b"".join(_pdf_string(line) + b" '\n" for line in page) + b"ET"
+        objects.append(
+            b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 %d %d] "
+            b"/Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>"
+            % (PAGE_WIDTH, PAGE_HEIGHT, page_id + 1)
+        )
+        objects.append(b"<< /Length %d >>\nstream\n%s\nendstream" % (len(stream), stream))
+
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(out))
+        out += b"%d 0 obj\n%s\nendobj\n" % (number, body)
+    xref = len(out)
+    out += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    out += b"".join(b"%010d 00000 n \n" % offset for offset in offsets)
+    out += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (
+        len(objects) + 1,
+        xref,
+    )
+    return bytes(out)
+
+
+class _TextExtractor(html.parser.HTMLParser):
+    BLOCKS = {"p", "div", "br", "li", "tr", "h1", "h2", "h3", "h4", "h5", "h6", "pre", "blockquote"}
+    SKIPPED = {"script", "style", "head", "title"}
+
+    def __init__(self):
+        super().__init__()
+        self.parts = []
+        self._skipping = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.SKIPPED:
+            self._skipping += 1
+        elif tag in self.BLOCKS:
+            self.parts.append("\n")
+
+    def handle_endtag(self, tag):
+        if tag in self.SKIPPED:
+            self._skipping = max(0, self._skipping - 1)
+        elif tag in self.BLOCKS:
+            self.parts.append("\n")
+
+    def handle_data(self, data):
+        if not self._skipping:
+            self.parts.append(data)
+
+
+def html_to_text(markup: str) -> str:
+    """
+    Roughly what a reader would see of an HTML document, as plain text.
+    """
+    extractor = _TextExtractor()
+    extractor.feed(markup)
+    extractor.close()
+    text = "".join(extractor.parts)
+    lines = [" ".join(line.split()) for line in text.splitlines()]
+    # Collapse the runs of blank lines that nested blocks leave behind:
+    return "\n".join(
+        line for i, line in enumerate(lines) if line or (i and lines[i - 1])
+    ).strip()
+
+
+def html_to_pdf(markup: str) -> bytes:
+    try:
+        from weasyprint import HTML
+    except ImportError:
+        return text_to_pdf(html_to_text(markup))
+    return HTML(string=markup).write_pdf()
+
+
+def markdown_to_pdf(source: str) -> bytes:
+    try:
+        import markdown
+    except ImportError:
+        return text_to_pdf(source)
+    return html_to_pdf(markdown.markdown(source))
+
+
+CONVERTERS: Dict[str, Converter] = {
+    "markdown": markdown_to_pdf,
+    "html": html_to_pdf,
+    "text": text_to_pdf,
+}
+
+
+def register_converter(kind: str, converter: Converter) -> None:
+    """
+    Use `converter` to render documents of `kind` from now on. It's run in
+    a child process, so it has to be picklable: a module-level function,
+    not a lambda or a closure.
+    """
+    CONVERTERS[kind] = converter
+
+
+def _run_and_send(converter: Converter, text: str, sender) -> None:
+    try:
+        sender.send((True, converter(text)))
+    except Exception as e:
+        sender.send((False, repr(e)))
+    finally:
+        sender.close()
+
+
+def run_converter(converter: Converter, text: str, timeout: float) -> bytes:
+    """
+    `converter(text)` in a child process, which is killed if it takes more
+    than `timeout` seconds (raising TimeoutError). Where child processes
+    can't be started, the converter runs here instead, without a limit.
+    """
+    import multiprocessing
+
+    # We're called from worker threads, and a forked child could inherit a
+    # lock that one of them holds, so start the child from a clean process:
+    methods = multiprocessing.get_all_start_methods()
+    context = multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+    receiver, sender = context.Pipe(duplex=False)
+    process = context.Process(
+        target=_run_and_send, args=(converter, text, sender), daemon=True
+    )
+    try:
+        process.start()
+    except OSError:
+        receiver.close()
+        sender.close()
+        return converter(text)
+    sender.close()
+    try:
+        if not receiver.poll(timeout):
+            raise TimeoutError(f"Conversion took more than {timeout} seconds.")
+        ok, result = receiver.recv()
+    except EOFError:
+        raise RuntimeError("The conversion process died.")
+    finally:
+        if process.is_alive():
+            process.kill()
+        process.join()
+        receiver.close()
+    if not ok:
+        raise RuntimeError(result)
+    return result
+
+
+def content_key(kind: str, text: str) -> str:
+    """
+    The cache key for converting `text` as `kind`.
+    """
+    converter = CONVERTERS[kind]
+    digest = hashlib.sha256(
+        f"{kind}:{converter.__module__}.{converter.__qualname__}:{CONVERTER_VERSION}:".encode()
+    )
+    digest.update(text.encode("utf-8", "surrogateescape"))
+    return digest.hexdigest()
+
+
+class ConversionCache:
+    """
+    A thread-safe LRU of converted PDFs, keyed by `content_key` and
+    bounded by their total size.
+    """
+
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            pdf = self._entries.get(key)
+            if pdf is not None:
+                self._entries.move_to_end(key)
+            return pdf
+
+    def put(self, key: str, pdf: bytes) -> None:
+        if len(pdf) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._size -= len(old)
+            self._entries[key] = pdf
+            self._size += len(pdf)
+            while self._size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= len(evicted)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+
+CONVERSION_CACHE = ConversionCache()
@@ -0,0 +1,131 @@
+import datetime
+import hashlib
+from typing import List, Set
+
+from pynamodb.models import Model
+from pynamodb.attributes import UnicodeAttribute, TTLAttribute
+from pynamodb.constants import PAY_PER_REQUEST_BILLING_MODE
+from pynamodb.exceptions import PutError
+
+from config import Config
+import clients
+
+
+CLAIMED = "claimed"
+DONE = "done"
+
+
+class DedupModel(Model):
+    """
+    A claim on a piece of work (an S3 object, or a document for a user),
+    so that duplicate deliveries of the same work are skipped.
+
+    A claim starts out CLAIMED, on a short lease, while the work is in
+    progress, and becomes DONE, for a day, once it's finished.
+    """
+
+    class Meta:
+        table_name = "remailable-dedup"
+        region = Config.AWS_REGION
+        billing_mode = PAY_PER_REQUEST_BILLING_MODE
+        host = clients.dynamodb_host()
+        max_pool_connections = clients.pool_size()
+
+    key = UnicodeAttribute(hash_key=True)
+    state = UnicodeAttribute(null=True)
+    # DynamoDB deletes expired claims on its own, but only eventually:
+    expires = TTLAttribute()
+
+
+def object_key(path: str) -> str:
+    """
+    The claim key for an email object in S3.
+    """
+    return f"object#{path}"
+
+
+def _digest(fbytes: bytes, chunk_size: int = 1024 * 1024) -> str:
+    digest = hashlib.sha256()
+    view = memoryview(fbytes)
+    for start in range(0, len(view), chunk_size):
+        digest.update(view[start : start + chunk_size])
+    return digest.hexdigest()
+
+
+def file_key(user_email: str, fbytes: bytes, chunk_size: int = 1024 * 1024) -> str:
+    """
+    The claim key for a document sent by a user: the SHA-256 of its bytes.
+    """
+    return f"file#{user_email}#{_digest(fbytes, chunk_size)}"
+
+
+def checkpoint_key(path: str, fbytes: bytes) -> str:
+    """
+    The checkpoint key for a document from the email object at `path`.
+    """
+    return f"delivered#{path}#{_digest(fbytes)}"
+
+
+def claim(key: str, ttl: float = None) -> bool:
+    """
+    Claim `key` with a conditional write, as a lease of `ttl` seconds
+    (default `Config.DEDUP_LEASE_SECONDS`, or a minute). If we die before
+    calling `mark`, the lease runs out and Lambda's retry can take over.
+
+    Returns False if someone already holds an unexpired claim on it. If the
+    table can't be reached we fail open and return True; a duplicate
+    document is better than a lost one.
+    """
+    if ttl is None:
+        ttl = getattr(Config, "DEDUP_LEASE_SECONDS", 60)
+    now = datetime.datetime.now(datetime.timezone.utc)
+    expires = now + datetime.timedelta(seconds=ttl)
+    try:
+        DedupModel(key, state=CLAIMED, expires=expires).save(
+            condition=DedupModel.key.does_not_exist() | (DedupModel.expires < now)
+        )
+    except PutError as e:
+        if e.cause_response_code == "ConditionalCheckFailedException":
+            return False
+        print(f"Couldn't claim {key}, continuing anyway: {e}")
+    except Exception as e:
+        print(f"Couldn't claim {key}, continuing anyway: {e}")
+    return True
+
+
+def release(key: str) -> None:
+    """
+    Give up a claim, so that the work can be retried.
+    """
+    try:
+        DedupModel(key).delete()
+    except Exception as e:
+        print(f"Couldn't release {key}: {e}")
+
+
+def mark(key: str, ttl: float = None) -> None:
+    """
+    Record a checkpoint (a piece of work that's done) for `ttl` seconds
+    (default `Config.DEDUP_TTL_SECONDS`, or a day). Marking a claimed key
+    turns its lease into a claim for that long.
+    """
+    if ttl is None:
+        ttl = getattr(Config, "DEDUP_TTL_SECONDS", 24 * 60 * 60)
+    expires = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=ttl)
+    try:
+        DedupModel(key, state=DONE, expires=expires).save()
+    except Exception as e:
+        print(f"Couldn't record checkpoint {key}: {e}")
+
+
+def marked(keys: List[str]) -> Set[str]:
+    """
+    Which of `keys` have unexpired checkpoints, in one batch read. If the
+    table can't be reached, nothing is.
+    """
+    now = datetime.datetime.now(datetime.timezone.utc)
+    try:
+        return {item.key for item in DedupModel.batch_get(set(keys)) if item.expires > now}
+    except Exception as e:
+        print(f"Couldn't read checkpoints: {e}")
+        return set()
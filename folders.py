@@ -0,0 +1,143 @@
+"""
+Route uploads into folders on the tablet.
+
+Listing a user's documents from the reMarkable cloud takes seconds, so each
+user's folder tree is cached for `Config.FOLDER_CACHE_TTL` seconds (default
+ten minutes), kept up to date with the folders we create ourselves, and
+dropped if an upload into one of its folders fails.
+"""
+import contextlib
+import threading
+import time
+from collections import OrderedDict
+from typing import Iterable, List, Tuple
+
+from breaker import remarkable_call
+from config import Config
+
+ROOT = ""
+
+
+class FolderTree:
+    """
+    A user's folders, indexed by parent and name so that a path resolves in
+    one dict lookup per level. Names match case-insensitively.
+    """
+
+    def __init__(self, folders: Iterable[Tuple[str, str, str]] = ()):
+        self._children = {}
+        for folder_id, name, parent in folders:
+            self.add(folder_id, name, parent)
+
+    @classmethod
+    def from_meta_items(cls, items) -> "FolderTree":
+        """
+        Build a tree from rmapy's `get_meta_items()`. Folders in the trash
+        aren't reachable from the root, so they're never matched.
+        """
+        return cls(
+            (item.ID, item.VissibleName, item.Parent)
+            for item in items
+            if item.Type == "CollectionType"
+        )
+
+    def add(self, folder_id: str, name: str, parent: str = ROOT) -> None:
+        # If two folders share a name, stick with the first one we saw:
+        self._children.setdefault(parent, {}).setdefault(name.casefold(), folder_id)
+
+    def find(self, path: List[str]) -> Tuple[str, List[str]]:
+        """
+        Walk `path` from the root. Returns the ID of the deepest folder that
+        exists, and the names along `path` below it that don't.
+        """
+        parent = ROOT
+        for depth, name in enumerate(path):
+            child = self._children.get(parent, {}).get(name.casefold())
+            if child is None:
+                return parent, path[depth:]
+            parent = child
+        return parent, []
+
+
+class FolderCache:
+    """
+    Per-user folder trees, kept for `ttl` seconds, for at most `max_users`
+    users (least recently used first out).
+
+    This lives at module scope, so it survives across warm lambda
+    invocations in the same container.
+    """
+
+    def __init__(self, ttl: float = 600, max_users: int = 256):
+        self.ttl = ttl
+        self.max_users = max_users
+        self._trees = OrderedDict()
+        self._lock = threading.Lock()
+        # user -> [lock, how many callers hold or are waiting for it], dropped
+        # when nobody's using it.
+        self._user_locks = {}
+
+    def resolve(self, user_email: str, rm, path: List[str]) -> str:
+        """
+        The ID of the folder at `path` in the user's cloud, creating any
+        folders along it that don't exist yet.
+        """
+        with self._lock_for(user_email):
+            tree = self._tree(user_email, rm)
+            parent, missing = tree.find(path)
+            for name in missing:
+                from rmapy.folder import Folder
+
+                folder = Folder(name, Parent=parent)
+                remarkable_call(rm.create_folder, folder)
+                tree.add(folder.ID, name, parent)
+                parent = folder.ID
+            return parent
+
+    def invalidate(self, user_email: str) -> None:
+        with self._lock:
+            self._trees.pop(user_email, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._trees.clear()
+
+    def _tree(self, user_email: str, rm) -> FolderTree:
+        with self._lock:
+            entry = self._trees.get(user_email)
+            if entry is not None and entry[0] > time.monotonic():
+                self._trees.move_to_end(user_email)
+                return entry[1]
+        tree = FolderTree.from_meta_items(remarkable_call(rm.get_meta_items))
+        with self._lock:
+            self._trees[user_email] = (time.monotonic() + self.ttl, tree)
+            self._trees.move_to_end(user_email)
+            while len(self._trees) > self.max_users:
+                self._trees.popitem(last=False)
+        return tree
+
+    @contextlib.contextmanager
+    def _lock_for(self, user_email: str):
+        # One lookup or folder creation per user at a time, so concurrent
+        # uploads don't create the same folder twice.
+        with self._lock:
+            entry = self._user_locks.setdefault(user_email, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._user_locks[user_email]
+
+
+def parse_path(path: str) -> List[str]:
+    """
+    "Papers/ML/" -> ["Papers", "ML"]
+    """
+    return [name.strip() for name in path.split("/") if name.strip()]
+
+
+FOLDER_CACHE = FolderCache(ttl=getattr(Config, "FOLDER_CACHE_TTL", 600))
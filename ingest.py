@@ -0,0 +1,13 @@
+"""
+Lean entry point for mail-triggered invocations.
+
+Importing this module never imports Flask, and rmapy / PynamoDB are only
+imported once a message actually needs them (uploads, registrations and
+unsubscribes). Point the S3 event (and the pre-renew schedule) at these
+handlers rather than at the web app to keep cold starts short.
+
+Run `python bench/importtime.py` to see what importing this costs.
+"""
+from lambda_main import upload_handler, prerenew_handler, notification_handler
+
+__all__ = ["upload_handler", "prerenew_handler", "notification_handler"]
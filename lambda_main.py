@@ -1,31 +1,32 @@
-from typing import Tuple, Dict
+from typing import TYPE_CHECKING, Tuple, Dict, Iterable, Optional
 
 import base64
+import binascii
+import contextlib
 import datetime
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import io
+import os
 import email
+import email.message
+import email.parser
 import json
-
-import tempfile
-
-import boto3
-from botocore.exceptions import ClientError
-from flask import Flask, jsonify, render_template
+import re
+import threading
+import time
+import traceback
 
 from config import Config
+import breaker
+import clients
+import tracing
+from folders import FOLDER_CACHE, parse_path
 
-from users import (
-    get_config_for_user,
-    set_config_for_user,
-    renew_user_token,
-    delete_user,
-)
-
-from analytics.SendToRemarkableRequestModel import SendToRemarkableRequestModel
-
-# remarkable imports:
-from rmapy.document import ZipDocument
-from rmapy.api import Client
+# Heavy dependencies (rmapy, PynamoDB, Flask, boto3) are imported where
+# they're used, so that mail-triggered invocations only pay for what they
+# need on a cold start. See ingest.py.
+if TYPE_CHECKING:
+    from rmapy.document import ZipDocument
 
 
 def plog(*args):
@@ -51,63 +52,263 @@ def send_email_if_enabled(to: str, subject: str, message: str):
         plog("Config.SEND_EMAILS is False; skipping receipt message.")
         return
 
-    ses = boto3.client("ses", region_name=Config.AWS_REGION)
+    from botocore.exceptions import ClientError
+
+    ses = clients.ses()
 
     _suffix = """
 \n
 To delete your account and unsubscribe from all future emails, reply to this message with the subject line "UNSUBSCRIBE" (case-insensitive).
     """
     try:
-        response = ses.send_email(
-            Destination={
-                "ToAddresses": [to],
-            },
-            Message={
-                "Body": {
-                    "Text": {
+        with tracing.span("ses"):
+            response = ses.send_email(
+                Destination={
+                    "ToAddresses": [to],
+                },
+                Message={
+                    "Body": {
+                        "Text": {
+                            "Charset": "UTF-8",
+                            "Data": message + _suffix,
+                        },
+                    },
+                    "Subject": {
                         "Charset": "UTF-8",
-                        "Data": message + _suffix,
+                        "Data": subject,
                     },
                 },
-                "Subject": {
-                    "Charset": "UTF-8",
-                    "Data": subject,
-                },
-            },
-            Source=Config.EMAIL_SENDER,
-        )
+                Source=Config.EMAIL_SENDER,
+            )
     except ClientError as e:
         plog("Encountered error:", e)
     else:
         plog(f"Sent email to {to}.")
 
 
+# How much of the S3 body to pull down per read while parsing:
+S3_CHUNK_SIZE = 1024 * 1024
+
+# How many base64 characters to decode at a time:
+DECODE_CHUNK_SIZE = 1024 * 1024
+
+_NOT_BASE64 = re.compile(r"[^A-Za-z0-9+/=]")
+
+
+def parse_email_stream(chunks: Iterable[bytes]) -> email.message.Message:
+    """
+    Incrementally parse an email from an iterable of byte chunks.
+
+    Nothing holds on to the raw bytes once they've been fed to the parser,
+    so the message only exists in memory once (as the parsed tree).
+    """
+    parser = email.parser.BytesFeedParser()
+    for chunk in chunks:
+        parser.feed(chunk)
+    return parser.close()
+
+
+# How much of an email to fetch when we only want its headers:
+HEADER_FETCH_BYTES = 16 * 1024
+
+
+def s3_key(path: str) -> str:
+    if hasattr(Config, "BUCKET_PREFIX"):
+        return f"{Config.BUCKET_PREFIX}/{path}"
+    return f"{path}"
+
+
 def load_email_from_s3(path: str):
     """
     Load an email object from an s3 path like `s3://foo/bar`.
 
+    The object body is streamed straight into the MIME parser instead of
+    being buffered first.
+
     """
     plog(f"Loading {path} from s3...")
-    s3 = boto3.resource("s3")
-    virtual_file = io.BytesIO()
-    if hasattr(Config, "BUCKET_PREFIX"):
-        s3.Object(
-            bucket_name=Config.BUCKET_NAME, key=f"{Config.BUCKET_PREFIX}/{path}"
-        ).download_fileobj(virtual_file)
-    else:
-        s3.Object(bucket_name=Config.BUCKET_NAME, key=f"{path}").download_fileobj(
-            virtual_file
-        )
-
-    virtual_file.seek(0)
+    body = clients.s3().get_object(Bucket=Config.BUCKET_NAME, Key=s3_key(path))["Body"]
 
     try:
-        return email.message_from_bytes(virtual_file.read())
+        with tracing.span("s3_load"):
+            return parse_email_stream(body.iter_chunks(chunk_size=S3_CHUNK_SIZE))
     except:
         plog(f"Path {path} was not a valid email .eml binary.")
+    finally:
+        body.close()
+
+
+def load_headers_from_s3(
+    path: str,
+) -> Tuple[Optional[email.message.Message], Optional[int]]:
+    """
+    Load just the header block of an email in S3, with a ranged GET of the
+    first `HEADER_FETCH_BYTES`, along with the size of the whole object
+    (from the response's Content-Range).
+
+    The headers are None if they don't fit in that range (or the fetch
+    fails), in which case the caller should load the whole email. The size
+    is None if S3 didn't tell us.
+    """
+    try:
+        with tracing.span("s3_headers"):
+            response = clients.s3().get_object(
+                Bucket=Config.BUCKET_NAME,
+                Key=s3_key(path),
+                Range=f"bytes=0-{HEADER_FETCH_BYTES - 1}",
+            )
+            body = response["Body"]
+            try:
+                head = body.read()
+            finally:
+                body.close()
+    except Exception as e:
+        plog(f"Couldn't fetch headers for {path}: {e}")
+        return None, None
+
+    # Like "bytes 0-16383/90287":
+    content_range = response.get("ContentRange") or ""
+    size = None
+    if "/" in content_range and content_range.split("/")[-1].isdigit():
+        size = int(content_range.split("/")[-1])
+    elif len(head) < HEADER_FETCH_BYTES:
+        size = len(head)
+
+    ends = [i for i in (head.find(b"\r\n\r\n"), head.find(b"\n\n")) if i != -1]
+    if ends:
+        head = head[: min(ends)]
+    elif len(head) >= HEADER_FETCH_BYTES:
+        return None, size
+    return email.parser.BytesHeaderParser().parsebytes(head), size
+
+
+def iter_base64_chunks(payload: str, chunk_size: int = DECODE_CHUNK_SIZE):
+    """
+    Decode a base64 string a slice at a time, yielding decoded bytes.
+
+    Line breaks (and anything else outside the base64 alphabet) are dropped
+    per-slice, and partial quads are carried over to the next slice.
+    """
+    carry = ""
+    for start in range(0, len(payload), chunk_size):
+        piece = carry + _NOT_BASE64.sub("", payload[start : start + chunk_size])
+        cut = len(piece) - len(piece) % 4
+        carry = piece[cut:]
+        if cut:
+            yield base64.b64decode(piece[:cut])
+    if carry:
+        yield base64.b64decode(carry)
+
+
+def decode_part(part: email.message.Message) -> bytes:
+    """
+    Decode an attachment part into bytes.
+
+    Base64 parts are decoded straight from the payload string into one
+    bytes object: a2b_base64 reads ASCII strings in place and skips line
+    breaks, so there's no intermediate copy of either the encoded or the
+    decoded data.
+    """
+    encoding = str(part.get("Content-Transfer-Encoding", "base64")).strip().lower()
+    if encoding != "base64":
+        return part.get_payload(decode=True)
+    try:
+        return binascii.a2b_base64(part.get_payload())
+    except (binascii.Error, ValueError):
+        # Not ASCII, or badly padded; the email package is more forgiving:
+        return part.get_payload(decode=True)
+
+
+def get_valid_config_for_user(user_email: str) -> dict:
+    from users import get_valid_config_for_user
+
+    return get_valid_config_for_user(user_email)
+
+
+def resolve_users(user_emails: Iterable[str]) -> Dict[str, dict]:
+    from users import resolve_users
+
+    return resolve_users(user_emails)
+
+
+def set_config_for_user(user_email: str, new_cfg: dict) -> bool:
+    from users import set_config_for_user
+
+    return set_config_for_user(user_email, new_cfg)
+
+
+def delete_user(user_email: str) -> bool:
+    from users import delete_user
+
+    return delete_user(user_email)
+
+
+_analytics_sink = None
+_analytics_sink_lock = threading.Lock()
+
+
+def analytics_sink():
+    """
+    The container's AnalyticsSink, created the first time it's needed.
+    """
+    global _analytics_sink
+    with _analytics_sink_lock:
+        if _analytics_sink is None:
+            from analytics.AnalyticsSink import AnalyticsSink
+            from analytics.rollups import record_rollups
+
+            _analytics_sink = AnalyticsSink(rollup=record_rollups)
+        return _analytics_sink
+
+
+def log_send_request(
+    user_email: str,
+    upload_size: int,
+    success: bool,
+    traceback: str,
+    attachment_count: int = None,
+    stage_durations: Dict[str, float] = None,
+    bytes_saved: int = None,
+):
+    """
+    Buffer a document event for the analytics table; it's written when the
+    buffer fills or by `flush_analytics()`. Failures are logged and
+    swallowed; analytics should never break a delivery.
+    """
+    try:
+        from users import sanitize_email
+
+        date = datetime.datetime.now().isoformat()
+        analytics_sink().record(
+            email=sanitize_email(user_email),
+            date=date,
+            day=date[:10],
+            upload_size=upload_size,
+            success=success,
+            traceback=traceback,
+            attachment_count=attachment_count,
+            stage_durations=stage_durations,
+            bytes_saved=bytes_saved,
+        )
+    except Exception as e:
+        plog(f"Encountered exception while logging: {e}")
+
+
+def flush_analytics():
+    """
+    Write any buffered analytics events. Call at the end of an invocation.
+    """
+    if _analytics_sink is None:
+        return
+    try:
+        _analytics_sink.flush()
+    except Exception as e:
+        plog(f"Encountered exception while logging: {e}")
 
 
 def register_user(user_email: str, code: str):
+    from rmapy.api import Client
+
     rm = Client()
     rm.register_device(code, save_to_file=False)
     new_cfg = rm.renew_token(save_to_file=False)
@@ -126,7 +327,7 @@ class MessageStatus(Enum):
     FAILURE = 1
     UNSUBSCRIBE = 2
     REGISTER = 3
-    FILE_TOO_BIG = 4  # unused
+    FILE_TOO_BIG = 4
 
 
 class ParseMessageResult(Dict):
@@ -134,18 +335,346 @@ class ParseMessageResult(Dict):
     subject: str
     status: MessageStatus
     extracted_files: List[FileTuple]
+    # Only present when attachments were turned away for being too big:
+    oversized_files: List[str]
+    # Only present when documents couldn't be converted to PDF:
+    unconverted_files: List[str]
 
 
-def extract_files_from_email(message: email.message.Message) -> ParseMessageResult:
+MB = 1024 * 1024
+
+
+def max_email_bytes() -> int:
     """
-    Parses an email Message and returns a ParseMessageResult:
+    Emails bigger than this are turned away before we download them.
+    """
+    return getattr(Config, "MAX_EMAIL_BYTES", 40 * MB)
+
+
+def max_attachment_bytes() -> int:
+    """
+    Attachments bigger than this (decoded) are turned away before we
+    decode them.
+    """
+    return getattr(Config, "MAX_ATTACHMENT_BYTES", 30 * MB)
+
+
+def oversize_policy() -> str:
+    """
+    What to do with a message that has an attachment over the limit:
+    "reject" the whole message (default), or "truncate" it, delivering the
+    attachments that fit and telling the user about the rest.
+    """
+    return getattr(Config, "OVERSIZE_POLICY", "reject")
+
+
+def estimated_size(part: email.message.Message) -> int:
+    """
+    The decoded size of an attachment, estimated from its encoded payload
+    without decoding it.
+    """
+    payload = part.get_payload()
+    if not isinstance(payload, str):
+        return 0
+    encoding = str(part.get("Content-Transfer-Encoding", "base64")).strip().lower()
+    if encoding == "base64":
+        # Ignore line breaks (LF or CRLF) and padding; every 4 characters
+        # decode to 3 bytes.
+        ignored = payload.count("\n") + payload.count("\r") + payload.count("=")
+        return (len(payload) - ignored) * 3 // 4
+    return len(payload)
+
+
+def admit_message(
+    headers: email.message.Message, size: Optional[int]
+) -> Optional[ParseMessageResult]:
+    """
+    Turn an email away as FILE_TOO_BIG based on its size in S3, before we
+    download it. Returns None if it's admitted (or its size is unknown).
+    """
+    if size is None or size <= max_email_bytes():
+        return None
+    plog(f"Rejecting a {size} byte email from {headers.get('From')}.")
+    return ParseMessageResult(
+        sent_from=headers.get("From"),
+        subject=headers.get("Subject"),
+        status=MessageStatus.FILE_TOO_BIG,
+        extracted_files=[],
+        oversized_files=[],
+    )
+
+
+_worker_pool = None
+_worker_pool_lock = threading.Lock()
+
+
+def worker_pool():
+    """
+    The process pool for CPU-heavy work on documents (slimming them), so
+    that it doesn't hold the GIL while uploads are in flight. It has
+    `Config.WORKER_PROCESSES` workers (default: one per CPU).
+
+    Where process pools aren't available (AWS Lambda has no /dev/shm),
+    this is a thread pool instead.
+    """
+    import multiprocessing
+
+    global _worker_pool
+    with _worker_pool_lock:
+        if _worker_pool is None:
+            workers = getattr(Config, "WORKER_PROCESSES", os.cpu_count() or 1)
+            # Forking from a process with threads running could hand the
+            # workers a lock one of them holds, so start them cleanly:
+            methods = multiprocessing.get_all_start_methods()
+            context = multiprocessing.get_context(
+                "forkserver" if "forkserver" in methods else "spawn"
+            )
+            try:
+                _worker_pool = ProcessPoolExecutor(max_workers=workers, mp_context=context)
+            except (OSError, NotImplementedError) as e:
+                plog(f"No process pool available, using threads: {e}")
+                _worker_pool = ThreadPoolExecutor(max_workers=workers)
+    return _worker_pool
+
+
+DOCUMENT_TYPES = {
+    "application/pdf": "pdf",
+    "application/x-pdf": "pdf",
+    "application/epub+zip": "epub",
+    "application/epub": "epub",
+}
+GENERIC_TYPES = {"application/octet-stream", "binary/octet-stream", "application/binary"}
+# Documents we can render to PDF (see convert.py), by type and extension:
+CONVERTIBLE_TYPES = {
+    "text/markdown": "markdown",
+    "text/x-markdown": "markdown",
+    "text/html": "html",
+    "text/plain": "text",
+}
+CONVERTIBLE_EXTENSIONS = {
+    ".md": "markdown",
+    ".markdown": "markdown",
+    ".html": "html",
+    ".htm": "html",
+    ".txt": "text",
+}
+
+
+EPUB_MAGIC = b"PK\x03\x04"
+EPUB_MIMETYPE = b"mimetypeapplication/epub+zip"
+
+
+def sniff_part(part: email.message.Message, size: int = 64) -> bytes:
+    """
+    Decode just the first few bytes of a part, for checking magic numbers.
+    """
+    payload = part.get_payload()
+    if not isinstance(payload, str):
+        return b""
+    encoding = str(part.get("Content-Transfer-Encoding", "base64")).strip().lower()
+    if encoding != "base64":
+        return (part.get_payload(decode=True) or b"")[:size]
+    # Leave room for line breaks; 4 characters decode to 3 bytes.
+    prefix = payload[: size * 2]
+    return next(iter_base64_chunks(prefix, chunk_size=len(prefix)), b"")[:size]
+
+
+def classify_part(part: email.message.Message) -> Optional[str]:
+    """
+    Decide whether a MIME part is a document we can deliver: returns "pdf",
+    "epub", or None. With `Config.CONVERT_DOCUMENTS`, attached Markdown,
+    HTML and text files are "markdown", "html" or "text".
+
+    We go by the content type first, then the filename's extension (mail
+    clients often send application/octet-stream), and finally the part's
+    magic bytes, decoding only the first few of them.
+    """
+    if part.is_multipart():
+        return None
+    content_type = part.get_content_type()
+    if content_type in DOCUMENT_TYPES:
+        return DOCUMENT_TYPES[content_type]
+
+    ext = os.path.splitext(part.get_filename() or "")[1].lower()
+    if part.get_content_maintype() == "text":
+        # Message bodies are text too; only attachments count here.
+        if not converting() or part.get_content_disposition() != "attachment":
+            return None
+        return CONVERTIBLE_EXTENSIONS.get(ext) or CONVERTIBLE_TYPES.get(content_type)
+    if ext in (".pdf", ".epub"):
+        return ext[1:]
+    if ext in CONVERTIBLE_EXTENSIONS and converting():
+        return CONVERTIBLE_EXTENSIONS[ext]
+    if content_type in GENERIC_TYPES:
+        head = sniff_part(part)
+        if head.startswith(b"%PDF"):
+            return "pdf"
+        if head.startswith(EPUB_MAGIC) and EPUB_MIMETYPE in head:
+            return "epub"
+    return None
+
+
+def find_documents(
+    message: email.message.Message,
+) -> List[Tuple[str, str, email.message.Message]]:
+    """
+    Walk a message once and return (filename, kind, part) for every
+    deliverable document in it, without decoding them.
+
+    Filenames are given the extension that matches what we'll deliver,
+    since that's what decides the file type when we package it; documents
+    we'll convert become .pdf.
+    """
+    documents = []
+    for part in message.walk():
+        kind = classify_part(part)
+        if kind is None:
+            continue
+        delivered_as = kind if kind in ("pdf", "epub") else "pdf"
+        filename = part.get_filename() or f"Remailable_Attachment.{delivered_as}"
+        assert type(filename) == str
+        if kind != delivered_as:
+            filename = os.path.splitext(filename)[0] + ".pdf"
+        elif os.path.splitext(filename)[1].lower() != f".{kind}":
+            filename = f"{filename}.{kind}"
+        documents.append((filename, kind, part))
+    return documents
+
+
+def find_body(message: email.message.Message) -> Optional[Tuple[str, email.message.Message]]:
+    """
+    The message's body, as (kind, part), preferring HTML over plain text.
+    """
+    body = None
+    for part in message.walk():
+        if part.is_multipart() or part.get_content_disposition() == "attachment":
+            continue
+        if part.get_content_type() == "text/html":
+            return "html", part
+        if part.get_content_type() == "text/plain" and body is None:
+            body = ("text", part)
+    return body
+
+
+def part_text(part: email.message.Message) -> str:
+    payload = part.get_payload(decode=True) or b""
+    charset = part.get_content_charset() or "utf-8"
+    try:
+        return payload.decode(charset, "replace")
+    except LookupError:
+        return payload.decode("utf-8", "replace")
+
+
+# "Notes to: Papers/ML" sends the documents to the Papers/ML folder:
+FOLDER_DIRECTIVE = re.compile(r"(?:^|\s)to:\s*(?P<path>\S.*?)\s*$", re.IGNORECASE)
+
+
+def folder_path(subject: str) -> List[str]:
+    """
+    The folder the sender asked for in the subject, as a list of names from
+    the root. Empty for the root itself.
+    """
+    match = FOLDER_DIRECTIVE.search(subject or "")
+    return parse_path(match.group("path")) if match else []
+
+
+def document_name(subject: str) -> str:
+    """
+    A filename for a document made from an email body, based on its subject
+    (without any folder directive).
+    """
+    subject = FOLDER_DIRECTIVE.sub("", subject or "")
+    name = re.sub(r"[^\w\- .,()]+", "", subject).strip()
+    return f"{name[:100] or 'Remailable_Message'}.pdf"
+
+
+def converting() -> bool:
+    return getattr(Config, "CONVERT_DOCUMENTS", False)
+
+
+def conversion_cache_bucket() -> Optional[str]:
+    return getattr(Config, "CONVERSION_CACHE_BUCKET", None)
+
+
+def load_cached_conversion(key: str) -> Optional[bytes]:
+    bucket = conversion_cache_bucket()
+    if not bucket:
+        return None
+    try:
+        return clients.s3().get_object(Bucket=bucket, Key=f"converted/{key}.pdf")["Body"].read()
+    except Exception:
+        return None
+
+
+def store_cached_conversion(key: str, pdf: bytes) -> None:
+    bucket = conversion_cache_bucket()
+    if not bucket:
+        return
+    try:
+        clients.s3().put_object(Bucket=bucket, Key=f"converted/{key}.pdf", Body=pdf)
+    except Exception as e:
+        plog(f"Couldn't cache converted document {key}: {e}")
+
+
+def convert_documents(documents: List[Tuple[str, str, str]]) -> Tuple[List[FileTuple], List[str]]:
+    """
+    Render (filename, kind, text) documents to PDF, `Config.WORKER_PROCESSES`
+    at a time, each in a process of its own (see `convert.run_converter`).
+
+    Each document gets `Config.CONVERSION_TIMEOUT` seconds (default 30) from
+    when its conversion starts, after which it's killed.
+    Results are cached by content hash in memory and, if it's set, in
+    `Config.CONVERSION_CACHE_BUCKET`, so the same newsletter or forwarded
+    document is only converted once. Returns the converted files and the
+    names of any documents that couldn't be converted in time.
+    """
+    from convert import CONVERSION_CACHE, CONVERTERS, content_key, run_converter
+
+    budget = getattr(Config, "CONVERSION_TIMEOUT", 30)
+    results: List[Optional[bytes]] = []
+    pending = []
+    for i, (filename, kind, text) in enumerate(documents):
+        key = content_key(kind, text)
+        pdf = CONVERSION_CACHE.get(key) or load_cached_conversion(key)
+        results.append(pdf)
+        if pdf is None:
+            pending.append((i, key))
+        else:
+            CONVERSION_CACHE.put(key, pdf)
+
+    def convert(i):
+        _, kind, text = documents[i]
+        try:
+            return run_converter(CONVERTERS[kind], text, budget)
+        except Exception as e:
+            plog(f"Couldn't convert {documents[i][0]}: {e!r}")
+            return None
+
+    if pending:
+        workers = getattr(Config, "WORKER_PROCESSES", os.cpu_count() or 1)
+        with ThreadPoolExecutor(max_workers=max(1, min(workers, len(pending)))) as pool:
+            converted = list(pool.map(convert, [i for i, _ in pending]))
+        for (i, key), pdf in zip(pending, converted):
+            if pdf is None:
+                continue
+            CONVERSION_CACHE.put(key, pdf)
+            store_cached_conversion(key, pdf)
+            results[i] = pdf
+
+    converted = [(filename, pdf) for (filename, _, _), pdf in zip(documents, results) if pdf]
+    failed = [filename for (filename, _, _), pdf in zip(documents, results) if not pdf]
+    return converted, failed
+
+
+def classify_headers(message: email.message.Message) -> Optional[ParseMessageResult]:
+    """
+    Classify a message from its headers alone, if we can:
     1. Is there a subject and from in the email? If no, return.
-    2. Does the subject contain the word "unsubscribe"? If yes, return.
-    3. Is the subject 8 letters long? If yes, return.
-    4. Otherwise:
-        - Walk through the message and grab all parts that match
-          "application/pdf;" or "application/epub".
-        - Return a ParseMessageResult with those files.
+    2. Does the subject contain the word "unsubscribe"? If yes, UNSUBSCRIBE.
+    3. Is the subject 8 letters long? If yes, REGISTER.
+    4. Is the whole message text? If yes, there can't be any attachments,
+       so FAILURE (unless we're converting bodies to PDF).
+    Otherwise returns None: we'll need the body to know.
     """
     subject: str = message.get("Subject")
     sent_from: str = message.get("From")
@@ -165,26 +694,82 @@ def extract_files_from_email(message: email.message.Message) -> ParseMessageResu
             status=MessageStatus.REGISTER,
             extracted_files=[],
         )
+    if message.get_content_maintype() == "text" and not converting():
+        return ParseMessageResult(
+            sent_from=sent_from,
+            subject=subject,
+            status=MessageStatus.FAILURE,
+            extracted_files=[],
+        )
+    return None
+
+
+def extract_files_from_email(message: email.message.Message) -> ParseMessageResult:
+    """
+    Parses an email Message and returns a ParseMessageResult:
+    1. Can we classify it from the headers (see classify_headers)? If yes,
+       return.
+    2. Otherwise:
+        - Walk through the message once and grab every part that looks
+          like a PDF or EPUB (see classify_part).
+        - With `Config.CONVERT_DOCUMENTS`, render attached Markdown, HTML
+          and text to PDF, or the body itself if there's nothing attached.
+        - Return a ParseMessageResult with those files.
+    """
+    result = classify_headers(message)
+    if result is not None:
+        return result
+    subject: str = message.get("Subject")
+    sent_from: str = message.get("From")
     # Now we're done parsing the subject, we should check if there are any attachments
+    candidates = find_documents(message)
+
+    # Check sizes before decoding anything:
+    limit = max_attachment_bytes()
+    oversized = [name for name, _, part in candidates if estimated_size(part) > limit]
+    if oversized and (oversize_policy() != "truncate" or len(oversized) == len(candidates)):
+        return ParseMessageResult(
+            sent_from=sent_from,
+            subject=subject,
+            status=MessageStatus.FILE_TOO_BIG,
+            extracted_files=[],
+            oversized_files=oversized,
+        )
+
     files: List[FileTuple] = []
-    for part in message.walk():
-        if "application/pdf;" in part["Content-Type"]:
-            filename = part.get_filename() or "Remailable_Attachment.pdf"
-            filebytes = base64.b64decode(part.get_payload())
-            assert type(filename) == str
-            files.append((filename, filebytes))
-        elif "application/epub" in part["Content-Type"]:
-            filename = part.get_filename() or "Remailable_Attachment.epub"
-            filebytes = base64.b64decode(part.get_payload())
-            assert type(filename) == str
-            files.append((filename, filebytes))
+    to_convert = []
+    for filename, kind, part in candidates:
+        if estimated_size(part) > limit:
+            continue
+        if kind in ("pdf", "epub"):
+            files.append((filename, decode_part(part)))
+        else:
+            to_convert.append((filename, kind, part_text(part)))
+    if not candidates and converting():
+        body = find_body(message)
+        if body is not None:
+            kind, part = body
+            to_convert.append((document_name(subject), kind, part_text(part)))
+
+    unconverted = []
+    if to_convert:
+        started_at = time.monotonic()
+        converted, unconverted = convert_documents(to_convert)
+        tracing.current_trace().add("convert", (time.monotonic() - started_at) * 1000)
+        files.extend(converted)
+
     if files:
-        return ParseMessageResult(
+        result = ParseMessageResult(
             sent_from=sent_from,
             subject=subject,
             status=MessageStatus.SUCCESS,
             extracted_files=files,
         )
+        if oversized:
+            result["oversized_files"] = oversized
+        if unconverted:
+            result["unconverted_files"] = unconverted
+        return result
     else:
         # Couldn't parse any files, empty
         return ParseMessageResult(
@@ -211,10 +796,10 @@ def extract_pdf(message: email.message.Message) -> Tuple[str, bytes]:
 
     filename = None
     filebytes = None
-    for part in message.walk():
-        if "application/pdf;" in part["Content-Type"]:
-            filename = part.get_filename() or "Remailable_Attachment.pdf"
-            filebytes = base64.b64decode(part.get_payload())
+    for name, kind, part in find_documents(message):
+        if kind == "pdf":
+            filename = name
+            filebytes = decode_part(part)
             break
     else:
         # Let's try getting the subjectline and body and see if there's a code
@@ -241,107 +826,732 @@ def extract_pdf(message: email.message.Message) -> Tuple[str, bytes]:
     return (filename, filebytes)
 
 
-def transfer_file_to_remarkable(user_email: str, fname, fbytes):
-    plog(f"* Asking for {user_email} credentials...")
-    cfg = renew_user_token(user_email)
+def build_zip_document(fname: str, fbytes: bytes) -> "ZipDocument":
+    """
+    Package a decoded attachment as a reMarkable ZipDocument in memory.
+
+    The file type comes from the extension (anything that isn't an .epub is
+    treated as a PDF, as before), and the payload buffer wraps `fbytes`
+    directly rather than round-tripping through a temp file on /tmp.
+    """
+    from rmapy.document import ZipDocument
+
+    name, ext = os.path.splitext(fname)
+    doc = ZipDocument()
+    # BytesIO shares the underlying bytes object until it's written to:
+    payload = io.BytesIO(fbytes)
+    if ext.lower() == ".epub":
+        doc.content["fileType"] = "epub"
+        doc.epub = payload
+    else:
+        doc.content["fileType"] = "pdf"
+        doc.pdf = payload
+    doc.metadata["VissibleName"] = name or fname
+    return doc
+
+
+def transfer_file_to_remarkable(
+    user_email: str, fname, fbytes, cfg: dict = None, parent: str = ""
+):
+    if cfg is None:
+        plog(f"* Asking for {user_email} credentials...")
+        with tracing.span("token"):
+            cfg = get_valid_config_for_user(user_email)
+    from rmapy.api import Client
+
     rm = Client(config_dict=cfg)
-    # Annoychops; gotta save to disk. Bummski!
-    tfile = tempfile.NamedTemporaryFile(prefix=fname, suffix=".pdf")
-    tfile.write(fbytes)
-    tfile.seek(0)
 
     plog(f"* Generating zip...")
-    doc = ZipDocument(doc=tfile.name)
+    with tracing.span("package"):
+        doc = build_zip_document(fname, fbytes)
     plog(f"* Uploading to device.")
-    rm.upload(doc)
+    with tracing.span("upload"):
+        if getattr(Config, "STREAM_UPLOADS", True):
+            from streaming import stream_upload
+
+            breaker.remarkable_call(stream_upload, rm, doc, parent=parent)
+        else:
+            breaker.remarkable_call(upload_document, rm, doc, parent)
     plog("Success.")
-    send_email_if_enabled(
-        user_email,
-        subject="Your document is on the way!",
-        message=f"Your document, '{fname}', has been successfully sent to your reMarkable.",
-    )
 
 
-def handle_message_result(result: ParseMessageResult) -> None:
+def upload_document(rm, doc, parent: str = ""):
+    """
+    `rm.upload(doc)`, made safe to retry: `ZipDocument.dump` reads the
+    payload without rewinding it, so a second attempt would upload an
+    empty document.
+    """
+    from rmapy.folder import Folder
+
+    for payload in (doc.pdf, doc.epub):
+        if payload:
+            payload.seek(0)
+    doc.zipfile = io.BytesIO()
+    return rm.upload(doc, Folder(ID=parent))
+
+
+def handle_message_result(
+    result: ParseMessageResult, message_key: str = None
+) -> Optional[List[dict]]:
     """
     Takes in a ParseMessageResult and sends the appropriate emails/
-    transfers the approriate files depending on the message status
+    transfers the approriate files depending on the message status.
+
+    For a SUCCESS message, returns one result dict per extracted file.
+    `message_key` identifies the message for checkpoints (see
+    `deliver_files`).
     """
+    trace = tracing.current_trace()
+    trace.set_dimension("status", result["status"].name)
+    trace.set_dimension("attachment_count", len(result["extracted_files"]))
     if result["status"] == MessageStatus.UNSUBSCRIBE:
         plog(f"Permanently removing user {result['sent_from']}.")
         delete_user(result["sent_from"])
     elif result["status"] == MessageStatus.REGISTER:
         register_user(result["sent_from"], result["subject"])
         plog(f"Registered a new user {result['sent_from']}.")
-        send_email_if_enabled(
+        notify(
             to=result["sent_from"],
             subject="Your email address is now verified!",
             message="Your verification succeeded, and you can now email documents to your reMarkable tablet. Try responding to this email with a PDF attachment!",
         )
     elif result["status"] == MessageStatus.FAILURE:
-        send_email_if_enabled(
+        notify(
             to=result["sent_from"],
             subject="A problem with your document :(",
-            message="Unfortunately, a problem occurred while processing your email. Remailable only supports PDF attachments for now. If you're still encountering issues, please get in touch with Jordan at remailable@matelsky.com or on Twitter at @j6m8.",
+            message=f"Unfortunately, a problem occurred while processing your email. Remailable only supports PDF and EPUB attachments for now. {CONTACT}",
+        )
+        log_send_request(
+            result["sent_from"],
+            upload_size=-1,
+            success=False,
+            traceback="Error",
+            attachment_count=0,
         )
-        try:
-            SendToRemarkableRequestModel(
-                email=result["sent_from"],
-                date=datetime.datetime.now().isoformat(),
-                upload_size=-1,
-                success=False,
-                traceback="Error",
-            ).save()
-        except Exception as e:
-            plog(f"Encountered exception while logging: {e}")
         plog(
             f"ERROR: Encountered no files I could pass in message from {result['sent_from']}"
         )
+    elif result["status"] == MessageStatus.FILE_TOO_BIG:
+        notify_too_big(result["sent_from"], result["oversized_files"])
+        log_send_request(
+            result["sent_from"],
+            upload_size=-1,
+            success=False,
+            traceback="FILE_TOO_BIG",
+            attachment_count=len(result["oversized_files"]),
+        )
+    else:
+        outcomes = deliver_files(
+            result["sent_from"],
+            result["extracted_files"],
+            message_key=message_key,
+            folder=folder_path(result["subject"]),
+        )
+        if any(o.get("parked") for o in outcomes):
+            # This message will be retried, and the retry sends the receipt.
+            return outcomes
+        subject, message = delivery_summary(
+            outcomes,
+            result.get("oversized_files", []),
+            result.get("unconverted_files", []),
+        )
+        notify(to=result["sent_from"], subject=subject, message=message)
+        return outcomes
+
+
+CONTACT = "If you're still encountering issues, please get in touch with Jordan at remailable@matelsky.com or on Twitter at @j6m8."
+
+
+def notify_too_big(user_email: str, oversized_files: List[str]):
+    limit = max_attachment_bytes() // MB
+    if oversized_files:
+        names = ", ".join(repr(f) for f in oversized_files)
+        message = f"Unfortunately, {names} couldn't be sent to your reMarkable because Remailable only supports attachments up to {limit}MB."
+    else:
+        message = f"Unfortunately, your email couldn't be sent to your reMarkable because it was too big. Remailable only supports attachments up to {limit}MB."
+    notify(
+        to=user_email,
+        subject="Your document is too big :(",
+        message=message,
+    )
+
+
+def delivery_summary(
+    outcomes: List[dict], oversized_files: List[str] = (), unconverted_files: List[str] = ()
+) -> Tuple[str, str]:
+    """
+    Build one receipt email (subject, message) for everything we did with
+    a message's attachments.
+    """
+    sent = [o["filename"] for o in outcomes if o["success"] and not o.get("duplicate")]
+    duplicates = [o["filename"] for o in outcomes if o.get("duplicate")]
+    failed = [o["filename"] for o in outcomes if not o["success"]] + list(unconverted_files)
+
+    sections = []
+    for heading, names in [
+        ("Sent to your reMarkable:", sent),
+        ("Already sent recently, so we skipped:", duplicates),
+        ("Couldn't be sent:", failed),
+        (
+            f"Too big (Remailable supports attachments up to {max_attachment_bytes() // MB}MB):",
+            list(oversized_files),
+        ),
+    ]:
+        if names:
+            sections.append("\n".join([heading] + [f"  - {name}" for name in names]))
+    if failed or oversized_files:
+        sections.append(CONTACT)
+
+    if not failed and not oversized_files:
+        subject = (
+            "Your document is on the way!"
+            if len(outcomes) == 1
+            else "Your documents are on the way!"
+        )
+    elif sent:
+        subject = "Some of your documents couldn't be sent :("
+    else:
+        subject = "A problem with your document :("
+    return subject, "\n\n".join(sections)
+
+
+_notifier = None
+_pending_notifications: List = []
+_notifier_lock = threading.Lock()
+
+
+def notify(to: str, subject: str, message: str):
+    """
+    Send the user a receipt email without waiting for it.
+
+    If `Config.NOTIFICATION_QUEUE_URL` is set, the email is handed to that
+    SQS queue and sent by `notification_handler`; otherwise it's sent from a
+    background thread. Either way, SES latency stays off the upload path.
+    Call `flush_notifications()` before the invocation ends.
+    """
+    global _notifier
+    with _notifier_lock:
+        if _notifier is None:
+            _notifier = ThreadPoolExecutor(max_workers=2)
+        _pending_notifications.append(
+            _notifier.submit(_send_notification, to, subject, message)
+        )
+
+
+def _send_notification(to: str, subject: str, message: str):
+    try:
+        queue_url = getattr(Config, "NOTIFICATION_QUEUE_URL", None)
+        if queue_url:
+            clients.get_client("sqs").send_message(
+                QueueUrl=queue_url,
+                MessageBody=json.dumps({"to": to, "subject": subject, "message": message}),
+            )
+        else:
+            send_email_if_enabled(to=to, subject=subject, message=message)
+    except Exception as e:
+        plog(f"Encountered exception while notifying {to}: {e}")
+
+
+def flush_notifications():
+    """
+    Wait for any notifications that are still being sent or queued.
+    """
+    with _notifier_lock:
+        pending = list(_pending_notifications)
+        _pending_notifications.clear()
+    for future in pending:
+        future.result()
+
+
+# user -> [semaphore, how many uploads hold or are waiting for it]. Entries
+# are dropped when nobody's using them, so this never outgrows the number
+# of uploads in flight.
+_user_slots: Dict[str, list] = {}
+_user_slots_lock = threading.Lock()
+
+
+@contextlib.contextmanager
+def user_upload_slot(user_email: str):
+    """
+    Hold one of a user's upload slots, which cap their concurrent uploads
+    at `Config.USER_UPLOAD_CONCURRENCY` (default 4) across every message
+    being processed in this container.
+    """
+    with _user_slots_lock:
+        slot = _user_slots.get(user_email)
+        if slot is None:
+            semaphore = threading.BoundedSemaphore(
+                getattr(Config, "USER_UPLOAD_CONCURRENCY", 4)
+            )
+            slot = _user_slots[user_email] = [semaphore, 0]
+        slot[1] += 1
+    try:
+        with slot[0]:
+            yield
+    finally:
+        with _user_slots_lock:
+            slot[1] -= 1
+            if not slot[1]:
+                del _user_slots[user_email]
+
+
+def slim_threshold() -> Optional[int]:
+    """
+    PDFs at least this many bytes are slimmed before upload. None if
+    slimming is turned off (the default).
+    """
+    if not getattr(Config, "SLIM_PDFS", False):
+        return None
+    return getattr(Config, "SLIM_PDF_THRESHOLD", 10 * MB)
+
+
+def slim_document(fname: str, fbytes: bytes) -> Tuple[bytes, int]:
+    """
+    Shrink a PDF before upload if it's over `slim_threshold()`.
+
+    Returns the bytes to upload and how many bytes that saved. If anything
+    goes wrong, the original is sent untouched.
+    """
+    threshold = slim_threshold()
+    if threshold is None or len(fbytes) < threshold or not fname.lower().endswith(".pdf"):
+        return fbytes, 0
+    from slim import slim_pdf
+
+    try:
+        slimmed = worker_pool().submit(slim_pdf, fbytes).result()
+    except Exception as e:
+        plog(f"Couldn't slim {fname}, sending it as-is: {e}")
+        return fbytes, 0
+    return slimmed, len(fbytes) - len(slimmed)
+
+
+def deliver_file(
+    user_email: str,
+    cfg: dict,
+    fname: str,
+    fbytes: bytes,
+    attachment_count: int = 1,
+    parent: str = "",
+) -> dict:
+    """
+    Upload one file into the folder with ID `parent` and log it, returning
+    a result dict instead of raising.
+    """
+    durations = {}
+    bytes_saved = 0
+    try:
+        trace = tracing.current_trace()
+        if slim_threshold() is not None:
+            slim_started_at = time.monotonic()
+            upload_bytes, bytes_saved = slim_document(fname, fbytes)
+            durations["slim"] = (time.monotonic() - slim_started_at) * 1000
+            trace.add("slim", durations["slim"])
+        else:
+            upload_bytes = fbytes
+        queued_at = time.monotonic()
+        with user_upload_slot(user_email):
+            started_at = time.monotonic()
+            durations["queued"] = (started_at - queued_at) * 1000
+            transfer_file_to_remarkable(
+                user_email, fname, upload_bytes, cfg=cfg, parent=parent
+            )
+            durations["transfer"] = (time.monotonic() - started_at) * 1000
+        trace.add("queued", durations["queued"])
+        trace.add("transfer", durations["transfer"])
+    except breaker.CircuitOpenError as e:
+        plog(f"Parking {fname} for {user_email}: {e}")
+        outcome = {"filename": fname, "success": False, "parked": True, "error": str(e)}
+        tb = ""
+    except Exception as e:
+        plog(f"ERROR: Failed to deliver {fname} for {user_email}: {e}")
+        if parent:
+            # The folder may have been deleted since we cached it:
+            FOLDER_CACHE.invalidate(user_email)
+        outcome = {"filename": fname, "success": False, "error": str(e)}
+        tb = traceback.format_exc()
     else:
-        for fname, fbytes in result["extracted_files"]:
-            transfer_file_to_remarkable(result["sent_from"], fname, fbytes)
+        outcome = {"filename": fname, "success": True}
+        tb = ""
+
+    log_send_request(
+        user_email,
+        upload_size=len(fbytes),
+        success=outcome["success"],
+        traceback=tb,
+        attachment_count=attachment_count,
+        stage_durations=durations,
+        bytes_saved=bytes_saved or None,
+    )
+    return outcome
+
+
+def deduplicating() -> bool:
+    return getattr(Config, "DEDUPLICATE", True)
+
+
+def _claim(key: str):
+    from dedup import claim
+
+    with tracing.span("dedup"):
+        return key if claim(key) else None
+
+
+def claim_object(path: str):
+    """
+    Claim an S3 email object. Returns the claim key, or None if the object
+    is being processed right now, or has been processed recently.
+    """
+    if not deduplicating():
+        return ""
+    from dedup import object_key
+
+    return _claim(object_key(path))
+
+
+def claim_file(user_email: str, fbytes: bytes):
+    """
+    Claim a document for a user by content hash. Returns the claim key, or
+    None if the same document is being delivered to them right now, or was
+    delivered to them recently.
+    """
+    if not deduplicating():
+        return ""
+    from dedup import file_key
+    from users import sanitize_email
+
+    return _claim(file_key(sanitize_email(user_email), fbytes))
+
+
+def delivered_already(message_key: str, files: List[FileTuple]) -> List[bool]:
+    """
+    For each file, whether an earlier attempt at the same message already
+    delivered it (see `checkpoint_delivery`).
+    """
+    if not deduplicating():
+        return [False] * len(files)
+    from dedup import checkpoint_key, marked
+
+    keys = [checkpoint_key(message_key, fbytes) for _, fbytes in files]
+    with tracing.span("checkpoints"):
+        done = marked(keys)
+    return [key in done for key in keys]
+
+
+def checkpoint_delivery(message_key: str, fbytes: bytes) -> None:
+    """
+    Record that a file from this message was delivered, so that a retry of
+    the message only sends the files that didn't make it.
+    """
+    if deduplicating():
+        from dedup import checkpoint_key, mark
+
+        mark(checkpoint_key(message_key, fbytes))
+
+
+def finish_claim(key: str) -> None:
+    """
+    Hold on to a claim (if there is one) for `Config.DEDUP_TTL_SECONDS`,
+    now that the work is done, so that duplicates of it are skipped.
+    """
+    if key:
+        from dedup import mark
+
+        mark(key)
+
+
+def release_claim(key: str) -> None:
+    """
+    Give up a claim (if there is one) so that the work can be retried.
+    """
+    if key:
+        from dedup import release
+
+        release(key)
+
+
+def deliver_files(
+    user_email: str,
+    files: List[FileTuple],
+    message_key: str = None,
+    folder: List[str] = (),
+) -> List[dict]:
+    """
+    Deliver all of the files from one message concurrently.
+
+    Files that an earlier attempt at the same message (`message_key`)
+    already delivered are counted as sent without sending them again, and
+    documents the user already sent recently are skipped, both before we
+    talk to the reMarkable cloud at all. Credentials are looked up once and
+    shared by every upload, and so is the destination `folder` (a path of
+    folder names, created if need be). Each file gets its own result.
+    """
+    done = delivered_already(message_key, files) if message_key else [False] * len(files)
+    workers = max(1, min(getattr(Config, "USER_UPLOAD_CONCURRENCY", 4), len(files)))
+
+    def deliver(i):
+        outcome = deliver_file(user_email, cfg, *files[i], len(files), parent=parent)
+        if outcome["success"]:
+            finish_claim(claims[i])
+            if message_key:
+                checkpoint_delivery(message_key, files[i][1])
+        return outcome
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = [i for i in range(len(files)) if not done[i]]
+        claims = dict(
+            zip(
+                pending,
+                tracing.map_in_context(
+                    pool, lambda i: claim_file(user_email, files[i][1]), pending
+                ),
+            )
+        )
+        outcomes = [
+            {"filename": fname, "success": True}
+            if done[i]
+            else {"filename": fname, "success": True, "duplicate": True}
+            for i, (fname, _) in enumerate(files)
+        ]
+        fresh = []
+        for i, claim in claims.items():
+            if claim is None:
+                plog(f"Skipping {files[i][0]}; {user_email} sent it recently.")
+            else:
+                fresh.append(i)
+
+        if fresh:
+            plog(f"* Asking for {user_email} credentials...")
             try:
-                SendToRemarkableRequestModel(
-                    email=result["sent_from"],
-                    date=datetime.datetime.now().isoformat(),
-                    upload_size=len(fbytes),
-                    success=True,
-                    traceback="",
-                ).save()
-            except Exception as e:
-                plog(f"Encountered exception while logging: {e}")
+                with tracing.span("token"):
+                    cfg = get_valid_config_for_user(user_email)
+                parent = resolve_folder(user_email, cfg, folder) if folder else ""
+            except breaker.CircuitOpenError as e:
+                plog(f"Parking {len(fresh)} files for {user_email}: {e}")
+                parked = {"success": False, "parked": True, "error": str(e)}
+                delivered = [dict(parked, filename=files[i][0]) for i in fresh]
+            except Exception:
+                # Nothing was sent, so a retry must be able to send it all:
+                for i in fresh:
+                    release_claim(claims[i])
+                raise
+            else:
+                delivered = tracing.map_in_context(pool, deliver, fresh)
+            for i, outcome in zip(fresh, delivered):
+                outcomes[i] = outcome
+                if not outcome["success"]:
+                    release_claim(claims[i])
+    return outcomes
+
+
+def resolve_folder(user_email: str, cfg: dict, folder: List[str]) -> str:
+    """
+    The ID of `folder` in the user's cloud (see `folders.FolderCache`). If
+    it can't be found or made, documents go to the root instead.
+    """
+    from rmapy.api import Client
+
+    try:
+        with tracing.span("folder"):
+            return FOLDER_CACHE.resolve(user_email, Client(config_dict=cfg), folder)
+    except breaker.CircuitOpenError:
+        raise
+    except Exception as e:
+        plog(f"ERROR: Couldn't find folder {'/'.join(folder)} for {user_email}: {e}")
+        return ""
 
 
-def transfer_s3_path_to_remarkable(path: str):
+def transfer_s3_path_to_remarkable(path: str, prefetched: Tuple = None):
     """
     Given a path to a file in S3, download the file and transfer it.
+
+    Each object is only processed once per `Config.DEDUP_TTL_SECONDS`, so
+    duplicate S3 notifications are dropped before we download anything.
+    While it's in progress, the object is only claimed for
+    `Config.DEDUP_LEASE_SECONDS`, so a retry can pick it up if we die.
+    `prefetched` is the (headers, size) from `load_headers_from_s3`, if
+    the caller already has them.
+    """
+    key = claim_object(path)
+    if key is None:
+        plog(f"Skipping {path}; it's being processed, or has been already.")
+        return []
+    try:
+        # Control-plane mail (register/unsubscribe) can be handled from the
+        # headers alone, without downloading the rest of the message:
+        headers, size = prefetched or load_headers_from_s3(path)
+        result = None
+        if headers is not None:
+            result = classify_headers(headers) or admit_message(headers, size)
+        if result is None:
+            message = load_email_from_s3(path)
+            with tracing.span("extract"):
+                result = extract_files_from_email(message)
+            # Release the encoded MIME tree before we start uploading the decoded files:
+            del message
+        outcomes = handle_message_result(result, message_key=path)
+    except Exception:
+        release_claim(key)
+        raise
+    if outcomes and not all(o["success"] for o in outcomes):
+        # Let a redelivery retry the files that failed:
+        release_claim(key)
+    else:
+        finish_claim(key)
+    return outcomes
+
+
+def record_path(record: dict) -> str:
+    return record["s3"]["object"]["key"].split("/")[-1]
+
+
+def prefetch_senders(records: List[dict], pool: ThreadPoolExecutor) -> List[Optional[Tuple]]:
+    """
+    Fetch the headers of every record up front, and look up all of the
+    senders with attachments to deliver in one batch.
+
+    Returns the (headers, size) for each record, or None where they
+    couldn't be fetched, to pass on to `transfer_s3_path_to_remarkable`.
+    """
+
+    def fetch(record):
+        try:
+            headers, size = load_headers_from_s3(record_path(record))
+        except Exception:
+            return None
+        return (headers, size) if headers is not None else None
+
+    def deliverable(headers, size) -> bool:
+        # A malformed message is handle_record's to deal with, not ours:
+        try:
+            return (
+                classify_headers(headers) is None
+                and admit_message(headers, size) is None
+            )
+        except Exception:
+            return False
+
+    prefetched = list(pool.map(fetch, records))
+    senders = [
+        headers.get("From")
+        for headers, size in filter(None, prefetched)
+        if headers.get("From") and deliverable(headers, size)
+    ]
+    if senders:
+        try:
+            with tracing.span("users"):
+                resolve_users(senders)
+        except Exception as e:
+            # Each delivery will look its user up on its own instead:
+            plog(f"Failed to resolve senders in bulk: {e}")
+    return prefetched
+
+
+def handle_record(record: dict, prefetched: Tuple = None) -> dict:
+    """
+    Process a single S3 record from a lambda event.
+
+    Failures are caught and reported in the returned dict rather than raised,
+    so that one bad .eml doesn't take down the rest of the batch.
     """
-    message = load_email_from_s3(path)
-    handle_message_result(extract_files_from_email(message))
+    key = None
+    with tracing.traced() as trace:
+        # Until the message is classified; objects that were already
+        # processed never are:
+        trace.set_dimension("status", "SKIPPED")
+        try:
+            with trace.span("total"):
+                key = record["s3"]["object"]["key"]
+                path = key.split("/")[-1]
+                plog(f"Key: {key}")
+                plog(f"Path: {path}")
+                if breaker.REMARKABLE.is_open():
+                    # Don't spend time downloading what we can't deliver:
+                    raise breaker.CircuitOpenError("The reMarkable circuit is open.")
+                outcomes = transfer_s3_path_to_remarkable(path, prefetched) or []
+        except breaker.CircuitOpenError as e:
+            trace.set_dimension("status", "ERROR")
+            plog(f"Parking record {key}: {e}")
+            return {"key": key, "success": False, "parked": True, "error": str(e)}
+        except Exception as e:
+            trace.set_dimension("status", "ERROR")
+            plog(f"ERROR: Failed to process record {key}: {e}")
+            return {"key": key, "success": False, "error": str(e)}
+    if any(o.get("parked") for o in outcomes):
+        return {"key": key, "success": False, "parked": True, "files": outcomes}
+    if not all(o["success"] for o in outcomes):
+        return {"key": key, "success": False, "files": outcomes}
+    return {"key": key, "success": True}
 
 
 def upload_handler(event, context):
     """
     This is the function that is called when an event takes place in lambda.
 
+    Every record in the event is processed, on a pool of at most
+    `Config.RECORD_CONCURRENCY` worker threads (default 4). When there's
+    more than one record, their senders are looked up together first.
+
+    If the reMarkable cloud is degraded (see breaker.py), records are
+    parked: the invocation fails, so that Lambda retries the event later.
+    Records and files that did go through are skipped by the retry.
     """
     try:
         plog(f"Event: {event}")
-        # bucket = event['Records'][0]['s3']['bucket']['name']
-        key = event["Records"][0]["s3"]["object"]["key"]
-        path = key.split("/")[-1]
-        plog(f"Key: {key}")
-        plog(f"Path: {path}")
-        transfer_s3_path_to_remarkable(path)
+        records = event["Records"]
+        workers = max(1, min(getattr(Config, "RECORD_CONCURRENCY", 4), len(records)))
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            prefetched = (
+                prefetch_senders(records, pool) if len(records) > 1 else [None] * len(records)
+            )
+            results = list(pool.map(handle_record, records, prefetched))
     except Exception as e:
         return {"statusCode": 500, "body": f"Failure occurred!"}
+    finally:
+        flush_notifications()
+        flush_analytics()
+
+    parked = sum(1 for r in results if r.get("parked"))
+    if parked and deduplicating():
+        raise breaker.CircuitOpenError(
+            f"Parked {parked} of {len(results)} records until the reMarkable cloud recovers."
+        )
+    succeeded = sum(1 for r in results if r["success"])
+    if results and succeeded == len(results):
+        return {"statusCode": 200, "body": "Success", "results": results}
+    if succeeded:
+        return {"statusCode": 207, "body": "Partial failure", "results": results}
+    return {"statusCode": 500, "body": f"Failure occurred!", "results": results}
+
 
+def notification_handler(event, context):
+    """
+    SQS-triggered entry point that sends the receipt emails queued by
+    `notify` when `Config.NOTIFICATION_QUEUE_URL` is set.
+    """
+    for record in event["Records"]:
+        body = json.loads(record["body"])
+        send_email_if_enabled(to=body["to"], subject=body["subject"], message=body["message"])
     return {"statusCode": 200, "body": "Success"}
 
 
-APP = Flask(__name__)
+def prerenew_handler(event, context):
+    """
+    Scheduled entry point that renews user tokens before they expire, so
+    that upload_handler almost never has to wait on the token endpoint.
+
+    """
+    from users import prerenew_active_users
+
+    counts = prerenew_active_users()
+    plog(f"Pre-renewed tokens: {counts}")
+    return {"statusCode": 200, "body": json.dumps(counts)}
+
 
+def __getattr__(name: str):
+    # The Flask app lives in web.py; keep `lambda_main.APP` working for
+    # existing Zappa configs without importing Flask for every invocation.
+    if name == "APP":
+        from web import APP
 
-@APP.route("/")
-def main():
-    return render_template("index.html")
+        return APP
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
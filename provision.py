@@ -1,7 +1,7 @@
 import sys
-import boto3
 
 from config import Config
+import clients
 
 HELP_MESSAGE = """
 
@@ -10,7 +10,8 @@ Usage: python3 provision.py [COMMAND]
 Commands:
     - help:             Show this message
     - verify-sender:    Verify the email sender in Config.EMAIL_SENDER
-    - create-table:     Create the UserModel table for use via PynamoDB
+    - create-table:     Create the user, analytics, rollup and dedup tables for use via PynamoDB
+    - report:           Print document events as JSON lines. See `provision.py report --help`
 
 """
 
@@ -23,7 +24,7 @@ def help_and_exit():
 def verify_sender_and_exit():
     if not Config.EMAIL_SENDER:
         print("You must specify a sender as Config.EMAIL_SENDER in config.py.")
-    ses = boto3.client("ses", region_name=Config.AWS_REGION)
+    ses = clients.ses()
     response = ses.verify_email_identity(
         EmailAddress=Config.EMAIL_SENDER,
     )
@@ -34,15 +35,112 @@ def verify_sender_and_exit():
 def create_table_and_exit():
     from users import UserModel
     from analytics.SendToRemarkableRequestModel import SendToRemarkableRequestModel
+    from analytics.UsageRollupModel import UsageRollupModel
+    from dedup import DedupModel
 
     if not UserModel.exists():
         UserModel.create_table(wait=True)
     if not SendToRemarkableRequestModel.exists():
         SendToRemarkableRequestModel.create_table(wait=True)
+    else:
+        add_day_index(SendToRemarkableRequestModel)
+    if not UsageRollupModel.exists():
+        UsageRollupModel.create_table(wait=True)
+    if not DedupModel.exists():
+        DedupModel.create_table(wait=True)
     exit(0)
 
 
-if sys.argv[-1] in ["--help", "-h", "help"]:
+def add_day_index(model):
+    """
+    Add the day index to a send-requests table created before it existed.
+    Events logged before then have no day, so only `report --scan` finds them.
+    """
+    dynamodb = clients.get_client("dynamodb")
+    table = dynamodb.describe_table(TableName=model.Meta.table_name)["Table"]
+    index_name = model.day_index.Meta.index_name
+    if any(
+        index["IndexName"] == index_name
+        for index in table.get("GlobalSecondaryIndexes", [])
+    ):
+        return
+    print(f"Adding {index_name} to {model.Meta.table_name}; this can take a while.")
+    dynamodb.update_table(
+        TableName=model.Meta.table_name,
+        AttributeDefinitions=[
+            {"AttributeName": "day", "AttributeType": "S"},
+            {"AttributeName": "date", "AttributeType": "S"},
+        ],
+        GlobalSecondaryIndexUpdates=[
+            {
+                "Create": {
+                    "IndexName": index_name,
+                    "KeySchema": [
+                        {"AttributeName": "day", "KeyType": "HASH"},
+                        {"AttributeName": "date", "KeyType": "RANGE"},
+                    ],
+                    "Projection": {"ProjectionType": "ALL"},
+                }
+            }
+        ],
+    )
+
+
+def report_and_exit(args):
+    import argparse
+    import datetime
+
+    from analytics.report import parallel_scan, parse_time, query_range, write_ndjson
+    from analytics.SendToRemarkableRequestModel import (
+        SendToRemarkableRequestModel as Model,
+    )
+
+    parser = argparse.ArgumentParser(
+        prog="provision.py report",
+        description="Print document events as JSON lines. With --since, the day "
+        "index is queried; otherwise the table is scanned in parallel.",
+    )
+    parser.add_argument("--since", help='like "24h", "7d" or "2021-03-23"')
+    parser.add_argument("--until", help="defaults to now")
+    parser.add_argument("--failures", action="store_true", help="only failed events")
+    parser.add_argument("--email", help="only events from this sender")
+    parser.add_argument("--traceback", help="only events whose traceback contains this")
+    parser.add_argument(
+        "--scan", action="store_true", help="scan even with --since (finds old events)"
+    )
+    parser.add_argument("--segments", type=int, default=8, help="parallel scan workers")
+    options = parser.parse_args(args)
+
+    start = parse_time(options.since) if options.since else None
+    until = parse_time(options.until) if options.until else datetime.datetime.now()
+    conditions = []
+    if options.failures:
+        conditions.append(Model.success == False)  # noqa: E712
+    if options.email:
+        conditions.append(Model.email == options.email)
+    if options.traceback:
+        conditions.append(Model.traceback.contains(options.traceback))
+    if start and options.scan:
+        conditions.append(Model.date.between(start.isoformat(), until.isoformat()))
+    elif options.until and not start:
+        conditions.append(Model.date <= until.isoformat())
+    condition = None
+    for c in conditions:
+        condition = c if condition is None else condition & c
+
+    if start and not options.scan:
+        events = query_range(start, until, condition)
+    else:
+        events = parallel_scan(condition, segments=options.segments)
+    count = write_ndjson(events, sys.stdout)
+    print(f"{count} events", file=sys.stderr)
+    exit(0)
+
+
+if len(sys.argv) > 1 and sys.argv[1] == "report":
+    report_and_exit(sys.argv[2:])
+
+elif sys.argv[-1] in ["--help", "-h", "help"]:
     help_and_exit()
 
 elif sys.argv[-1] in ["verify-sender"]:
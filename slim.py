@@ -0,0 +1,77 @@
+"""
+Make scanned PDFs smaller before they're uploaded: embedded images are
+downsampled to the tablet's resolution and recompressed as JPEGs, and
+objects nothing refers to are dropped.
+
+This needs the optional `pikepdf` and `Pillow` packages, which are only
+imported when a PDF is actually slimmed.
+"""
+import io
+
+# The reMarkable's screen is 1404x1872; pixels past that are never seen.
+MAX_IMAGE_DIMENSION = 1872
+JPEG_QUALITY = 75
+
+
+def slim_pdf(
+    data: bytes, max_dimension: int = MAX_IMAGE_DIMENSION, quality: int = JPEG_QUALITY
+) -> bytes:
+    """
+    Return a smaller version of the PDF in `data`, or `data` itself if it
+    couldn't be made any smaller.
+
+    This runs in a worker process, so it only takes and returns bytes.
+    """
+    import pikepdf
+
+    with pikepdf.open(io.BytesIO(data)) as pdf:
+        seen = set()
+        for page in pdf.pages:
+            for image in page.images.values():
+                if image.objgen in seen:
+                    continue
+                seen.add(image.objgen)
+                _shrink_image(image, max_dimension, quality)
+        pdf.remove_unreferenced_resources()
+        out = io.BytesIO()
+        pdf.save(
+            out,
+            compress_streams=True,
+            recompress_flate=True,
+            object_stream_mode=pikepdf.ObjectStreamMode.generate,
+        )
+    slimmed = out.getvalue()
+    return slimmed if len(slimmed) < len(data) else data
+
+
+def _shrink_image(image, max_dimension: int, quality: int) -> None:
+    import pikepdf
+
+    # Leave anything with transparency or unusual decoding alone:
+    if any(key in image for key in ("/SMask", "/Mask", "/Decode", "/ImageMask")):
+        return
+    try:
+        pil = pikepdf.PdfImage(image).as_pil_image()
+    except Exception:
+        # pikepdf can't decode every filter and colorspace; keep those as-is.
+        return
+    if pil.mode not in ("RGB", "L"):
+        return
+    if max(pil.size) > max_dimension:
+        pil.thumbnail((max_dimension, max_dimension))
+    elif image.get("/Filter") == pikepdf.Name.DCTDecode:
+        # Already a JPEG at a sensible size:
+        return
+
+    out = io.BytesIO()
+    pil.save(out, format="JPEG", quality=quality, optimize=True)
+    if len(out.getvalue()) >= len(image.read_raw_bytes()):
+        return
+    image.write(out.getvalue(), filter=pikepdf.Name.DCTDecode)
+    image.Width, image.Height = pil.size
+    image.ColorSpace = (
+        pikepdf.Name.DeviceRGB if pil.mode == "RGB" else pikepdf.Name.DeviceGray
+    )
+    image.BitsPerComponent = 8
+    if "/DecodeParms" in image:
+        del image["/DecodeParms"]
@@ -0,0 +1,86 @@
+"""
+Upload a reMarkable ZipDocument without ever holding the whole archive in
+memory.
+
+rmapy's `Client.upload` dumps the document into an in-memory zip and then
+PUTs it. Here the zip is written to a pipe as the upload reads from it, so
+the request body is produced incrementally and sent with chunked transfer
+encoding. Beyond the document itself, only about `chunk_size` bytes are
+held at a time.
+"""
+import json
+from typing import Iterator, List
+from zipfile import ZIP_DEFLATED, ZipFile
+
+CHUNK_SIZE = 256 * 1024
+
+
+class _Pipe:
+    """
+    A write-only, unseekable file that keeps what's written until it's
+    drained. ZipFile falls back to streaming mode (data descriptors after
+    each entry) for files like this.
+    """
+
+    def __init__(self):
+        self._chunks: List[bytes] = []
+
+    def write(self, data) -> int:
+        if data:
+            self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self) -> None:
+        pass
+
+    def drain(self) -> Iterator[bytes]:
+        chunks, self._chunks = self._chunks, []
+        return iter(chunks)
+
+
+def iter_zip_document(doc, chunk_size: int = CHUNK_SIZE) -> Iterator[bytes]:
+    """
+    Yield the bytes of the zip archive for `doc` (a ZipDocument with a pdf
+    or epub payload), as they're produced.
+
+    The archive has the same entries `ZipDocument.dump` would write.
+    """
+    pipe = _Pipe()
+    with ZipFile(pipe, "w", ZIP_DEFLATED) as zf:
+        zf.writestr(f"{doc.ID}.content", json.dumps(doc.content))
+        zf.writestr(f"{doc.ID}.pagedata", doc.pagedata)
+        yield from pipe.drain()
+        for ext, payload in (("pdf", doc.pdf), ("epub", doc.epub)):
+            if not payload:
+                continue
+            # A retried upload starts a new generator over the same payload:
+            payload.seek(0)
+            with zf.open(f"{doc.ID}.{ext}", "w") as entry:
+                while True:
+                    chunk = payload.read(chunk_size)
+                    if not chunk:
+                        break
+                    entry.write(chunk)
+                    yield from pipe.drain()
+            payload.seek(0)
+    yield from pipe.drain()
+
+
+def stream_upload(rm, doc, chunk_size: int = CHUNK_SIZE, parent: str = "") -> bool:
+    """
+    Upload `doc` into the folder with ID `parent` (the root by default) of
+    the user's reMarkable cloud, like `rm.upload(doc)` but streaming the
+    archive.
+    """
+    from rmapy.document import Document
+    from rmapy.exceptions import ApiError
+
+    blob_url = rm._upload_request(doc)
+    # requests sends generator bodies with Transfer-Encoding: chunked.
+    response = rm.request("PUT", blob_url, data=iter_zip_document(doc, chunk_size))
+    if not response.ok:
+        raise ApiError("an error occured while uploading the document.", response=response)
+    meta = Document(**doc.metadata)
+    meta.ID = doc.ID
+    meta.Parent = parent
+    return rm.update_metadata(meta)
@@ -0,0 +1,187 @@
+from analytics.AnalyticsSink import AnalyticsSink
+
+
+class FakeConnection:
+    def __init__(self, unprocessed_rounds=0):
+        self.calls = []
+        self.unprocessed_rounds = unprocessed_rounds
+
+    def batch_write_item(self, put_items):
+        self.calls.append(list(put_items))
+        if self.unprocessed_rounds:
+            self.unprocessed_rounds -= 1
+            return {
+                "UnprocessedItems": {
+                    "fake-table": [{"PutRequest": {"Item": put_items[-1]}}]
+                }
+            }
+        return {}
+
+
+def fake_model(connection):
+    class FakeModel:
+        class Meta:
+            table_name = "fake-table"
+
+        def __init__(self, **fields):
+            self.fields = fields
+
+        def serialize(self):
+            return self.fields
+
+        @classmethod
+        def _get_connection(cls):
+            return connection
+
+    return FakeModel
+
+
+def _event(i, email="someone@example.com"):
+    return dict(email=email, date=f"2021-03-23T00:00:0{i}", success=True)
+
+
+def test_sink_buffers_until_flush():
+    connection = FakeConnection()
+    sink = AnalyticsSink(model=fake_model(connection))
+    sink.record(**_event(1))
+    sink.record(**_event(2))
+    assert connection.calls == []
+    sink.flush()
+    assert len(connection.calls) == 1
+    assert len(connection.calls[0]) == 2
+
+
+def test_sink_writes_full_buffers_and_retries_unprocessed():
+    connection = FakeConnection(unprocessed_rounds=1)
+    sink = AnalyticsSink(model=fake_model(connection), buffer_size=2, base_backoff=0)
+    sink.record(**_event(1))
+    sink.record(**_event(2))
+    sink.flush()
+    assert [len(call) for call in connection.calls] == [2, 1]
+
+
+def test_sink_keeps_colliding_keys_distinct():
+    connection = FakeConnection()
+    sink = AnalyticsSink(model=fake_model(connection))
+    sink.record(**_event(1))
+    sink.record(**_event(1))
+    sink.flush()
+    dates = [item["date"] for item in connection.calls[0]]
+    assert len(set(dates)) == 2
+
+
+def test_sink_never_raises():
+    class BrokenModel:
+        def __init__(self, **fields):
+            raise RuntimeError("no table")
+
+    sink = AnalyticsSink(model=BrokenModel)
+    sink.record(**_event(1))
+    sink.flush()
+
+
+def test_record_rollups_coalesces_buckets(monkeypatch):
+    from analytics import rollups
+    from analytics.UsageRollupModel import UsageRollupModel
+
+    updates = {}
+
+    def update(self, actions):
+        updates[(self.granularity, self.bucket)] = [
+            action.values[1].value for action in actions
+        ]
+
+    monkeypatch.setattr(UsageRollupModel, "update", update)
+    rollups.record_rollups(
+        [
+            dict(date="2021-03-23T14:05:00", success=True, upload_size=100),
+            dict(date="2021-03-23T14:59:00", success=False, upload_size=-1),
+            dict(date="2021-03-23T15:00:00", success=True, upload_size=50),
+        ]
+    )
+    assert updates == {
+        ("hour", "2021-03-23T14"): [{"N": "2"}, {"N": "1"}, {"N": "100"}],
+        ("hour", "2021-03-23T15"): [{"N": "1"}, {"N": "1"}, {"N": "50"}],
+        ("day", "2021-03-23"): [{"N": "3"}, {"N": "2"}, {"N": "150"}],
+    }
+
+
+def _request(i, day="2021-03-23"):
+    from analytics.SendToRemarkableRequestModel import SendToRemarkableRequestModel
+
+    return SendToRemarkableRequestModel(
+        "someone@example.com",
+        f"{day}T00:00:{i:02}",
+        day=day,
+        success=i % 2 == 0,
+        traceback="",
+    )
+
+
+def test_parallel_scan_merges_segments():
+    import io
+    import json
+
+    from analytics import report
+
+    class FakeModel:
+        @classmethod
+        def scan(cls, filter_condition, segment, total_segments):
+            return [_request(i) for i in range(segment, 40, total_segments)]
+
+    out = io.StringIO()
+    events = report.parallel_scan(segments=4, model=FakeModel, buffer_size=2)
+    assert report.write_ndjson(events, out) == 40
+    lines = [json.loads(line) for line in out.getvalue().splitlines()]
+    assert sorted(line["date"] for line in lines) == [_request(i).date for i in range(40)]
+
+
+def test_parallel_scan_raises_scanner_errors():
+    import pytest
+
+    from analytics import report
+
+    class BrokenModel:
+        @classmethod
+        def scan(cls, filter_condition, segment, total_segments):
+            if segment == 1:
+                raise RuntimeError("throttled")
+            return [_request(segment)]
+
+    with pytest.raises(RuntimeError):
+        list(report.parallel_scan(segments=2, model=BrokenModel))
+
+
+def test_query_range_queries_one_day_at_a_time():
+    import datetime
+
+    from analytics import report
+    from analytics.SendToRemarkableRequestModel import SendToRemarkableRequestModel
+
+    queried = []
+
+    class FakeIndex:
+        def query(self, day, range_key_condition, filter_condition):
+            queried.append(day)
+            return [_request(1, day)]
+
+    class FakeModel:
+        date = SendToRemarkableRequestModel.date
+        day_index = FakeIndex()
+
+    events = report.query_range(
+        datetime.datetime(2021, 3, 22, 12), datetime.datetime(2021, 3, 24), model=FakeModel
+    )
+    assert [event.day for event in events] == ["2021-03-22", "2021-03-23", "2021-03-24"]
+    assert queried == ["2021-03-22", "2021-03-23", "2021-03-24"]
+
+
+def test_parse_time():
+    import datetime
+
+    from analytics.report import parse_time
+
+    now = datetime.datetime(2021, 3, 23, 12)
+    assert parse_time("24h", now) == datetime.datetime(2021, 3, 22, 12)
+    assert parse_time("7d", now) == datetime.datetime(2021, 3, 16, 12)
+    assert parse_time("2021-03-01", now) == datetime.datetime(2021, 3, 1)
@@ -0,0 +1,127 @@
+import pytest
+
+import breaker
+
+
+class Unavailable(Exception):
+    class response:
+        status_code = 503
+
+
+def test_breaker_opens_after_repeated_failures_and_lets_one_trial_through(monkeypatch):
+    clock = [0.0]
+    monkeypatch.setattr(breaker.time, "monotonic", lambda: clock[0])
+    circuit = breaker.CircuitBreaker("test", failure_threshold=2, cooldown=10)
+    circuit.record_failure()
+    assert circuit.state == "closed"
+    circuit.record_failure()
+    assert circuit.state == "open"
+    with pytest.raises(breaker.CircuitOpenError):
+        circuit.before_call()
+
+    clock[0] = 11
+    circuit.before_call()
+    with pytest.raises(breaker.CircuitOpenError):
+        # Only one trial at a time:
+        circuit.before_call()
+    circuit.record_success()
+    assert circuit.state == "closed"
+
+
+def test_call_retries_retryable_errors(monkeypatch):
+    monkeypatch.setattr(breaker.time, "sleep", lambda seconds: None)
+    circuit = breaker.CircuitBreaker("test", failure_threshold=5)
+    attempts = []
+
+    def flaky():
+        attempts.append(1)
+        if len(attempts) < 3:
+            raise Unavailable()
+        return "ok"
+
+    assert breaker.call(flaky, breaker=circuit, attempts=3) == "ok"
+    assert len(attempts) == 3
+    assert circuit.state == "closed"
+
+
+def test_call_does_not_retry_other_errors():
+    circuit = breaker.CircuitBreaker("test", failure_threshold=1)
+    attempts = []
+
+    def broken():
+        attempts.append(1)
+        raise ValueError("bad document")
+
+    with pytest.raises(ValueError):
+        breaker.call(broken, breaker=circuit, attempts=3)
+    assert len(attempts) == 1
+    assert circuit.state == "closed"
+
+
+def test_retried_rmapy_upload_sends_the_whole_document():
+    import io
+    from zipfile import ZipFile
+
+    import requests
+    from rmapy.api import Client
+
+    import lambda_main
+
+    class Response:
+        ok = True
+
+    class FlakyClient:
+        bodies = []
+
+        # rmapy's own upload, on top of a flaky PUT:
+        upload = Client.upload
+
+        def _upload_request(self, doc):
+            return "https://blob"
+
+        def request(self, method, url, data=None):
+            self.bodies.append(data)
+            if len(self.bodies) == 1:
+                raise requests.ConnectionError("connection reset")
+            return Response()
+
+        def update_metadata(self, meta):
+            return True
+
+    rm = FlakyClient()
+    doc = lambda_main.build_zip_document("paper.pdf", b"%PDF-1.4 hello")
+    breaker.call(
+        lambda_main.upload_document,
+        rm,
+        doc,
+        breaker=breaker.CircuitBreaker("test"),
+        base_delay=0,
+    )
+    with ZipFile(io.BytesIO(rm.bodies[-1])) as zf:
+        assert zf.read(f"{doc.ID}.pdf") == b"%PDF-1.4 hello"
+
+
+def test_token_renewal_errors_are_classified_by_status():
+    from rmapy.exceptions import AuthError
+
+    assert breaker.is_retryable(AuthError("Can't renew token: 503"))
+    assert breaker.is_retryable(AuthError("Can't renew token: 429"))
+    assert not breaker.is_retryable(AuthError("Can't renew token: 401"))
+    assert not breaker.is_retryable(AuthError("Please register a device first"))
+
+
+def test_failed_trial_with_other_error_keeps_the_breaker_open(monkeypatch):
+    clock = [0.0]
+    monkeypatch.setattr(breaker.time, "monotonic", lambda: clock[0])
+    circuit = breaker.CircuitBreaker("test", failure_threshold=1, cooldown=10)
+    circuit.record_failure()
+    clock[0] = 11
+
+    def rejected():
+        raise ValueError("bad request")
+
+    with pytest.raises(ValueError):
+        breaker.call(rejected, breaker=circuit, attempts=1)
+    assert circuit.state == "half-open"
+    # ...and the next caller gets a trial of its own:
+    circuit.before_call()
@@ -0,0 +1,87 @@
+import io
+
+from botocore.response import StreamingBody
+
+import clients
+import lambda_main
+
+
+class FakeS3:
+    def __init__(self, objects):
+        self.objects = objects
+        self.requests = []
+
+    def get_object(self, Bucket, Key):
+        self.requests.append((Bucket, Key))
+        data = self.objects[Key.split("/")[-1]]
+        return {"Body": StreamingBody(io.BytesIO(data), len(data))}
+
+
+def test_clients_are_created_once():
+    created = []
+    clients.set_factory("ses", lambda service: created.append(service) or object())
+    try:
+        assert clients.ses() is clients.ses()
+        assert created == ["ses"]
+    finally:
+        clients.reset()
+
+
+def test_load_email_from_s3_uses_shared_client():
+    with open("./test_data/test_pdf.pdf", "rb") as f:
+        test_pdf_bytes = f.read()
+    with open("./test_data/pdf_one_email.eml", "rb") as f:
+        fake = FakeS3({"pdf_one_email": f.read()})
+    clients.use("s3", fake)
+    try:
+        message = lambda_main.load_email_from_s3("pdf_one_email")
+    finally:
+        clients.reset()
+    [(bucket, key)] = fake.requests
+    assert bucket == lambda_main.Config.BUCKET_NAME
+    assert key.endswith("pdf_one_email")
+    result = lambda_main.extract_files_from_email(message)
+    assert result["extracted_files"] == [("test_pdf.pdf", test_pdf_bytes)]
+
+
+class RangedFakeS3(FakeS3):
+    def get_object(self, Bucket, Key, Range=None):
+        self.requests.append((Bucket, Key, Range))
+        data = self.objects[Key.split("/")[-1]]
+        if Range:
+            first, last = Range[len("bytes=") :].split("-")
+            data = data[int(first) : int(last) + 1]
+        return {"Body": StreamingBody(io.BytesIO(data), len(data))}
+
+
+def _transfer_with_fake_s3(monkeypatch, name):
+    with open(f"./test_data/{name}.eml", "rb") as f:
+        fake = RangedFakeS3({name: f.read()})
+    handled = []
+    monkeypatch.setattr(lambda_main, "claim_object", lambda path: "")
+    monkeypatch.setattr(
+        lambda_main,
+        "handle_message_result",
+        lambda result, message_key=None: handled.append(result),
+    )
+    clients.use("s3", fake)
+    try:
+        lambda_main.transfer_s3_path_to_remarkable(name)
+    finally:
+        clients.reset()
+    return fake.requests, handled[0]
+
+
+def test_control_plane_mail_only_fetches_headers(monkeypatch):
+    requests, result = _transfer_with_fake_s3(monkeypatch, "unsubscribe_email")
+    assert result["status"] == lambda_main.MessageStatus.UNSUBSCRIBE
+    assert [r[2] for r in requests] == [f"bytes=0-{lambda_main.HEADER_FETCH_BYTES - 1}"]
+
+
+def test_mail_with_attachments_fetches_the_body(monkeypatch):
+    requests, result = _transfer_with_fake_s3(monkeypatch, "pdf_one_email")
+    assert result["status"] == lambda_main.MessageStatus.SUCCESS
+    assert [r[2] for r in requests] == [
+        f"bytes=0-{lambda_main.HEADER_FETCH_BYTES - 1}",
+        None,
+    ]
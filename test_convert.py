@@ -0,0 +1,60 @@
+import re
+
+import pytest
+
+import convert
+
+
+def test_text_to_pdf_paginates():
+    pdf = convert.text_to_pdf("\n".join(f"line {i} (with parens)" for i in range(100)))
+    assert pdf.startswith(b"%PDF-1.4")
+    assert pdf.rstrip().endswith(b"%%EOF")
+    assert int(re.search(rb"/Count (\d+)", pdf).group(1)) == -(-100 // convert.ROWS)
+    # Every xref entry points at the object it names:
+    xref = int(re.search(rb"startxref\n(\d+)", pdf).group(1))
+    offsets = re.findall(rb"(\d{10}) 00000 n", pdf[xref:])
+    for number, offset in enumerate(offsets, start=1):
+        assert pdf[int(offset) :].startswith(b"%d 0 obj" % number)
+
+
+def test_html_to_text():
+    markup = "<html><head><style>p {}</style></head><body><h1>Hi</h1><p>A &amp; B</p></body></html>"
+    assert convert.html_to_text(markup) == "Hi\n\nA & B"
+
+
+def test_conversion_cache_is_bounded_by_size():
+    cache = convert.ConversionCache(max_bytes=10)
+    cache.put("a", b"12345")
+    cache.put("b", b"12345")
+    cache.get("a")
+    cache.put("c", b"12345")
+    assert cache.get("b") is None
+    assert cache.get("a") == b"12345"
+
+
+def test_content_key_depends_on_kind_and_text():
+    assert convert.content_key("text", "x") == convert.content_key("text", "x")
+    assert convert.content_key("text", "x") != convert.content_key("html", "x")
+    assert convert.content_key("text", "x") != convert.content_key("text", "y")
+
+
+def test_run_converter_kills_runaway_conversions():
+    import time
+
+    assert convert.run_converter(convert.text_to_pdf, "hi", 10).startswith(b"%PDF")
+    started = time.monotonic()
+    with pytest.raises(TimeoutError):
+        convert.run_converter(_stall, "hi", 0.2)
+    assert time.monotonic() - started < 5
+    with pytest.raises(RuntimeError, match="bad markup"):
+        convert.run_converter(_reject, "hi", 10)
+
+
+def _reject(text):
+    raise ValueError("bad markup")
+
+
+def _stall(text):
+    import time
+
+    time.sleep(60)
@@ -0,0 +1,50 @@
+import datetime
+
+from pynamodb.exceptions import PutError
+
+import dedup
+
+
+class ConditionFailed(Exception):
+    response = {"Error": {"Code": "ConditionalCheckFailedException"}}
+
+
+def test_file_key_is_a_content_hash():
+    a = dedup.file_key("someone@example.com", b"x" * 3000, chunk_size=1024)
+    b = dedup.file_key("someone@example.com", b"x" * 3000)
+    assert a == b
+    assert a != dedup.file_key("someone@example.com", b"y" * 3000)
+    assert a != dedup.file_key("someone.else@example.com", b"x" * 3000)
+
+
+def test_claim_is_refused_when_already_held(monkeypatch):
+    def save(self, condition=None):
+        raise PutError(cause=ConditionFailed())
+
+    monkeypatch.setattr(dedup.DedupModel, "save", save)
+    assert dedup.claim("object#abc") is False
+
+
+def test_claim_fails_open(monkeypatch):
+    def save(self, condition=None):
+        raise PutError(cause=RuntimeError("table's gone"))
+
+    monkeypatch.setattr(dedup.DedupModel, "save", save)
+    assert dedup.claim("object#abc") is True
+
+
+def test_claims_are_leases_until_marked(monkeypatch):
+    saved = []
+
+    def save(self, condition=None):
+        saved.append((self.state, self.expires - datetime.datetime.now(datetime.timezone.utc)))
+
+    monkeypatch.setattr(dedup.Config, "DEDUP_LEASE_SECONDS", 90, raising=False)
+    monkeypatch.setattr(dedup.Config, "DEDUP_TTL_SECONDS", 24 * 60 * 60, raising=False)
+    monkeypatch.setattr(dedup.DedupModel, "save", save)
+    dedup.claim("object#abc")
+    dedup.mark("object#abc")
+    (claimed, lease), (done, ttl) = saved
+    assert (claimed, done) == (dedup.CLAIMED, dedup.DONE)
+    assert 80 < lease.total_seconds() <= 90
+    assert ttl.total_seconds() > 23 * 60 * 60
@@ -178,3 +178,198 @@ def test_extract_files_from_email_multiple(message_with_multiple_attachments, te
 def test_extract_files_from_email_error(message_with_one_attachment, test_pdf):
     # TODO
     assert True
+
+def test_parse_email_stream_matches_whole_file_parse(test_pdf):
+    """
+    Tests that feeding an email to the parser in small chunks
+    yields the same attachments as parsing it all at once.
+    """
+    with open("./test_data/pdf_one_email.eml", "rb") as f:
+        chunks = iter(lambda: f.read(1000), b"")
+        message = lambda_main.parse_email_stream(chunks)
+    result = lambda_main.extract_files_from_email(message)
+    assert result["extracted_files"] == [("test_pdf.pdf", test_pdf)]
+
+def test_iter_base64_chunks_handles_unaligned_slices(test_pdf):
+    import base64
+    encoded = base64.encodebytes(test_pdf).decode("ascii")
+    decoded = b"".join(lambda_main.iter_base64_chunks(encoded, chunk_size=1001))
+    assert decoded == test_pdf
+
+def test_decode_part_holds_one_copy():
+    import base64
+    import email.message
+    import os
+    import tracemalloc
+    data = os.urandom(4 * 1024 * 1024)
+    part = email.message.Message()
+    part["Content-Transfer-Encoding"] = "base64"
+    part.set_payload(base64.encodebytes(data).decode("ascii"))
+    tracemalloc.start()
+    decoded = lambda_main.decode_part(part)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    assert decoded == data
+    # The email package briefly encodes the payload to check it for
+    # surrogates; beyond that, only the decoded bytes are held:
+    assert peak < len(data) * 1.5
+
+def test_build_zip_document_pdf(test_pdf):
+    import zipfile
+    doc = lambda_main.build_zip_document("test_pdf.pdf", test_pdf)
+    assert doc.content["fileType"] == "pdf"
+    assert doc.metadata["VissibleName"] == "test_pdf"
+    doc.dump(doc.zipfile)
+    with zipfile.ZipFile(doc.zipfile) as zf:
+        assert zf.read(f"{doc.ID}.pdf") == test_pdf
+        assert f"{doc.ID}.content" in zf.namelist()
+
+def test_build_zip_document_epub(test_epub):
+    doc = lambda_main.build_zip_document("test_pdf.epub", test_epub)
+    assert doc.content["fileType"] == "epub"
+    assert doc.pdf is None
+    assert doc.epub.read() == test_epub
+
+def test_extract_files_from_email_too_big(monkeypatch, message_with_multiple_attachments):
+    monkeypatch.setattr(lambda_main.Config, "MAX_ATTACHMENT_BYTES", 10000, raising=False)
+    result = lambda_main.extract_files_from_email(message_with_multiple_attachments)
+    assert result["status"] == lambda_main.MessageStatus.FILE_TOO_BIG
+    assert result["oversized_files"] == ["test_pdf.pdf"]
+    assert result["extracted_files"] == []
+
+def test_extract_files_from_email_truncates_oversized(monkeypatch, message_with_multiple_attachments, test_epub):
+    monkeypatch.setattr(lambda_main.Config, "MAX_ATTACHMENT_BYTES", 10000, raising=False)
+    monkeypatch.setattr(lambda_main.Config, "OVERSIZE_POLICY", "truncate", raising=False)
+    result = lambda_main.extract_files_from_email(message_with_multiple_attachments)
+    assert result["status"] == lambda_main.MessageStatus.SUCCESS
+    assert result["oversized_files"] == ["test_pdf.pdf"]
+    assert result["extracted_files"] == [("test_pdf.epub", test_epub)]
+
+def test_estimated_size_of_crlf_mail_is_exact(monkeypatch, test_pdf):
+    data = test_pdf[: len(test_pdf) // 3 * 3 - 1]  # so that it's padded
+    message = _message_with_parts(_attachment(data, "pdf", "paper.pdf"))
+    crlf = email.message_from_bytes(message.as_bytes().replace(b"\n", b"\r\n"))
+    part = crlf.get_payload()[1]
+    assert "\r\n" in part.get_payload()
+    assert lambda_main.estimated_size(part) == len(data)
+    monkeypatch.setattr(lambda_main.Config, "MAX_ATTACHMENT_BYTES", len(data), raising=False)
+    result = lambda_main.extract_files_from_email(crlf)
+    assert result["status"] == lambda_main.MessageStatus.SUCCESS
+    assert result["extracted_files"] == [("paper.pdf", data)]
+
+def test_admit_message_rejects_big_emails(monkeypatch, message_with_one_attachment):
+    monkeypatch.setattr(lambda_main.Config, "MAX_EMAIL_BYTES", 50000, raising=False)
+    assert lambda_main.admit_message(message_with_one_attachment, 40000) is None
+    assert lambda_main.admit_message(message_with_one_attachment, None) is None
+    result = lambda_main.admit_message(message_with_one_attachment, 90287)
+    assert result["status"] == lambda_main.MessageStatus.FILE_TOO_BIG
+
+def test_handle_message_result_too_big(monkeypatch):
+    monkeypatch.setattr(lambda_main, "log_send_request", MagicMock())
+    mock_send_email.reset_mock()
+    lambda_main.handle_message_result(lambda_main.ParseMessageResult(
+        sent_from="Lieu Zheng Hong <lieu@lieuzhenghong.com>",
+        subject="Big",
+        status=lambda_main.MessageStatus.FILE_TOO_BIG,
+        extracted_files=[],
+        oversized_files=["huge.pdf"],
+    ))
+    lambda_main.flush_notifications()
+    assert mock_send_email.call_args.kwargs["subject"] == "Your document is too big :("
+    assert "'huge.pdf'" in mock_send_email.call_args.kwargs["message"]
+
+def _message_with_parts(*parts):
+    from email.mime.multipart import MIMEMultipart
+    from email.mime.text import MIMEText
+    message = MIMEMultipart()
+    message["From"] = "Lieu Zheng Hong <lieu@lieuzhenghong.com>"
+    message["Subject"] = "Documents in disguise"
+    message.attach(MIMEText("Please find attached.", "plain"))
+    for part in parts:
+        message.attach(part)
+    return email.message_from_bytes(message.as_bytes())
+
+def _attachment(data, subtype, filename=None):
+    from email.mime.application import MIMEApplication
+    part = MIMEApplication(data, subtype)
+    if filename:
+        part.add_header("Content-Disposition", "attachment", filename=filename)
+    return part
+
+def test_extract_files_from_email_finds_unlabelled_documents(test_pdf, test_epub):
+    message = _message_with_parts(
+        _attachment(test_pdf, "pdf"),  # no parameters on the Content-Type
+        _attachment(test_pdf, "octet-stream", "paper.pdf"),
+        _attachment(test_epub, "octet-stream", "book.epub"),
+        _attachment(test_pdf, "octet-stream", "scan"),
+        _attachment(b"not a document", "octet-stream", "notes.bin"),
+    )
+    result = lambda_main.extract_files_from_email(message)
+    assert result["status"] == lambda_main.MessageStatus.SUCCESS
+    assert result["extracted_files"] == [
+        ("Remailable_Attachment.pdf", test_pdf),
+        ("paper.pdf", test_pdf),
+        ("book.epub", test_epub),
+        ("scan.pdf", test_pdf),
+    ]
+
+def test_classify_part_sniffs_magic_bytes(test_pdf, test_epub):
+    assert lambda_main.classify_part(_attachment(test_pdf, "octet-stream")) == "pdf"
+    assert lambda_main.classify_part(_attachment(test_epub, "octet-stream")) == "epub"
+    assert lambda_main.classify_part(_attachment(b"plain old bytes", "octet-stream")) is None
+
+@pytest.fixture
+def converting(monkeypatch):
+    import convert
+    monkeypatch.setattr(lambda_main.Config, "CONVERT_DOCUMENTS", True, raising=False)
+    # Convert in this process, so tests can see what converters were called:
+    monkeypatch.setattr(convert, "run_converter", lambda converter, text, timeout: converter(text))
+    convert.CONVERSION_CACHE.clear()
+    yield convert
+    convert.CONVERSION_CACHE.clear()
+
+def test_extract_files_from_email_converts_markdown(converting, test_pdf):
+    from email.mime.text import MIMEText
+    with open("./test_data/test_pdf.md") as f:
+        notes = MIMEText(f.read(), "markdown")
+    notes.add_header("Content-Disposition", "attachment", filename="notes.md")
+    message = _message_with_parts(_attachment(test_pdf, "pdf", "paper.pdf"), notes)
+    result = lambda_main.extract_files_from_email(message)
+    assert result["status"] == lambda_main.MessageStatus.SUCCESS
+    assert [name for name, _ in result["extracted_files"]] == ["paper.pdf", "notes.pdf"]
+    assert result["extracted_files"][1][1].startswith(b"%PDF")
+
+def test_extract_files_from_email_converts_bodies_once(converting, monkeypatch, regular_message):
+    calls = []
+    def render(text):
+        calls.append(text)
+        return b"%PDF-1.4 rendered"
+    monkeypatch.setitem(converting.CONVERTERS, "text", render)
+    first = lambda_main.extract_files_from_email(regular_message)
+    second = lambda_main.extract_files_from_email(regular_message)
+    assert first["status"] == lambda_main.MessageStatus.SUCCESS
+    assert first["extracted_files"] == second["extracted_files"]
+    assert first["extracted_files"][0][1] == b"%PDF-1.4 rendered"
+    assert len(calls) == 1
+
+def _stall(text):
+    import time
+    time.sleep(60)
+    return b"%PDF"
+
+def test_convert_documents_gives_up_after_the_budget(monkeypatch):
+    import time
+    import convert
+    convert.CONVERSION_CACHE.clear()
+    monkeypatch.setattr(lambda_main.Config, "CONVERSION_TIMEOUT", 0.5, raising=False)
+    monkeypatch.setattr(lambda_main.Config, "WORKER_PROCESSES", 1, raising=False)
+    monkeypatch.setitem(convert.CONVERTERS, "html", _stall)
+    started = time.monotonic()
+    converted, failed = lambda_main.convert_documents(
+        [("slow.pdf", "html", "<p>slow</p>"), ("fine.pdf", "text", "fine")]
+    )
+    # The runaway conversion is killed, and the next one still gets its
+    # whole budget even though it had to wait for a worker:
+    assert time.monotonic() - started < 10
+    assert [name for name, _ in converted] == ["fine.pdf"]
+    assert failed == ["slow.pdf"]
@@ -0,0 +1,103 @@
+from types import SimpleNamespace
+from unittest.mock import MagicMock
+
+import lambda_main
+from folders import FolderCache, FolderTree
+
+
+def item(ID, name, parent="", kind="CollectionType"):
+    return SimpleNamespace(ID=ID, VissibleName=name, Parent=parent, Type=kind)
+
+
+class FakeClient:
+    def __init__(self, items=()):
+        self.items = list(items)
+        self.listings = 0
+        self.created = []
+
+    def get_meta_items(self):
+        self.listings += 1
+        return list(self.items)
+
+    def create_folder(self, folder):
+        self.created.append(folder)
+        self.items.append(item(folder.ID, folder.VissibleName, folder.Parent))
+        return True
+
+
+def test_folder_tree_finds_paths_and_whats_missing():
+    tree = FolderTree.from_meta_items(
+        [
+            item("p", "Papers"),
+            item("ml", "ML", parent="p"),
+            item("doc", "ML", parent="p", kind="DocumentType"),
+            item("old", "Papers", parent="trash"),
+        ]
+    )
+    assert tree.find([]) == ("", [])
+    assert tree.find(["papers", "ml"]) == ("ml", [])
+    assert tree.find(["Papers", "ML", "Transformers"]) == ("ml", ["Transformers"])
+    assert tree.find(["Notes", "Daily"]) == ("", ["Notes", "Daily"])
+
+
+def test_folder_cache_lists_once_and_creates_missing_folders():
+    rm = FakeClient([item("p", "Papers")])
+    cache = FolderCache(ttl=60)
+
+    ml = cache.resolve("a@example.com", rm, ["Papers", "ML"])
+    assert [(f.VissibleName, f.Parent) for f in rm.created] == [("ML", "p")]
+    assert ml == rm.created[0].ID
+
+    # The new folder is in the cached tree, so nothing is listed or made:
+    assert cache.resolve("a@example.com", rm, ["papers", "ml"]) == ml
+    assert rm.listings == 1 and len(rm.created) == 1
+
+    cache.invalidate("a@example.com")
+    assert cache.resolve("a@example.com", rm, ["Papers", "ML"]) == ml
+    assert rm.listings == 2
+
+
+def test_folder_cache_drops_locks_when_listing_fails():
+    import pytest
+
+    class Broken(FakeClient):
+        def get_meta_items(self):
+            raise RuntimeError("cloud's down")
+
+    cache = FolderCache(ttl=60)
+    with pytest.raises(RuntimeError):
+        cache.resolve("a@example.com", Broken(), ["Papers"])
+    assert cache._user_locks == {}
+
+
+def test_folder_cache_expires():
+    rm = FakeClient()
+    cache = FolderCache(ttl=0)
+    cache.resolve("a@example.com", rm, [])
+    cache.resolve("a@example.com", rm, [])
+    assert rm.listings == 2
+
+
+def test_subject_picks_the_folder():
+    assert lambda_main.folder_path("Reading to: Papers/ML/") == ["Papers", "ML"]
+    assert lambda_main.folder_path("TO: Notes") == ["Notes"]
+    assert lambda_main.folder_path("Re: tomorrow") == []
+    assert lambda_main.folder_path("Papers") == []
+    assert lambda_main.document_name("Reading to: Papers/ML") == "Reading.pdf"
+
+
+def test_deliveries_go_to_the_folder(monkeypatch):
+    monkeypatch.setattr(lambda_main, "get_valid_config_for_user", lambda email: {})
+    monkeypatch.setattr(lambda_main, "log_send_request", MagicMock())
+    monkeypatch.setattr(lambda_main, "deduplicating", lambda: False)
+    monkeypatch.setattr(lambda_main, "resolve_folder", lambda email, cfg, folder: "/".join(folder))
+    parents = []
+    monkeypatch.setattr(
+        lambda_main,
+        "transfer_file_to_remarkable",
+        lambda user_email, fname, fbytes, cfg=None, parent="": parents.append(parent),
+    )
+    lambda_main.deliver_files(
+        "a@example.com", [("a.pdf", b"a"), ("b.pdf", b"b")], folder=["Papers", "ML"]
+    )
+    assert parents == ["Papers/ML", "Papers/ML"]
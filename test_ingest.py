@@ -0,0 +1,28 @@
+import subprocess
+import sys
+
+
+def test_ingest_does_not_import_heavy_dependencies():
+    """
+    The mail-triggered entry point shouldn't pay for Flask, rmapy,
+    PynamoDB or boto3 at import time.
+    """
+    heavy = ("flask", "rmapy", "pynamodb", "boto3")
+    out = subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            f"import sys, ingest; print([m for m in {heavy!r} if m in sys.modules])",
+        ],
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout
+    assert out.strip() == "[]"
+
+
+def test_lambda_main_still_exposes_app():
+    import lambda_main
+    import web
+
+    assert lambda_main.APP is web.APP
@@ -0,0 +1,29 @@
+import io
+
+import pytest
+
+pikepdf = pytest.importorskip("pikepdf")
+Image = pytest.importorskip("PIL.Image")
+
+import slim
+
+
+def _scanned_pdf(width: int, height: int) -> bytes:
+    image = Image.effect_noise((width, height), 64).convert("RGB")
+    buf = io.BytesIO()
+    image.save(buf, format="PDF", resolution=300)
+    return buf.getvalue()
+
+
+def test_slim_pdf_downsamples_big_images():
+    original = _scanned_pdf(4000, 3000)
+    slimmed = slim.slim_pdf(original)
+    assert len(slimmed) < len(original)
+    with pikepdf.open(io.BytesIO(slimmed)) as pdf:
+        (image,) = pdf.pages[0].images.values()
+        assert max(image.Width, image.Height) <= slim.MAX_IMAGE_DIMENSION
+
+
+def test_slim_pdf_keeps_small_files():
+    original = _scanned_pdf(100, 100)
+    assert len(slim.slim_pdf(original)) <= len(original)
@@ -0,0 +1,95 @@
+import io
+import os
+from zipfile import ZipFile
+
+import lambda_main
+import streaming
+
+
+def test_iter_zip_document_matches_dump():
+    payload = os.urandom(300 * 1024)
+    doc = lambda_main.build_zip_document("paper.pdf", payload)
+    chunks = list(streaming.iter_zip_document(doc, chunk_size=16 * 1024))
+    assert len(chunks) > 10
+    # Nothing near the size of the document is ever buffered at once:
+    assert max(len(chunk) for chunk in chunks) < 64 * 1024
+
+    with ZipFile(io.BytesIO(b"".join(chunks))) as streamed:
+        assert streamed.read(f"{doc.ID}.pdf") == payload
+        names = sorted(streamed.namelist())
+    dumped = io.BytesIO()
+    doc.dump(dumped)
+    with ZipFile(dumped) as whole:
+        assert sorted(whole.namelist()) == names
+
+
+def test_stream_upload_puts_a_generator_and_updates_metadata():
+    class Response:
+        ok = True
+
+    class FakeClient:
+        def _upload_request(self, doc):
+            return "https://blob"
+
+        def request(self, method, url, data=None):
+            self.put = (method, url, b"".join(data))
+            return Response()
+
+        def update_metadata(self, meta):
+            self.meta = meta
+            return True
+
+    rm = FakeClient()
+    doc = lambda_main.build_zip_document("book.epub", b"PK epub bytes")
+    assert streaming.stream_upload(rm, doc)
+    method, url, body = rm.put
+    assert (method, url) == ("PUT", "https://blob")
+    with ZipFile(io.BytesIO(body)) as zf:
+        assert zf.read(f"{doc.ID}.epub") == b"PK epub bytes"
+    assert rm.meta.ID == doc.ID
+    assert rm.meta.VissibleName == "book"
+
+
+def test_retried_stream_upload_sends_the_whole_document():
+    import requests
+
+    import breaker
+
+    class Response:
+        ok = True
+
+    class FlakyClient:
+        attempts = 0
+
+        def _upload_request(self, doc):
+            return "https://blob"
+
+        def request(self, method, url, data=None):
+            self.attempts += 1
+            if self.attempts == 1:
+                sent = 0
+                for chunk in data:
+                    sent += len(chunk)
+                    if sent > 512 * 1024:
+                        break
+                raise requests.ConnectionError("connection reset")
+            self.body = b"".join(data)
+            return Response()
+
+        def update_metadata(self, meta):
+            return True
+
+    payload = os.urandom(1024 * 1024)
+    rm = FlakyClient()
+    doc = lambda_main.build_zip_document("paper.pdf", payload)
+    breaker.call(
+        streaming.stream_upload,
+        rm,
+        doc,
+        chunk_size=64 * 1024,
+        breaker=breaker.CircuitBreaker("test"),
+        base_delay=0,
+    )
+    assert rm.attempts == 2
+    with ZipFile(io.BytesIO(rm.body)) as zf:
+        assert zf.read(f"{doc.ID}.pdf") == payload
@@ -0,0 +1,55 @@
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+import lambda_main
+import tracing
+
+
+def test_trace_emits_emf(capsys):
+    with tracing.traced(enabled=True) as trace:
+        trace.set_dimension("status", "SUCCESS")
+        with tracing.span("upload"):
+            pass
+        with tracing.span("upload"):
+            pass
+        with tracing.span("extract"):
+            pass
+    record = json.loads(capsys.readouterr().out)
+    metrics = record["_aws"]["CloudWatchMetrics"][0]
+    assert metrics["Dimensions"] == [["status"]]
+    assert [m["Name"] for m in metrics["Metrics"]] == ["extract_ms", "upload_ms"]
+    assert record["status"] == "SUCCESS"
+    assert len(record["upload_ms"]) == 2
+    assert isinstance(record["extract_ms"], float)
+
+
+def test_noop_trace_emits_nothing(capsys):
+    with tracing.traced(enabled=False) as trace:
+        with tracing.span("upload"):
+            pass
+    assert trace is tracing.NOOP_TRACE
+    assert capsys.readouterr().out == ""
+
+
+def test_map_in_context_shares_the_trace_with_workers():
+    def work(i):
+        with tracing.span("work"):
+            return i
+
+    with tracing.traced(enabled=True) as trace:
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            assert tracing.map_in_context(pool, work, [1, 2, 3]) == [1, 2, 3]
+    assert len(trace.durations["work"]) == 3
+
+
+def test_handle_record_emits_one_metric_line(monkeypatch, capsys):
+    monkeypatch.setattr(tracing.Config, "EMIT_METRICS", True, raising=False)
+    monkeypatch.setattr(
+        lambda_main, "transfer_s3_path_to_remarkable", lambda path, prefetched=None: []
+    )
+    lambda_main.handle_record({"s3": {"object": {"key": "attachments/one"}}})
+    lines = [l for l in capsys.readouterr().out.splitlines() if l.startswith("{")]
+    assert len(lines) == 1
+    metrics = json.loads(lines[0])
+    assert "total_ms" in metrics
+    assert metrics["status"] != "ERROR"
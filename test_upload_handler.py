@@ -0,0 +1,334 @@
+import pytest
+
+import clients
+import lambda_main
+
+
+def _event(*keys):
+    return {"Records": [{"s3": {"object": {"key": key}}} for key in keys]}
+
+
+def test_upload_handler_processes_every_record(monkeypatch):
+    seen = []
+    monkeypatch.setattr(lambda_main, "load_headers_from_s3", lambda path: (None, None))
+    monkeypatch.setattr(
+        lambda_main,
+        "transfer_s3_path_to_remarkable",
+        lambda path, prefetched=None: seen.append(path),
+    )
+    response = lambda_main.upload_handler(
+        _event("attachments/one", "attachments/two", "attachments/three"), None
+    )
+    assert response["statusCode"] == 200
+    assert sorted(seen) == ["one", "three", "two"]
+    assert all(r["success"] for r in response["results"])
+
+
+def test_upload_handler_isolates_failures(monkeypatch):
+    def transfer(path, prefetched=None):
+        if path == "bad":
+            raise ValueError("not an email")
+
+    monkeypatch.setattr(lambda_main, "load_headers_from_s3", lambda path: (None, None))
+    monkeypatch.setattr(lambda_main, "transfer_s3_path_to_remarkable", transfer)
+    response = lambda_main.upload_handler(_event("attachments/good", "attachments/bad"), None)
+    assert response["statusCode"] == 207
+    assert response["results"] == [
+        {"key": "attachments/good", "success": True},
+        {"key": "attachments/bad", "success": False, "error": "not an email"},
+    ]
+
+
+def test_upload_handler_resolves_senders_together(monkeypatch):
+    from email.message import Message
+
+    def headers(path):
+        message = Message()
+        message["From"] = f"{path}@example.com"
+        if path != "nosubject":
+            message["Subject"] = "Papers"
+        message["Content-Type"] = "multipart/mixed"
+        return message, 1000
+
+    resolved = []
+    transferred = {}
+    monkeypatch.setattr(lambda_main, "load_headers_from_s3", headers)
+    monkeypatch.setattr(lambda_main, "resolve_users", resolved.append)
+    monkeypatch.setattr(
+        lambda_main,
+        "transfer_s3_path_to_remarkable",
+        lambda path, prefetched=None: transferred.update({path: prefetched}),
+    )
+    response = lambda_main.upload_handler(
+        _event("attachments/a", "attachments/nosubject", "attachments/b"), None
+    )
+    assert response["statusCode"] == 200
+    assert resolved == [["a@example.com", "b@example.com"]]
+    assert transferred["a"][0]["From"] == "a@example.com"
+    # A malformed message doesn't stop the others; it's handled on its own:
+    assert "nosubject" in transferred
+
+
+def test_upload_handler_all_failed(monkeypatch):
+    def transfer(path, prefetched=None):
+        raise ValueError("nope")
+
+    monkeypatch.setattr(lambda_main, "transfer_s3_path_to_remarkable", transfer)
+    response = lambda_main.upload_handler(_event("attachments/bad"), None)
+    assert response["statusCode"] == 500
+
+
+def test_upload_handler_malformed_event():
+    assert lambda_main.upload_handler({}, None)["statusCode"] == 500
+
+
+def test_handle_message_result_delivers_files_independently(monkeypatch):
+    from unittest.mock import MagicMock
+
+    renewals = []
+    sent = MagicMock()
+    monkeypatch.setattr(
+        lambda_main,
+        "get_valid_config_for_user",
+        lambda email: renewals.append(email) or {"usertoken": "t"},
+    )
+    monkeypatch.setattr(lambda_main, "log_send_request", MagicMock())
+    monkeypatch.setattr(lambda_main, "deduplicating", lambda: False)
+    monkeypatch.setattr(lambda_main, "send_email_if_enabled", sent)
+
+    def transfer(user_email, fname, fbytes, cfg=None, parent=""):
+        assert cfg == {"usertoken": "t"}
+        if fname == "broken.pdf":
+            raise RuntimeError("upload failed")
+
+    monkeypatch.setattr(lambda_main, "transfer_file_to_remarkable", transfer)
+    outcomes = lambda_main.handle_message_result(
+        lambda_main.ParseMessageResult(
+            sent_from="someone@example.com",
+            subject="Papers",
+            status=lambda_main.MessageStatus.SUCCESS,
+            extracted_files=[("a.pdf", b"a"), ("broken.pdf", b"b"), ("c.pdf", b"c")],
+        )
+    )
+    lambda_main.flush_notifications()
+    assert renewals == ["someone@example.com"]
+    assert [o["success"] for o in outcomes] == [True, False, True]
+    sent.assert_called_once()
+    assert sent.call_args.kwargs["subject"] == "Some of your documents couldn't be sent :("
+    assert "broken.pdf" in sent.call_args.kwargs["message"]
+
+
+def test_delivery_summary():
+    subject, message = lambda_main.delivery_summary(
+        [
+            {"filename": "a.pdf", "success": True},
+            {"filename": "again.pdf", "success": True, "duplicate": True},
+        ]
+    )
+    assert subject == "Your documents are on the way!"
+    assert "a.pdf" in message and "again.pdf" in message
+
+    subject, _ = lambda_main.delivery_summary([{"filename": "a.pdf", "success": True}])
+    assert subject == "Your document is on the way!"
+
+    subject, message = lambda_main.delivery_summary(
+        [{"filename": "a.pdf", "success": False}], ["huge.pdf"]
+    )
+    assert subject == "A problem with your document :("
+    assert "huge.pdf" in message
+
+
+def test_notifications_go_to_queue_when_configured(monkeypatch):
+    import json
+    from unittest.mock import MagicMock
+
+    sqs = MagicMock()
+    sent = MagicMock()
+    monkeypatch.setattr(lambda_main.Config, "NOTIFICATION_QUEUE_URL", "https://queue", raising=False)
+    monkeypatch.setattr(lambda_main, "send_email_if_enabled", sent)
+    clients.use("sqs", sqs)
+    try:
+        lambda_main.notify("someone@example.com", "Hi", "There")
+        lambda_main.flush_notifications()
+    finally:
+        clients.reset()
+    sent.assert_not_called()
+    body = sqs.send_message.call_args.kwargs["MessageBody"]
+
+    lambda_main.notification_handler({"Records": [{"body": body}]}, None)
+    sent.assert_called_once_with(to="someone@example.com", subject="Hi", message="There")
+    assert json.loads(body)["to"] == "someone@example.com"
+
+
+def test_deliver_files_skips_recent_duplicates(monkeypatch):
+    from unittest.mock import MagicMock
+
+    seen = set()
+    released = []
+    finished = []
+
+    def claim_file(user_email, fbytes):
+        if fbytes in seen:
+            return None
+        seen.add(fbytes)
+        return fbytes.decode()
+
+    def transfer(user_email, fname, fbytes, cfg=None, parent=""):
+        if fname == "broken.pdf":
+            raise RuntimeError("upload failed")
+
+    monkeypatch.setattr(lambda_main, "claim_file", claim_file)
+    monkeypatch.setattr(lambda_main, "finish_claim", finished.append)
+    monkeypatch.setattr(lambda_main, "release_claim", released.append)
+    monkeypatch.setattr(lambda_main, "get_valid_config_for_user", lambda email: {})
+    monkeypatch.setattr(lambda_main, "transfer_file_to_remarkable", transfer)
+    monkeypatch.setattr(lambda_main, "log_send_request", MagicMock())
+    monkeypatch.setattr(lambda_main, "send_email_if_enabled", MagicMock())
+
+    outcomes = lambda_main.deliver_files(
+        "someone@example.com",
+        [("a.pdf", b"a"), ("again.pdf", b"a"), ("broken.pdf", b"b")],
+    )
+    assert outcomes[0] == {"filename": "a.pdf", "success": True}
+    assert outcomes[1] == {"filename": "again.pdf", "success": True, "duplicate": True}
+    assert not outcomes[2]["success"]
+    assert finished == ["a"]
+    assert released == ["b"]
+
+
+def test_deliver_files_releases_claims_when_credentials_fail(monkeypatch):
+    released = []
+
+    def unregistered(email):
+        raise KeyError(email)
+
+    monkeypatch.setattr(lambda_main, "claim_file", lambda user_email, fbytes: fbytes.decode())
+    monkeypatch.setattr(lambda_main, "release_claim", released.append)
+    monkeypatch.setattr(lambda_main, "get_valid_config_for_user", unregistered)
+
+    with pytest.raises(KeyError):
+        lambda_main.deliver_files("someone@example.com", [("a.pdf", b"a"), ("b.pdf", b"b")])
+    assert sorted(released) == ["a", "b"]
+
+
+def test_transfer_skips_claimed_objects(monkeypatch):
+    monkeypatch.setattr(lambda_main, "claim_object", lambda path: None)
+
+    def load(path):
+        raise AssertionError("should not download a claimed object")
+
+    monkeypatch.setattr(lambda_main, "load_email_from_s3", load)
+    assert lambda_main.transfer_s3_path_to_remarkable("already-seen") == []
+
+
+def test_deliver_file_slims_big_pdfs(monkeypatch):
+    from concurrent.futures import ThreadPoolExecutor
+    from unittest.mock import MagicMock
+    import slim
+
+    uploaded = []
+    logged = MagicMock()
+    monkeypatch.setattr(lambda_main.Config, "SLIM_PDFS", True, raising=False)
+    monkeypatch.setattr(lambda_main.Config, "SLIM_PDF_THRESHOLD", 10, raising=False)
+    monkeypatch.setattr(lambda_main, "worker_pool", lambda: ThreadPoolExecutor(1))
+    monkeypatch.setattr(slim, "slim_pdf", lambda data: data[:4])
+    monkeypatch.setattr(lambda_main, "log_send_request", logged)
+    monkeypatch.setattr(
+        lambda_main,
+        "transfer_file_to_remarkable",
+        lambda user_email, fname, fbytes, cfg=None, parent="": uploaded.append(fbytes),
+    )
+
+    lambda_main.deliver_file("someone@example.com", {}, "scan.pdf", b"%PDF" + b"x" * 20)
+    lambda_main.deliver_file("someone@example.com", {}, "small.pdf", b"%PDF")
+    assert uploaded == [b"%PDF", b"%PDF"]
+    assert [c.kwargs["bytes_saved"] for c in logged.call_args_list] == [20, None]
+    assert logged.call_args_list[0].kwargs["upload_size"] == 24
+
+
+def test_slim_document_sends_original_on_failure(monkeypatch):
+    from concurrent.futures import ThreadPoolExecutor
+    import slim
+
+    def broken(data):
+        raise ValueError("not a PDF")
+
+    monkeypatch.setattr(lambda_main.Config, "SLIM_PDFS", True, raising=False)
+    monkeypatch.setattr(lambda_main.Config, "SLIM_PDF_THRESHOLD", 1, raising=False)
+    monkeypatch.setattr(lambda_main, "worker_pool", lambda: ThreadPoolExecutor(1))
+    monkeypatch.setattr(slim, "slim_pdf", broken)
+    assert lambda_main.slim_document("scan.pdf", b"%PDF-1.4") == (b"%PDF-1.4", 0)
+
+
+def test_deliver_files_resumes_from_checkpoints(monkeypatch):
+    from unittest.mock import MagicMock
+
+    checkpoints = {b"a"}
+    uploaded = []
+    monkeypatch.setattr(lambda_main, "deduplicating", lambda: False)
+    monkeypatch.setattr(
+        lambda_main,
+        "delivered_already",
+        lambda message_key, files: [f[1] in checkpoints for f in files],
+    )
+    monkeypatch.setattr(
+        lambda_main, "checkpoint_delivery", lambda message_key, fbytes: checkpoints.add(fbytes)
+    )
+    monkeypatch.setattr(lambda_main, "get_valid_config_for_user", lambda email: {})
+    monkeypatch.setattr(lambda_main, "log_send_request", MagicMock())
+    monkeypatch.setattr(
+        lambda_main,
+        "transfer_file_to_remarkable",
+        lambda user_email, fname, fbytes, cfg=None, parent="": uploaded.append(fname),
+    )
+
+    outcomes = lambda_main.deliver_files(
+        "someone@example.com", [("a.pdf", b"a"), ("b.pdf", b"b")], message_key="msg"
+    )
+    assert outcomes == [
+        {"filename": "a.pdf", "success": True},
+        {"filename": "b.pdf", "success": True},
+    ]
+    assert uploaded == ["b.pdf"]
+    assert checkpoints == {b"a", b"b"}
+
+
+def test_upload_handler_parks_records_while_the_circuit_is_open(monkeypatch):
+    import pytest
+    import breaker
+
+    def transfer(path, prefetched=None):
+        raise AssertionError("shouldn't process records while the circuit is open")
+
+    monkeypatch.setattr(lambda_main, "deduplicating", lambda: True)
+    monkeypatch.setattr(lambda_main, "transfer_s3_path_to_remarkable", transfer)
+    monkeypatch.setattr(breaker.REMARKABLE, "is_open", lambda: True)
+    with pytest.raises(breaker.CircuitOpenError):
+        lambda_main.upload_handler(_event("attachments/one"), None)
+
+
+def test_user_upload_slots_cap_concurrency_and_are_dropped_when_idle(monkeypatch):
+    import threading
+    import time
+
+    monkeypatch.setattr(lambda_main.Config, "USER_UPLOAD_CONCURRENCY", 2, raising=False)
+    active = []
+    peak = []
+    lock = threading.Lock()
+
+    def upload():
+        with lambda_main.user_upload_slot("someone@example.com"):
+            with lock:
+                active.append(1)
+                peak.append(len(active))
+            time.sleep(0.01)
+            with lock:
+                active.pop()
+
+    threads = [threading.Thread(target=upload) for _ in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert max(peak) == 2
+    assert lambda_main._user_slots == {}
@@ -0,0 +1,127 @@
+import base64
+import json
+import time
+
+import users
+
+
+def _jwt(exp):
+    payload = base64.urlsafe_b64encode(json.dumps({"exp": exp}).encode()).rstrip(b"=")
+    return f"header.{payload.decode()}.signature"
+
+
+class FakeUser:
+    def __init__(self, expires, last_used=None):
+        self.email = "remailable@getneutrality.org"
+        self.device = "device"
+        self.user = _jwt(expires)
+        self.user_expires = expires
+        self.last_used = time.time() if last_used is None else last_used
+        self.updates = []
+
+    def update(self, actions):
+        self.updates.append(actions)
+
+
+def test_token_expiry():
+    assert users.token_expiry(_jwt(1234)) == 1234
+    assert users.token_expiry("not-a-jwt") is None
+
+
+def test_token_cache_is_lru():
+    cache = users.TokenCache(max_size=2)
+    cache.put("a", {}, 1)
+    cache.put("b", {}, 1)
+    cache.get("a")
+    cache.put("c", {}, 1)
+    assert cache.get("b") is None
+    assert cache.get("a") is not None
+
+
+def test_unknown_senders_leave_no_locks_behind(monkeypatch):
+    import pytest
+
+    def get(email):
+        raise users.UserModel.DoesNotExist()
+
+    monkeypatch.setattr(users.UserModel, "get", get)
+    cache = users.TokenCache()
+    lookup = users.UserLookerUpper(cache=cache)
+    with pytest.raises(Exception):
+        lookup.get_valid_config("stranger@example.com")
+    assert cache._user_locks == {}
+
+
+def test_get_valid_config_skips_renewal_for_fresh_tokens(monkeypatch):
+    user = FakeUser(time.time() + 3600)
+    lookups = []
+
+    def get(email):
+        lookups.append(email)
+        return user
+
+    monkeypatch.setattr(users.UserModel, "get", get)
+    monkeypatch.setattr(users.UserModel, "update", lambda self, **kw: user.updates.append(kw))
+    lookup = users.UserLookerUpper(cache=users.TokenCache())
+    first = lookup.get_valid_config(user.email)
+    second = lookup.get_valid_config(user.email)
+    assert first == second == {"devicetoken": "device", "usertoken": user.user}
+    assert lookups == [user.email]
+    assert user.updates == []
+
+
+def test_get_valid_config_records_activity_now_and_then(monkeypatch):
+    user = FakeUser(time.time() + 3600, last_used=time.time() - 7 * 24 * 60 * 60)
+    monkeypatch.setattr(users.UserModel, "get", lambda email: user)
+    monkeypatch.setattr(users.UserModel, "update", lambda self, **kw: user.updates.append(kw))
+    lookup = users.UserLookerUpper(cache=users.TokenCache())
+    lookup.get_valid_config(user.email)
+    lookup.get_valid_config(user.email)
+    assert len(user.updates) == 1
+    assert user.updates[0]["actions"][0].values[0].path == ["last_used"]
+
+
+def test_get_valid_config_renews_expiring_tokens(monkeypatch):
+    user = FakeUser(time.time() + 10)
+    fresh = {"devicetoken": "device", "usertoken": _jwt(time.time() + 3600)}
+
+    class FakeClient:
+        def __init__(self, config_dict):
+            pass
+
+        def renew_token(self, save_to_file):
+            return fresh
+
+    def update(self, actions, condition=None):
+        user.updates.append((self.email, condition))
+
+    monkeypatch.setattr(users.UserModel, "get", lambda email: user)
+    monkeypatch.setattr(users.UserModel, "update", update)
+    monkeypatch.setattr("rmapy.api.Client", FakeClient)
+    lookup = users.UserLookerUpper(cache=users.TokenCache())
+    assert lookup.get_valid_config(user.email) == fresh
+    assert lookup.get_valid_config(user.email) == fresh
+    assert len(user.updates) == 1
+    assert user.updates[0][0] == user.email
+
+
+def test_resolve_users_batches_lookups(monkeypatch):
+    user = FakeUser(time.time() + 3600)
+    batches = []
+
+    def batch_get(keys):
+        batches.append(sorted(keys))
+        return [user] if user.email in keys else []
+
+    def get(email):
+        raise AssertionError("resolved users shouldn't be read again")
+
+    monkeypatch.setattr(users.UserModel, "batch_get", batch_get)
+    monkeypatch.setattr(users.UserModel, "get", get)
+    lookup = users.UserLookerUpper(cache=users.TokenCache())
+    found = lookup.resolve_users(
+        [f"Jordan <{user.email}>", user.email, "nobody@example.com"]
+    )
+    assert found == {user.email: {"devicetoken": "device", "usertoken": user.user}}
+    assert batches == [["nobody@example.com", user.email]]
+    assert lookup.get_valid_config(user.email) == found[user.email]
@@ -0,0 +1,73 @@
+import pytest
+
+import web
+
+
+@pytest.fixture
+def api(monkeypatch):
+    monkeypatch.setattr(web.Config, "STATS_API_TOKEN", "secret", raising=False)
+    web.STATS_CACHE.clear()
+    yield web.APP.test_client()
+    web.STATS_CACHE.clear()
+
+
+AUTH = {"Authorization": "Bearer secret"}
+
+
+def test_stats_need_a_token(api, monkeypatch):
+    assert api.get("/api/stats/failure-rate").status_code == 401
+    monkeypatch.setattr(web.Config, "STATS_API_TOKEN", None)
+    assert api.get("/api/stats/failure-rate", headers=AUTH).status_code == 404
+
+
+def test_failure_rate_is_cached_with_etags(api, monkeypatch):
+    from analytics import rollups
+
+    reads = []
+
+    def get_usage(granularity, start, end):
+        reads.append(granularity)
+        return [
+            {"bucket": "2021-03-23T14", "requests": 3, "successes": 2, "failures": 1, "upload_bytes": 10},
+            {"bucket": "2021-03-23T15", "requests": 1, "successes": 1, "failures": 0, "upload_bytes": 5},
+        ]
+
+    monkeypatch.setattr(rollups, "get_usage", get_usage)
+    response = api.get("/api/stats/failure-rate?hours=2", headers=AUTH)
+    assert response.status_code == 200
+    assert response.get_json() == {
+        "hours": 2,
+        "requests": 4,
+        "failures": 1,
+        "failure_rate": 0.25,
+    }
+
+    etag = response.headers["ETag"]
+    again = api.get(
+        "/api/stats/failure-rate?hours=2", headers=dict(AUTH, **{"If-None-Match": etag})
+    )
+    assert again.status_code == 304
+    assert reads == ["hour"]
+
+    api.get("/api/stats/throughput?granularity=day&periods=7", headers=AUTH)
+    assert reads == ["hour", "day"]
+
+
+def test_bad_arguments_are_rejected(api):
+    assert api.get("/api/stats/throughput?granularity=week", headers=AUTH).status_code == 400
+    assert api.get("/api/stats/failure-rate?hours=0", headers=AUTH).status_code == 400
+
+
+def test_deliveries_are_looked_up_by_bare_address(api, monkeypatch):
+    from analytics.SendToRemarkableRequestModel import SendToRemarkableRequestModel
+
+    queried = []
+
+    def query(email, scan_index_forward=True, limit=None):
+        queried.append(email)
+        return []
+
+    monkeypatch.setattr(SendToRemarkableRequestModel, "query", query)
+    response = api.get("/api/users/Jordan M <jordan@example.com>/deliveries", headers=AUTH)
+    assert response.get_json()["email"] == "jordan@example.com"
+    assert queried == ["jordan@example.com"]
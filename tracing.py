@@ -0,0 +1,130 @@
+"""
+Per-stage timing for the delivery pipeline, emitted as CloudWatch Embedded
+Metric Format (EMF) JSON.
+
+Each message gets a Trace (see `traced()`), and code anywhere below it
+times a stage with `with tracing.span("upload"): ...`. When the message is
+done, one EMF line is printed to stdout, which CloudWatch Logs turns into
+metrics with the trace's dimensions (message status, attachment count).
+
+With `Config.EMIT_METRICS` off (the default), `traced()` installs a no-op
+trace whose spans are a shared nullcontext, so instrumentation costs next
+to nothing.
+"""
+import contextlib
+import contextvars
+import json
+import threading
+import time
+from typing import Dict, List
+
+from config import Config
+
+NAMESPACE = "Remailable"
+
+
+class Trace:
+    def __init__(self, namespace: str = NAMESPACE):
+        self.namespace = namespace
+        self.dimensions: Dict[str, str] = {}
+        self.durations: Dict[str, List[float]] = {}
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def span(self, stage: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, (time.perf_counter() - start) * 1000)
+
+    def add(self, stage: str, milliseconds: float) -> None:
+        with self._lock:
+            self.durations.setdefault(stage, []).append(milliseconds)
+
+    def set_dimension(self, name: str, value) -> None:
+        self.dimensions[name] = str(value)
+
+    def to_emf(self) -> dict:
+        with self._lock:
+            durations = {stage: list(values) for stage, values in self.durations.items()}
+        record = {
+            "_aws": {
+                "Timestamp": int(time.time() * 1000),
+                "CloudWatchMetrics": [
+                    {
+                        "Namespace": self.namespace,
+                        "Dimensions": [sorted(self.dimensions)],
+                        "Metrics": [
+                            {"Name": f"{stage}_ms", "Unit": "Milliseconds"}
+                            for stage in sorted(durations)
+                        ],
+                    }
+                ],
+            },
+            **self.dimensions,
+        }
+        for stage, values in durations.items():
+            # EMF accepts a list of values for stages that ran more than once:
+            record[f"{stage}_ms"] = values[0] if len(values) == 1 else values
+        return record
+
+    def emit(self) -> None:
+        print(json.dumps(self.to_emf()))
+
+
+class NoopTrace:
+    _span = contextlib.nullcontext()
+
+    def span(self, stage: str):
+        return self._span
+
+    def add(self, stage: str, milliseconds: float) -> None:
+        pass
+
+    def set_dimension(self, name: str, value) -> None:
+        pass
+
+    def emit(self) -> None:
+        pass
+
+
+NOOP_TRACE = NoopTrace()
+
+_current = contextvars.ContextVar("remailable_trace", default=NOOP_TRACE)
+
+
+def current_trace():
+    return _current.get()
+
+
+def span(stage: str):
+    """
+    Time a stage against the current trace.
+    """
+    return _current.get().span(stage)
+
+
+@contextlib.contextmanager
+def traced(enabled: bool = None):
+    """
+    Run the block under a new trace, and emit it at the end.
+    """
+    if enabled is None:
+        enabled = getattr(Config, "EMIT_METRICS", False)
+    trace = Trace() if enabled else NOOP_TRACE
+    token = _current.set(trace)
+    try:
+        yield trace
+    finally:
+        _current.reset(token)
+        trace.emit()
+
+
+def map_in_context(pool, fn, items) -> list:
+    """
+    Like `pool.map`, but each call runs in a copy of the caller's context,
+    so that worker threads see the current trace.
+    """
+    futures = [pool.submit(contextvars.copy_context().run, fn, item) for item in items]
+    return [future.result() for future in futures]
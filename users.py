@@ -1,12 +1,20 @@
+import base64
+import contextlib
+import functools
+import json
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Iterable, Optional
+
 from pynamodb.models import Model
-from pynamodb.attributes import UnicodeAttribute
+from pynamodb.attributes import UnicodeAttribute, NumberAttribute
 from pynamodb.constants import PAY_PER_REQUEST_BILLING_MODE
+from pynamodb.exceptions import UpdateError
 
-# remarkable imports:
-from rmapy.document import ZipDocument
-from rmapy.api import Client
-
+from breaker import remarkable_call
 from config import Config
+import clients
 
 
 class UserModel(Model):
@@ -18,27 +26,142 @@ class UserModel(Model):
         table_name = "remailable-user"
         region = Config.AWS_REGION
         billing_mode = PAY_PER_REQUEST_BILLING_MODE
+        host = clients.dynamodb_host()
+        max_pool_connections = clients.pool_size()
 
     email = UnicodeAttribute(hash_key=True)
     device = UnicodeAttribute()
     user = UnicodeAttribute()
+    # Unix timestamp at which `user` stops being valid, if we could decode it:
+    user_expires = NumberAttribute(null=True)
+    # Unix timestamp of the last time a delivery had to renew this user's token:
+    last_used = NumberAttribute(null=True)
+
+
+def token_expiry(token: str) -> Optional[float]:
+    """
+    Read the `exp` claim out of a reMarkable user token (a JWT).
+
+    The signature isn't checked; we only use this to decide when to renew.
+    Returns None if the token can't be decoded.
+    """
+    try:
+        payload = token.split(".")[1]
+        payload += "=" * (-len(payload) % 4)
+        return float(json.loads(base64.urlsafe_b64decode(payload))["exp"])
+    except (AttributeError, IndexError, KeyError, TypeError, ValueError):
+        return None
+
+
+def needs_renewal(expires: Optional[float], margin: float = None) -> bool:
+    """
+    True if a token expiring at `expires` should be renewed now.
+
+    Tokens with an unknown expiry are always renewed.
+    """
+    if margin is None:
+        margin = getattr(Config, "TOKEN_RENEW_MARGIN", 300)
+    return expires is None or expires - margin <= time.time()
+
+
+class TokenCache:
+    """
+    A small thread-safe LRU of user configs, keyed by sanitized email.
+
+    This lives at module scope, so it survives across warm lambda
+    invocations in the same container.
+    """
+
+    def __init__(self, max_size: int = 256):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        # user -> [lock, how many callers hold or are waiting for it]. Entries
+        # are dropped when nobody's using them, so unknown senders don't
+        # leave locks behind.
+        self._user_locks = {}
+
+    def get(self, user_email: str) -> Optional[dict]:
+        with self._lock:
+            entry = self._entries.get(user_email)
+            if entry is None:
+                return None
+            self._entries.move_to_end(user_email)
+            return entry
+
+    def put(
+        self,
+        user_email: str,
+        cfg: dict,
+        expires: Optional[float],
+        last_used: Optional[float] = None,
+    ) -> None:
+        with self._lock:
+            if last_used is None:
+                last_used = self._entries.get(user_email, {}).get("last_used")
+            self._entries[user_email] = {
+                "config": cfg,
+                "expires": expires,
+                "last_used": last_used,
+            }
+            self._entries.move_to_end(user_email)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def mark_used(self, user_email: str, when: float) -> None:
+        with self._lock:
+            if user_email in self._entries:
+                self._entries[user_email]["last_used"] = when
+
+    def evict(self, user_email: str) -> None:
+        with self._lock:
+            self._entries.pop(user_email, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    @contextlib.contextmanager
+    def lock_for(self, user_email: str):
+        """
+        Hold a per-user lock, so that concurrent deliveries for the same
+        user only renew their token once.
+        """
+        with self._lock:
+            entry = self._user_locks.setdefault(user_email, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._user_locks[user_email]
+
+
+TOKEN_CACHE = TokenCache(getattr(Config, "TOKEN_CACHE_SIZE", 256))
+
+
+class StaleUserError(KeyError):
+    """
+    The user was deleted or re-registered while we were renewing their token.
+    """
+
 
 class UserLookerUpper:
-    def __init__(self):
-        pass
+    def __init__(self, cache: TokenCache = None):
+        self.cache = cache or TOKEN_CACHE
 
     def delete_user(self, user_email: str) -> bool:
         user_email = sanitize_email(user_email)
-        UserModel.get(user_email).delete()
+        self.cache.evict(user_email)
+        UserModel(user_email).delete()
         return True
 
     def get_config_for_user(self, user_email: str) -> dict:
         user_email = sanitize_email(user_email)
-        try:
-            cfg = UserModel.get(user_email)
-        except:
-            raise KeyError(f"Failed key lookup for {user_email}.")
-        return {"devicetoken": cfg.device, "usertoken": cfg.user}
+        return self._config(self._get_user(user_email))
 
     def add_user_config(self, user_email: str, config: dict) -> bool:
         user_email = sanitize_email(user_email)
@@ -46,25 +169,176 @@ class UserLookerUpper:
         # When inevitably someone double-registers, this will bork.
         # Probably it'll be me, and I'll be so upset at first, and then I'll be
         # so glad I wrote this comment.
+        expires = token_expiry(config["usertoken"])
+        now = time.time()
         UserModel(
-            email=user_email, device=config["devicetoken"], user=config["usertoken"]
+            email=user_email,
+            device=config["devicetoken"],
+            user=config["usertoken"],
+            user_expires=expires,
+            last_used=now,
         ).save()
+        self.cache.put(user_email, config, expires, last_used=now)
         return True
 
-    def renew_user_token(self, user_email: str) -> bool:
-        cfg = self.get_config_for_user(user_email)
+    def renew_user_token(self, user_email: str) -> dict:
+        user_email = sanitize_email(user_email)
+        with self.cache.lock_for(user_email):
+            return self._renew(user_email, self._stored_config(user_email)["config"])
+
+    def resolve_users(self, user_emails: Iterable[str]) -> Dict[str, dict]:
+        """
+        Look up many users at once, with a single BatchGetItem for everyone
+        who isn't already cached.
+
+        The results are cached, so later `get_valid_config` calls for these
+        users don't need their own read. Returns the stored config of every
+        user that exists, keyed by sanitized email. Nothing is renewed here.
+        """
+        found = {}
+        missing = []
+        for user_email in {sanitize_email(e) for e in user_emails}:
+            cached = self.cache.get(user_email)
+            if cached:
+                found[user_email] = cached["config"]
+            else:
+                missing.append(user_email)
+        if missing:
+            for user in UserModel.batch_get(missing):
+                cfg = self._config(user)
+                self.cache.put(user.email, cfg, user.user_expires, user.last_used)
+                found[user.email] = cfg
+        return found
+
+    def get_valid_config(self, user_email: str) -> dict:
+        """
+        Return a config whose user token isn't about to expire.
+
+        This is served from the in-process cache when possible, then from
+        DynamoDB, and only goes to the reMarkable token endpoint if the
+        stored token is within `Config.TOKEN_RENEW_MARGIN` seconds of expiry.
+
+        Either way, the user is recorded as active (see `_mark_used`).
+        """
+        user_email = sanitize_email(user_email)
+        cached = self.cache.get(user_email)
+        if cached and not needs_renewal(cached["expires"]):
+            self._mark_used(user_email, cached)
+            return cached["config"]
+
+        with self.cache.lock_for(user_email):
+            # Someone else may have renewed while we were waiting:
+            stored = self._stored_config(user_email)
+            if not needs_renewal(stored["expires"]):
+                self._mark_used(user_email, stored)
+                return stored["config"]
+            try:
+                return self._renew(user_email, stored["config"], last_used=time.time())
+            except StaleUserError:
+                # Our copy was out of date (the user re-registered from
+                # another device); try once more from the table:
+                stored = self._stored_config(user_email)
+                return self._renew(user_email, stored["config"], last_used=time.time())
+
+    def prerenew_active_users(self, window: float = None, active_days: float = None) -> dict:
+        """
+        Renew every recently-active user whose token expires within `window`
+        seconds, so that deliveries don't have to wait on renewal.
+        """
+        if window is None:
+            window = getattr(Config, "TOKEN_PRERENEW_WINDOW", 3600)
+        if active_days is None:
+            active_days = getattr(Config, "ACTIVE_USER_DAYS", 30)
+        now = time.time()
+        counts = {"renewed": 0, "failed": 0}
+        for user in UserModel.scan(
+            (UserModel.user_expires < now + window)
+            & (UserModel.last_used > now - active_days * 24 * 60 * 60)
+        ):
+            try:
+                self._renew(user.email, self._config(user))
+            except Exception as e:
+                print(f"Failed to pre-renew token for {user.email}: {e}")
+                counts["failed"] += 1
+            else:
+                counts["renewed"] += 1
+        return counts
+
+    def _get_user(self, user_email: str) -> UserModel:
+        try:
+            return UserModel.get(user_email)
+        except:
+            raise KeyError(f"Failed key lookup for {user_email}.")
+
+    def _stored_config(self, user_email: str) -> dict:
+        """
+        The cache entry for this user, reading it from the table on a miss.
+        """
+        cached = self.cache.get(user_email)
+        if cached is None:
+            user = self._get_user(user_email)
+            self.cache.put(user_email, self._config(user), user.user_expires, user.last_used)
+            cached = self.cache.get(user_email)
+        return cached
+
+    def _mark_used(self, user_email: str, entry: dict) -> None:
+        """
+        Record that the user is sending documents, so that
+        `prerenew_active_users` keeps their token fresh. The write is
+        skipped if we recorded it in the last `Config.LAST_USED_INTERVAL`
+        seconds (default six hours). Failures are logged and swallowed.
+        """
+        now = time.time()
+        interval = getattr(Config, "LAST_USED_INTERVAL", 6 * 60 * 60)
+        if (entry.get("last_used") or 0) > now - interval:
+            return
+        # Don't write again while this one's in flight:
+        self.cache.mark_used(user_email, now)
+        try:
+            UserModel(user_email).update(
+                actions=[UserModel.last_used.set(now)],
+                condition=UserModel.email.exists(),
+            )
+        except Exception as e:
+            print(f"Failed to record activity for {user_email}: {e}")
+
+    def _config(self, user: UserModel) -> dict:
+        return {"devicetoken": user.device, "usertoken": user.user}
+
+    def _renew(self, user_email: str, cfg: dict, last_used: float = None) -> dict:
+        from rmapy.api import Client
+
         rm = Client(config_dict=cfg)
-        new_cfg = rm.renew_token(save_to_file=False)
-
-        UserModel.get(user_email).update(
-            actions=[
-                UserModel.device.set(new_cfg["devicetoken"]),
-                UserModel.user.set(new_cfg["usertoken"]),
-            ]
-        )
+        new_cfg = remarkable_call(rm.renew_token, save_to_file=False)
+        expires = token_expiry(new_cfg["usertoken"])
+
+        actions = [
+            UserModel.device.set(new_cfg["devicetoken"]),
+            UserModel.user.set(new_cfg["usertoken"]),
+            UserModel.user_expires.set(expires)
+            if expires is not None
+            else UserModel.user_expires.remove(),
+        ]
+        if last_used is not None:
+            actions.append(UserModel.last_used.set(last_used))
+        # No read first: the condition makes sure the user still exists and
+        # hasn't re-registered with another device since we read them.
+        try:
+            UserModel(user_email).update(
+                actions=actions,
+                condition=UserModel.device == cfg["devicetoken"],
+            )
+        except UpdateError as e:
+            self.cache.evict(user_email)
+            if e.cause_response_code == "ConditionalCheckFailedException":
+                raise StaleUserError(user_email) from e
+            raise
+        self.cache.put(user_email, new_cfg, expires, last_used)
         return new_cfg
 
 
+# Every lookup sanitizes the sender again, so remember the answers:
+@functools.lru_cache(maxsize=1024)
 def sanitize_email(user_email: str) -> str:
     """
     Given a formatted email like "Jordan M <remailable@getneutrality.org>",
@@ -82,7 +356,6 @@ def get_config_for_user(user_email: str) -> dict:
     """
     Returns a config dict for the given user, based upon email.
     """
-    user_email = sanitize_email(user_email)
     return UserLookerUpper().get_config_for_user(user_email)
 
 
@@ -90,7 +363,6 @@ def set_config_for_user(user_email: str, new_cfg: dict) -> bool:
     """
     Sets a config dict for the given user, based upon email.
     """
-    user_email = sanitize_email(user_email)
     return UserLookerUpper().add_user_config(user_email, new_cfg)
 
 
@@ -98,10 +370,32 @@ def renew_user_token(user_email: str) -> dict:
     """
     Renews the config dict for the given user, based upon email.
     """
-    user_email = sanitize_email(user_email)
     return UserLookerUpper().renew_user_token(user_email)
 
 
+def get_valid_config_for_user(user_email: str) -> dict:
+    """
+    Returns a config dict for the given user with an unexpired user token,
+    renewing it only if it's close to expiry.
+    """
+    return UserLookerUpper().get_valid_config(user_email)
+
+
+def resolve_users(user_emails: Iterable[str]) -> Dict[str, dict]:
+    """
+    Look up several users with one round trip to DynamoDB, so that
+    delivering to each of them afterwards doesn't need its own read.
+    """
+    return UserLookerUpper().resolve_users(user_emails)
+
+
+def prerenew_active_users() -> dict:
+    """
+    Renew tokens for active users that are about to expire.
+    """
+    return UserLookerUpper().prerenew_active_users()
+
+
 def delete_user(user_email: str) -> bool:
     """
     Remove the user from the database.
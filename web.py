@@ -0,0 +1,179 @@
+import datetime
+import hashlib
+import hmac
+import json
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+from typing import Callable, Optional, Tuple
+
+from flask import Flask, Response, abort, render_template, request
+
+from config import Config
+
+
+APP = Flask(__name__)
+
+
+@APP.route("/")
+def main():
+    return render_template("index.html")
+
+
+class ResponseCache:
+    """
+    JSON response bodies and their ETags, kept for `ttl` seconds, for at
+    most `max_entries` URLs (least recently used first out).
+
+    Dashboards poll the stats endpoints every few seconds; with this, they
+    cost one DynamoDB read per URL per `ttl`, and a 304 when nothing changed.
+    """
+
+    def __init__(self, ttl: float = 30, max_entries: int = 256):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_or_compute(self, key: str, compute: Callable[[], object]) -> Tuple[bytes, str]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                return entry[1], entry[2]
+        body = json.dumps(compute(), sort_keys=True).encode()
+        etag = hashlib.sha1(body).hexdigest()
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, body, etag)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return body, etag
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+
+STATS_CACHE = ResponseCache(ttl=getattr(Config, "STATS_CACHE_TTL", 30))
+
+
+def stats_endpoint(route: str):
+    """
+    Register a read-only JSON endpoint, served from STATS_CACHE.
+
+    The endpoints are only there when `Config.STATS_API_TOKEN` is set, and
+    they expect it as "Authorization: Bearer <token>".
+    """
+
+    def decorator(view):
+        @wraps(view)
+        def cached(**kwargs):
+            token = getattr(Config, "STATS_API_TOKEN", None)
+            if not token:
+                abort(404)
+            supplied = request.headers.get("Authorization", "")
+            if not hmac.compare_digest(supplied.encode(), f"Bearer {token}".encode()):
+                abort(401)
+            body, etag = STATS_CACHE.get_or_compute(
+                request.full_path, lambda: view(**kwargs)
+            )
+            headers = {
+                "ETag": f'"{etag}"',
+                "Cache-Control": f"private, max-age={int(STATS_CACHE.ttl)}",
+            }
+            if etag in request.if_none_match:
+                return Response(status=304, headers=headers)
+            return Response(body, mimetype="application/json", headers=headers)
+
+        return APP.route(route, methods=["GET"])(cached)
+
+    return decorator
+
+
+def _int_arg(name: str, default: int, maximum: int) -> int:
+    value = request.args.get(name, default, type=int)
+    if value is None or not 1 <= value <= maximum:
+        abort(400, f"{name} must be between 1 and {maximum}")
+    return value
+
+
+def _usage(granularity: str, periods: int) -> list:
+    from analytics.rollups import get_usage
+
+    step = datetime.timedelta(**{f"{granularity}s": periods - 1})
+    end = datetime.datetime.now()
+    return get_usage(granularity, end - step, end)
+
+
+def _failure_rate(requests: int, failures: int) -> Optional[float]:
+    return round(failures / requests, 4) if requests else None
+
+
+@stats_endpoint("/api/stats/throughput")
+def throughput():
+    """
+    Documents handled per hour (or per day, with ?granularity=day) over the
+    last ?periods of them, from the usage rollups.
+    """
+    granularity = request.args.get("granularity", "hour")
+    if granularity not in ("hour", "day"):
+        abort(400, "granularity must be hour or day")
+    periods = _int_arg("periods", 24, 24 * 31)
+    buckets = _usage(granularity, periods)
+    return {
+        "granularity": granularity,
+        "periods": periods,
+        "requests": sum(b["requests"] for b in buckets),
+        "upload_bytes": sum(b["upload_bytes"] for b in buckets),
+        "buckets": buckets,
+    }
+
+
+@stats_endpoint("/api/stats/failure-rate")
+def failure_rate():
+    """
+    The share of documents that failed over the last ?hours.
+    """
+    hours = _int_arg("hours", 24, 24 * 31)
+    buckets = _usage("hour", hours)
+    requests = sum(b["requests"] for b in buckets)
+    failures = sum(b["failures"] for b in buckets)
+    return {
+        "hours": hours,
+        "requests": requests,
+        "failures": failures,
+        "failure_rate": _failure_rate(requests, failures),
+    }
+
+
+@stats_endpoint("/api/users/<path:user_email>/deliveries")
+def user_deliveries(user_email: str):
+    """
+    A sender's most recent ?limit document events, newest first. Either
+    a bare address or a whole From: header will do.
+    """
+    from analytics.SendToRemarkableRequestModel import SendToRemarkableRequestModel
+    from users import sanitize_email
+
+    user_email = sanitize_email(user_email)
+    limit = _int_arg("limit", 20, 100)
+    events = [
+        {
+            "date": event.date,
+            "success": event.success,
+            "upload_size": int(event.upload_size),
+            "attachment_count": event.attachment_count,
+            "traceback": event.traceback,
+        }
+        for event in SendToRemarkableRequestModel.query(
+            user_email, scan_index_forward=False, limit=limit
+        )
+    ]
+    failures = sum(1 for e in events if not e["success"])
+    return {
+        "email": user_email,
+        "failure_rate": _failure_rate(len(events), failures),
+        "deliveries": events,
+    }